@@ -32,6 +32,14 @@ def __conf(section, param, type=None):
         sys.exit(1)
 
 
+# Flags whose environment variable wins whenever it's set, so that it can turn them off as well as on
+def __env_bool(name, section, param):
+    if environ.get(name):
+        return environ[name].lower() in ('1', 'on', 'true', 'yes')
+
+    return __conf(section, param, bool)
+
+
 DEVELOPMENT_MODE = True if environ.get('HTTPOBS_DEV') == 'yes' else False or __conf('global', 'development', bool)
 
 # API configuration
@@ -49,8 +57,28 @@ BROKER_URL = (environ.get('HTTPOBS_BROKER_URL') or __conf('scanner', 'broker'))
 DATABASE_DB = environ.get('HTTPOBS_DATABASE_DB') or __conf('database', 'database')
 DATABASE_HOST = environ.get('HTTPOBS_DATABASE_HOST') or __conf('database', 'host')
 DATABASE_PASSWORD = environ.get('HTTPOBS_DATABASE_PASS') or __conf('database', 'pass')
+DATABASE_POOL_CHECK_IDLE = float(environ.get('HTTPOBS_DATABASE_POOL_CHECK_IDLE') or
+                                 __conf('database', 'pool_check_idle'))
+DATABASE_POOL_MAX_SIZE = int(environ.get('HTTPOBS_DATABASE_POOL_MAX_SIZE') or __conf('database', 'pool_max_size'))
+DATABASE_POOL_TIMEOUT = float(environ.get('HTTPOBS_DATABASE_POOL_TIMEOUT') or __conf('database', 'pool_timeout'))
 DATABASE_PORT = int(environ.get('HTTPOBS_DATABASE_PORT') or __conf('database', 'port', int))
+DATABASE_RETENTION_COLD_PARTITIONS = int(environ.get('HTTPOBS_DATABASE_RETENTION_COLD_PARTITIONS') or
+                                         __conf('database', 'retention_cold_partitions'))
+DATABASE_RETENTION_HOT_PARTITIONS = int(environ.get('HTTPOBS_DATABASE_RETENTION_HOT_PARTITIONS') or
+                                        __conf('database', 'retention_hot_partitions'))
 DATABASE_USER = environ.get('HTTPOBS_DATABASE_USER') or __conf('database', 'user')
+DATABASE_WRITE_BEHIND = __env_bool('HTTPOBS_DATABASE_WRITE_BEHIND', 'database', 'write_behind')
+DATABASE_WRITE_BEHIND_INTERVAL = float(environ.get('HTTPOBS_DATABASE_WRITE_BEHIND_INTERVAL') or
+                                       __conf('database', 'write_behind_interval'))
+DATABASE_WRITE_BEHIND_MAX_BUFFERED = int(environ.get('HTTPOBS_DATABASE_WRITE_BEHIND_MAX_BUFFERED') or
+                                         __conf('database', 'write_behind_max_buffered'))
+DATABASE_WRITE_BEHIND_MAX_SCANS = int(environ.get('HTTPOBS_DATABASE_WRITE_BEHIND_MAX_SCANS') or
+                                      __conf('database', 'write_behind_max_scans'))
+
+# With fewer than two partitions kept, the partition that new scans are going into could be the only one left
+if DATABASE_RETENTION_HOT_PARTITIONS < 0 or DATABASE_RETENTION_HOT_PARTITIONS == 1:
+    print('retention_hot_partitions must be 0, to keep every partition, or at least 2', file=sys.stderr)
+    sys.exit(1)
 
 # Set some database provider specific parameters
 if DATABASE_HOST.endswith('.rds.amazonaws.com'):
@@ -61,11 +89,38 @@ else:
     DATABASE_SSL_MODE = 'prefer'
 
 # Retriever parameters
+RETRIEVER_ASYNC_MAX_HOSTS = int(environ.get('HTTPOBS_RETRIEVER_ASYNC_MAX_HOSTS') or
+                                __conf('retriever', 'async_max_hosts'))
+RETRIEVER_ASYNC_MAX_WORKERS = int(environ.get('HTTPOBS_RETRIEVER_ASYNC_MAX_WORKERS') or
+                                  __conf('retriever', 'async_max_workers'))
+RETRIEVER_BUDGET = __env_bool('HTTPOBS_RETRIEVER_BUDGET', 'retriever', 'budget')
+RETRIEVER_BUDGET_TIME = float(environ.get('HTTPOBS_RETRIEVER_BUDGET_TIME') or
+                              __conf('retriever', 'budget_time'))
 RETRIEVER_CONNECT_TIMEOUT = float(environ.get('HTTPOBS_RETRIEVER_CONNECT_TIMEOUT') or
                                   __conf('retriever', 'connect_timeout'))
+RETRIEVER_FAN_OUT = __env_bool('HTTPOBS_RETRIEVER_FAN_OUT', 'retriever', 'fan_out')
+RETRIEVER_FAN_OUT_MAX_WORKERS = int(environ.get('HTTPOBS_RETRIEVER_FAN_OUT_MAX_WORKERS') or
+                                    __conf('retriever', 'fan_out_max_workers'))
+RETRIEVER_LIMITER = __env_bool('HTTPOBS_RETRIEVER_LIMITER', 'retriever', 'limiter')
+RETRIEVER_LIMITER_DOMAIN_BURST = float(environ.get('HTTPOBS_RETRIEVER_LIMITER_DOMAIN_BURST') or
+                                       __conf('retriever', 'limiter_domain_burst'))
+RETRIEVER_LIMITER_DOMAIN_RATE = float(environ.get('HTTPOBS_RETRIEVER_LIMITER_DOMAIN_RATE') or
+                                      __conf('retriever', 'limiter_domain_rate'))
+RETRIEVER_LIMITER_IP_BURST = float(environ.get('HTTPOBS_RETRIEVER_LIMITER_IP_BURST') or
+                                   __conf('retriever', 'limiter_ip_burst'))
+RETRIEVER_LIMITER_IP_RATE = float(environ.get('HTTPOBS_RETRIEVER_LIMITER_IP_RATE') or
+                                  __conf('retriever', 'limiter_ip_rate'))
+RETRIEVER_LIMITER_MAX_WAIT = float(environ.get('HTTPOBS_RETRIEVER_LIMITER_MAX_WAIT') or
+                                   __conf('retriever', 'limiter_max_wait'))
+RETRIEVER_MAX_RESOURCE_SIZE = int(environ.get('HTTPOBS_RETRIEVER_MAX_RESOURCE_SIZE') or
+                                  __conf('retriever', 'max_resource_size'))
+RETRIEVER_MAX_SCAN_SIZE = int(environ.get('HTTPOBS_RETRIEVER_MAX_SCAN_SIZE') or
+                              __conf('retriever', 'max_scan_size'))
 RETRIEVER_READ_TIMEOUT = float(environ.get('HTTPOBS_RETRIEVER_READ_TIMEOUT') or
                                __conf('retriever', 'read_timeout'))
 RETRIEVER_USER_AGENT = environ.get('HTTPOBS_RETRIEVER_USER_AGENT') or __conf('retriever', 'user_agent')
+RETRIEVER_CONNECTION_ATTEMPT_DELAY = float(environ.get('HTTPOBS_RETRIEVER_CONNECTION_ATTEMPT_DELAY') or
+                                           __conf('retriever', 'connection_attempt_delay'))
 RETRIEVER_CORS_ORIGIN = environ.get('HTTPOBS_RETRIEVER_CORS_ORIGIN') or __conf('retriever', 'cors_origin')
 
 # Scanner configuration
@@ -77,12 +132,31 @@ SCANNER_ALLOW_KICKSTART_NUM_ABORTED = int(environ.get('HTTPOBS_SCANNER_ALLOW_KIC
                                           __conf('scanner', 'allow_kickstart_num_aborted'))
 SCANNER_ALLOW_LOCALHOST = (environ.get('HTTPOBS_SCANNER_ALLOW_LOCALHOST') == 'yes' or
                            __conf('scanner', 'allow_localhost', bool))
+SCANNER_ANALYZER_CACHE_SIZE = int(environ.get('HTTPOBS_SCANNER_ANALYZER_CACHE_SIZE') or
+                                  __conf('scanner', 'analyzer_cache_size'))
+SCANNER_ANALYZER_CACHE_STATS_INTERVAL = float(environ.get('HTTPOBS_SCANNER_ANALYZER_CACHE_STATS_INTERVAL') or
+                                              __conf('scanner', 'analyzer_cache_stats_interval'))
+SCANNER_ANALYZER_THREADS = int(environ.get('HTTPOBS_SCANNER_ANALYZER_THREADS') or
+                               __conf('scanner', 'analyzer_threads'))
+SCANNER_ANALYZER_TIMEOUT = float(environ.get('HTTPOBS_SCANNER_ANALYZER_TIMEOUT') or
+                                 __conf('scanner', 'analyzer_timeout'))
 SCANNER_BROKER_RECONNECTION_SLEEP_TIME = float(environ.get('HTTPOBS_SCANNER_BROKER_RECONNECTION_SLEEP_TIME') or
                                                __conf('scanner', 'broker_reconnection_sleep_time'))
 SCANNER_CYCLE_SLEEP_TIME = float(environ.get('HTTPOBS_SCANNER_CYCLE_SLEEP_TIME') or
                                  __conf('scanner', 'cycle_sleep_time'))
 SCANNER_DATABASE_RECONNECTION_SLEEP_TIME = float(environ.get('HTTPOBS_SCANNER_DATABASE_RECONNECTION_SLEEP_TIME') or
                                                  __conf('scanner', 'database_reconnection_sleep_time'))
+SCANNER_DEQUEUE_LISTEN = __env_bool('HTTPOBS_SCANNER_DEQUEUE_LISTEN', 'scanner', 'dequeue_listen')
+SCANNER_DEQUEUE_LISTEN_TIMEOUT = float(environ.get('HTTPOBS_SCANNER_DEQUEUE_LISTEN_TIMEOUT') or
+                                       __conf('scanner', 'dequeue_listen_timeout'))
+SCANNER_DEQUEUE_SKIP_LOCKED = __env_bool('HTTPOBS_SCANNER_DEQUEUE_SKIP_LOCKED', 'scanner', 'dequeue_skip_locked')
+SCANNER_DNS_CACHE_NEGATIVE_TTL = float(environ.get('HTTPOBS_SCANNER_DNS_CACHE_NEGATIVE_TTL') or
+                                       __conf('scanner', 'dns_cache_negative_ttl'))
+SCANNER_DNS_CACHE_SIZE = int(environ.get('HTTPOBS_SCANNER_DNS_CACHE_SIZE') or
+                             __conf('scanner', 'dns_cache_size'))
+SCANNER_DNS_CACHE_TTL = float(environ.get('HTTPOBS_SCANNER_DNS_CACHE_TTL') or
+                              __conf('scanner', 'dns_cache_ttl'))
+SCANNER_DOCUMENT_ENGINE = environ.get('HTTPOBS_SCANNER_DOCUMENT_ENGINE') or __conf('scanner', 'document_engine')
 SCANNER_MAINTENANCE_CYCLE_FREQUENCY = int(environ.get('HTTPOBS_MAINTENANCE_CYCLE_FREQUENCY') or
                                           __conf('scanner', 'maintenance_cycle_frequency'))
 SCANNER_MAX_CPU_UTILIZATION = int(environ.get('HTTPOBS_SCANNER_MAX_CPU_UTILIZATION') or
@@ -94,3 +168,6 @@ SCANNER_MOZILLA_DOMAINS = [domain.strip() for domain in (environ.get('HTTPOBS_SC
                                                          __conf('scanner', 'mozilla_domains')).split(',')]
 SCANNER_PINNED_DOMAINS = [domain.strip() for domain in (environ.get('HTTPOBS_SCANNER_PINNED_DOMAINS') or
                                                         __conf('scanner', 'pinned_domains')).split(',')]
+SCANNER_PSL_CACHE_SIZE = int(environ.get('HTTPOBS_SCANNER_PSL_CACHE_SIZE') or
+                             __conf('scanner', 'psl_cache_size'))
+SCANNER_PSL_UPDATE_ON_STARTUP = __env_bool('HTTPOBS_SCANNER_PSL_UPDATE_ON_STARTUP', 'scanner', 'psl_update_on_startup')
@@ -1,8 +1,14 @@
-from .database import (get_cursor,
+from .database import (flush_test_results,
+                       get_cursor,
+                       get_pool_stats,
                        insert_scan,
                        insert_scan_grade,
                        insert_test_results,
+                       maintain_scan_partitions,
                        periodic_maintenance,
+                       PendingScansListener,
+                       refresh_scan_summaries,
+                       reset_pool,
                        select_scan_host_history,
                        select_scan_recent_finished_scans,
                        select_scan_recent_scan,
@@ -12,14 +18,18 @@ from .database import (get_cursor,
                        select_star_from,
                        select_test_results,
                        update_scan_state,
+                       update_site_resources,
                        update_scans_dequeue_scans)
 
 __all__ = [
     'abort_broken_scans',
+    'flush_test_results',
     'get_cursor',
+    'get_pool_stats',
     'insert_scan',
     'insert_scan_grade',
     'insert_test_results',
+    'maintain_scan_partitions',
     'select_scan_host_history',
     'select_scan_recent_finished_scans',
     'select_scan_recent_scan',
@@ -29,6 +39,10 @@ __all__ = [
     'select_star_from',
     'select_test_results',
     'update_scan_state',
+    'update_site_resources',
     'periodic_maintenance',
+    'PendingScansListener',
+    'refresh_scan_summaries',
+    'reset_pool',
     'update_scans_dequeue_scans',
 ]
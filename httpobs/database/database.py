@@ -1,17 +1,28 @@
 from contextlib import contextmanager
 from json import dumps
-from types import SimpleNamespace
 from os import getpid
+from threading import BoundedSemaphore, Lock, Thread
+from time import monotonic, sleep
 
 from httpobs.conf import (API_CACHED_RESULT_TIME,
                           DATABASE_CA_CERT,
                           DATABASE_DB,
                           DATABASE_HOST,
                           DATABASE_PASSWORD,
+                          DATABASE_POOL_CHECK_IDLE,
+                          DATABASE_POOL_MAX_SIZE,
+                          DATABASE_POOL_TIMEOUT,
                           DATABASE_PORT,
+                          DATABASE_RETENTION_COLD_PARTITIONS,
+                          DATABASE_RETENTION_HOT_PARTITIONS,
                           DATABASE_SSL_MODE,
                           DATABASE_USER,
-                          SCANNER_ABORT_SCAN_TIME)
+                          DATABASE_WRITE_BEHIND,
+                          DATABASE_WRITE_BEHIND_INTERVAL,
+                          DATABASE_WRITE_BEHIND_MAX_BUFFERED,
+                          DATABASE_WRITE_BEHIND_MAX_SCANS,
+                          SCANNER_ABORT_SCAN_TIME,
+                          SCANNER_DEQUEUE_SKIP_LOCKED)
 from httpobs.scanner import (ALGORITHM_VERSION,
                              STATE_ABORTED,
                              STATE_FAILED,
@@ -19,72 +30,305 @@ from httpobs.scanner import (ALGORITHM_VERSION,
                              STATE_PENDING,
                              STATE_STARTING)
 from httpobs.scanner.analyzer import NUM_TESTS
-from httpobs.scanner.grader import get_grade_and_likelihood_for_score, MINIMUM_SCORE_FOR_EXTRA_CREDIT
+from httpobs.scanner.grader import get_curved_score, get_grade_and_likelihood_for_score
 
+import atexit
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
-import psycopg2.pool
+import select
 import sys
 
 
-class SimpleDatabaseConnection:
-    def __init__(self):
-        self._initialized_pid = getpid()
-        self._connected = True
-        self._connect()
+def connect():
+    return psycopg2.connect(database=DATABASE_DB,
+                            host=DATABASE_HOST,
+                            password=DATABASE_PASSWORD,
+                            port=DATABASE_PORT,
+                            sslmode=DATABASE_SSL_MODE,
+                            sslrootcert=DATABASE_CA_CERT,
+                            user=DATABASE_USER)
 
-    def _connect(self):
-        try:
-            self._conn = psycopg2.connect(database=DATABASE_DB,
-                                          host=DATABASE_HOST,
-                                          password=DATABASE_PASSWORD,
-                                          port=DATABASE_PORT,
-                                          sslmode=DATABASE_SSL_MODE,
-                                          sslrootcert=DATABASE_CA_CERT,
-                                          user=DATABASE_USER)
-
-            if not self._connected:
-                print('INFO: Connected to PostgreSQL', file=sys.stderr)
-            self._connected = True
 
+class DatabaseConnectionPool:
+    """
+    A bounded pool of connections for each process. Connections are only opened when every open one is in use, and
+    once there are max_size of them, whoever wants one next waits up to timeout seconds for one to come back.
+    A connection that has sat idle for more than check_idle seconds is checked before it's handed out again, and
+    one that's closed or broken is replaced.
+
+    TLS connections cannot be shared across processes (you'll get a decryption failed or bad mac error), so the pool
+    has to be reset() in each new process after a fork; the celery and uWSGI post-fork hooks do that, and as a last
+    resort, the pool resets itself if it finds that it's running in a different process than before.
+    """
+    def __init__(self,
+                 max_size: int=DATABASE_POOL_MAX_SIZE,
+                 timeout: float=DATABASE_POOL_TIMEOUT,
+                 check_idle: float=DATABASE_POOL_CHECK_IDLE,
+                 connect=connect):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self._connect = connect
+
+        self._connected = True
+        self._generation = 0
+        self._inherited = []
+        self._idle = []
+        self.reset()
+
+    def reset(self):
+        """
+        Forget every connection, without closing them, since closing a connection opened by the parent process
+        would shut it down for the parent as well; they're kept around so that garbage collection doesn't either
+        """
+        self._inherited.extend(conn for conn, _ in self._idle)
+
+        self._generation += 1
+        self._idle = []  # (connection, when it was returned), most recently returned last
+        self._lock = Lock()
+        self._pid = getpid()
+        self._size = 0
+        self._slots = BoundedSemaphore(self.max_size)
+
+        # Metrics about how long it takes to get a connection
+        self._checkouts = 0
+        self._timeouts = 0
+        self._wait_max = 0.0
+        self._wait_total = 0.0
+
+    def __open(self):
+        try:
+            conn = self._connect()
         except Exception as e:
             print(e, file=sys.stderr)
-            self._conn = SimpleNamespace(closed=1)
 
             if self._connected:
                 print('WARNING: Disconnected from PostgreSQL', file=sys.stderr)
             self._connected = False
 
-    @property
-    def conn(self):
-        # TLS connections cannot be shared across workers; you'll get a decryption failed or bad mac error
-        # What we will do is detect if we're running in a different PID and reconnect if so
-        # TODO: use celery's worker init stuff instead?
-        if self._initialized_pid != getpid():
-            self.__init__()
+            raise IOError
+
+        if not self._connected:
+            print('INFO: Connected to PostgreSQL', file=sys.stderr)
+        self._connected = True
+
+        with self._lock:
+            self._size += 1
+
+        return conn
+
+    def __discard(self, conn):
+        with self._lock:
+            self._size -= 1
 
-        # If the connection is closed, try to reconnect and raise an IOError if it's unsuccessful
-        if self._conn.closed:
-            self._connect()
+        try:
+            conn.close()
+        except:
+            pass
 
-            if self._conn.closed:
-                raise IOError
+    def __healthy(self, conn, returned: float) -> bool:
+        if conn.closed:
+            return False
+        elif monotonic() - returned < self.check_idle:
+            return True
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+
+            return True
+        except:
+            return False
 
-        return self._conn
+    def __checkout(self):
+        if self._pid != getpid():
+            self.reset()
 
+        start = monotonic()
+        acquired = self._slots.acquire(timeout=self.timeout)
+        waited = monotonic() - start
 
-# Create an initial database connection on startup
-db = SimpleDatabaseConnection()
+        with self._lock:
+            self._checkouts += 1
+            self._wait_max = max(self._wait_max, waited)
+            self._wait_total += waited
+
+            if not acquired:
+                self._timeouts += 1
+
+        if not acquired:
+            print('WARNING: Timed out waiting for a database connection', file=sys.stderr)
+            raise IOError
+
+        try:
+            while True:
+                with self._lock:
+                    conn, returned = self._idle.pop() if self._idle else (None, None)
+
+                if conn is None:
+                    return self.__open()
+                elif self.__healthy(conn, returned):
+                    return conn
+
+                self.__discard(conn)
+        except:
+            self._slots.release()
+            raise
+
+    def __checkin(self, conn, generation: int):
+        # A connection from before reset() belongs to the pool that the parent process still has
+        if generation != self._generation:
+            return
+
+        try:
+            # Whatever was left of its transaction, such as after an exception, is thrown away
+            if conn.closed:
+                self.__discard(conn)
+            else:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+
+                with self._lock:
+                    self._idle.append((conn, monotonic()))
+        except:
+            self.__discard(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.__checkout()
+        generation = self._generation
+
+        try:
+            yield conn
+        finally:
+            self.__checkin(conn, generation)
+
+    def stats(self) -> dict:
+        """
+        :return: dictionary with:
+          checkouts: how many times a connection has been asked for
+          connections: how many connections are open
+          idle: how many of those aren't in use
+          max_size: the most connections that can be open at once
+          timeouts: how many times there wasn't a connection to be had in time
+          wait_max: the longest it has taken to get a connection, in seconds
+          wait_mean: the average time it has taken to get a connection, in seconds
+        """
+        with self._lock:
+            return {
+                'checkouts': self._checkouts,
+                'connections': self._size,
+                'idle': len(self._idle),
+                'max_size': self.max_size,
+                'timeouts': self._timeouts,
+                'wait_max': self._wait_max,
+                'wait_mean': self._wait_total / self._checkouts if self._checkouts else 0.0,
+            }
+
+
+# insert_scan() lets anyone listening on this channel know that there's a scan waiting to be dequeued
+SCANS_PENDING_CHANNEL = 'httpobs_scans_pending'
+
+# The distributions only get the changes queued up in scan_summary_deltas during periodic maintenance, so they're
+# read through views that add on whatever is still queued up
+LIVE_SUMMARIES = {
+    'grade_distribution': 'grade_distribution_live',
+    'grade_distribution_all_scans': 'grade_distribution_all_scans_live',
+    'scan_score_difference_distribution_summation': 'scan_score_difference_distribution_summation_live',
+}
+
+
+class PendingScansListener:
+    """
+    A connection of its own that LISTENs for insert_scan()'s notifications, so that the dequeuer can sleep until
+    there's a scan to dequeue rather than polling for one. If it can't listen, it goes back to polling.
+    """
+    def __init__(self, poll: float, channel: str=SCANS_PENDING_CHANNEL, connect=connect):
+        """
+        :param poll: how long to sleep instead, when the connection is down
+        :param channel: channel to listen on
+        """
+        self.channel = channel
+        self.poll = poll
+        self._conn = None
+        self._connect = connect
+        self._listening = True
+
+    def __listen(self):
+        self._conn = self._connect()
+        self._conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+
+        with self._conn.cursor() as cur:
+            cur.execute('LISTEN ' + self.channel)
+
+        if not self._listening:
+            print('INFO: Listening for pending scans again', file=sys.stderr)
+        self._listening = True
+
+    def close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except:
+                pass
+
+        self._conn = None
+
+    def wait(self, timeout: float) -> bool:
+        """
+        :param timeout: the longest to wait for a notification, in seconds
+        :return: whether there might be scans waiting, which is always the case right after (re)connecting, since
+          anything inserted before then went unnoticed
+        """
+        try:
+            if self._conn is None or self._conn.closed:
+                self.__listen()
+                return True
+
+            if not self._conn.notifies and select.select([self._conn], [], [], timeout)[0]:
+                self._conn.poll()
+
+            notified = bool(self._conn.notifies)
+            del self._conn.notifies[:]
+
+            return notified
+        except Exception as e:
+            if self._listening:
+                print('WARNING: Unable to listen for pending scans: {e}'.format(e=e), file=sys.stderr)
+            self._listening = False
+
+            self.close()
+            sleep(min(timeout, self.poll))
+
+            return True
+
+
+# Create the connection pool on startup; it connects on first use
+pool = DatabaseConnectionPool()
+
+
+def get_pool_stats() -> dict:
+    return pool.stats()
+
+
+def reset_pool() -> None:
+    # Start over with a fresh pool after forking
+    pool.reset()
 
 
 @contextmanager
 def get_cursor():
     try:
-        yield db.conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        try:
-            db.conn.commit()
-        except:
-            db.conn.rollback()
+        with pool.connection() as conn:
+            yield conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            try:
+                conn.commit()
+            except:
+                conn.rollback()
     except:
         raise IOError
 
@@ -103,8 +347,12 @@ def insert_scan(site_id: int, hidden: bool = False) -> dict:
                          VALUES (%s, %s, NOW(), %s, %s, %s)
                          RETURNING *""",
                     (site_id, STATE_PENDING, ALGORITHM_VERSION, NUM_TESTS, hidden))
+        row = dict(cur.fetchone())
 
-        return dict(cur.fetchone())
+        # Wake up any dequeuers that are waiting for something to do; they're notified once this commits
+        cur.execute('NOTIFY ' + SCANS_PENDING_CHANNEL)
+
+        return row
 
 
 def insert_scan_grade(scan_id, scan_grade, scan_score) -> dict:
@@ -120,53 +368,220 @@ def insert_scan_grade(scan_id, scan_grade, scan_score) -> dict:
 
 
 # TODO: Separate out some of this logic so it doesn't need to be duplicated in local.scan()
+def _prepare_test_results(site_id: int, scan_id: int, tests: list, response_headers: dict, status_code: int) -> tuple:
+    """
+    :return: (the rows to insert into tests, the row of values to update scans with)
+    """
+    rows = []
+    score_modifiers = []
+    tests_failed = tests_passed = 0
+
+    for test in tests:
+        name = test.pop('name')
+        expectation = test.pop('expectation')
+        passed = test.pop('pass')
+        result = test.pop('result')
+        score_modifier = test.pop('score_modifier')
+
+        # Keep track of how many tests passed or failed
+        if passed:
+            tests_passed += 1
+        else:
+            tests_failed += 1
+
+        # And keep track of the score
+        score_modifiers.append(score_modifier)
+
+        rows.append((site_id, scan_id, name, expectation, result, passed, dumps(test), score_modifier))
+
+    # Now we need to update the scans table
+    score, grade, likelihood_indicator = get_grade_and_likelihood_for_score(get_curved_score(score_modifiers))
+
+    return rows, (scan_id, tests_failed, tests_passed, grade, score, likelihood_indicator, STATE_FINISHED,
+                  dumps(response_headers), status_code)
+
+
+def _finish_scans(cur, scans: list) -> None:
+    """
+    Insert the test results of any number of scans and update their scans, all in a single statement, so that it
+    only takes one round trip to the database no matter how many there are
+
+    :param cur: cursor to execute the statement on
+    :param scans: list of (rows, scan) from _prepare_test_results()
+    :return: None; the updated scans can be fetched from the cursor
+    """
+    # Every value is sent along as a literal, since the JSON in them could have anything in it, including %s
+    tests = b','.join(cur.mogrify('(%s, %s, %s, %s, %s, %s, %s, %s)', row) for rows, _ in scans for row in rows)
+    finished = b','.join(cur.mogrify("""(%s::INTEGER, %s::SMALLINT, %s::SMALLINT, %s::VARCHAR, %s::SMALLINT,
+                                         %s::VARCHAR, %s::VARCHAR, %s::JSONB, %s::SMALLINT)""", scan)
+                         for _, scan in scans)
+
+    query = b''
+    if tests:
+        query += (b"""WITH inserted AS (
+                        INSERT INTO tests (site_id, scan_id, name, expectation, result, pass, output, score_modifier)
+                          VALUES """ + tests + b""")
+                   """)
+
+    query += (b"""UPDATE scans
+                    SET (end_time, tests_failed, tests_passed, grade, score, likelihood_indicator,
+                    state, response_headers, status_code) =
+                    (NOW(), f.tests_failed, f.tests_passed, f.grade, f.score, f.likelihood_indicator,
+                    f.state, f.response_headers, f.status_code)
+                    FROM (VALUES """ + finished + b""")
+                      AS f (id, tests_failed, tests_passed, grade, score, likelihood_indicator,
+                            state, response_headers, status_code)
+                    WHERE scans.id = f.id
+                    RETURNING scans.*""")
+
+    cur.execute(query)
+
+
+class WriteBehindBuffer:
+    """
+    Finished scans waiting to be written, so that the results of many scans can go to the database together. They're
+    written whenever max_scans of them pile up, every interval seconds by a background thread, and whenever the
+    process shuts down. Until then, their scans stay RUNNING.
+
+    If the database can't be reached, the scans are kept to try again, but only up to max_buffered of them; past
+    that, the oldest are given up on, and left for periodic_maintenance() to abort. If the database rejects a batch
+    outright, it's split up until the scans at fault are found, and those are marked as FAILED.
+    """
+    def __init__(self,
+                 max_scans: int=DATABASE_WRITE_BEHIND_MAX_SCANS,
+                 interval: float=DATABASE_WRITE_BEHIND_INTERVAL,
+                 max_buffered: int=DATABASE_WRITE_BEHIND_MAX_BUFFERED):
+        self.max_scans = max_scans
+        self.interval = interval
+        self.max_buffered = max_buffered
+
+        self._lock = Lock()
+        self._pid = None
+        self._scans = []
+
+    def __flusher(self):
+        while True:
+            sleep(self.interval)
+            self.flush()
+
+    def add(self, rows: list, scan: tuple) -> None:
+        """
+        :param rows: the rows to insert into tests, from _prepare_test_results()
+        :param scan: the row of values to update scans with, from _prepare_test_results()
+        """
+        with self._lock:
+            # Threads don't survive a fork, so each process starts its own flusher
+            if self._pid != getpid():
+                self._pid = getpid()
+                self._scans = []
+
+                Thread(target=self.__flusher, daemon=True).start()
+                atexit.register(self.flush)
+
+            self._scans.append((rows, scan))
+            self.__truncate()
+            full = len(self._scans) >= self.max_scans
+
+        if full:
+            self.flush()
+
+    def __truncate(self):
+        # Called with the lock held
+        dropped = len(self._scans) - self.max_buffered
+        if dropped > 0:
+            print('WARNING: Write-behind buffer is full, giving up on {num} finished scan(s)'.format(num=dropped),
+                  file=sys.stderr)
+
+            self._scans = self._scans[dropped:]
+
+    @staticmethod
+    def __write(scans: list):
+        try:
+            with pool.connection() as conn:
+                with conn.cursor() as cur:
+                    _finish_scans(cur, scans)
+                conn.commit()
+        except (IOError, psycopg2.InterfaceError, psycopg2.OperationalError):
+            raise IOError  # worth trying again, unlike anything else, which will just fail the same way next time
+
+    @staticmethod
+    def __fail(scan: tuple, e: Exception):
+        print('WARNING: Unable to write finished scan {id}: {e}'.format(id=scan[0], e=e), file=sys.stderr)
+
+        try:
+            update_scan_state(scan[0], STATE_FAILED, error='unable to save results')
+        except IOError:
+            pass  # it stays RUNNING until periodic_maintenance() aborts it
+
+    def flush(self) -> int:
+        """
+        Write out every scan waiting in the buffer. If the database can't be reached, the ones that haven't been
+        written yet are put back to try again next time.
+
+        :return: the number of scans written
+        """
+        with self._lock:
+            scans, self._scans = self._scans, []
+
+        batches = [scans] if scans else []
+        written = 0
+
+        while batches:
+            batch = batches.pop(0)
+
+            try:
+                self.__write(batch)
+                written += len(batch)
+            except IOError:
+                scans = batch + [scan for rest in batches for scan in rest]
+                print('WARNING: Unable to write {num} finished scan(s), will retry'.format(num=len(scans)),
+                      file=sys.stderr)
+
+                with self._lock:
+                    self._scans = scans + self._scans
+                    self.__truncate()
+
+                break
+            except Exception as e:
+                if len(batch) == 1:
+                    self.__fail(batch[0][1], e)
+                else:
+                    batches[:0] = [batch[:len(batch) // 2], batch[len(batch) // 2:]]
+
+        return written
+
+    def __len__(self):
+        with self._lock:
+            return len(self._scans)
+
+
+write_behind = WriteBehindBuffer()
+
+
+def flush_test_results() -> int:
+    return write_behind.flush()
+
+
 def insert_test_results(site_id: int,
                         scan_id: int,
                         tests: list,
                         response_headers: dict,
-                        status_code: int=None) -> dict:
-    with get_cursor() as cur:
-        tests_failed = tests_passed = 0
-        score_with_extra_credit = uncurved_score = 100
-
-        for test in tests:
-            name = test.pop('name')
-            expectation = test.pop('expectation')
-            passed = test.pop('pass')
-            result = test.pop('result')
-            score_modifier = test.pop('score_modifier')
-
-            # Keep track of how many tests passed or failed
-            if passed:
-                tests_passed += 1
-            else:
-                tests_failed += 1
-
-            # And keep track of the score
-            score_with_extra_credit += score_modifier
-            if score_modifier < 0:
-                uncurved_score += score_modifier
-
-            # Insert test result to the database
-            cur.execute("""INSERT INTO tests (site_id, scan_id, name, expectation, result, pass, output, score_modifier)
-                             VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
-                        (site_id, scan_id, name, expectation, result, passed, dumps(test), score_modifier))
-
-        # Only record the full score if the uncurved score already receives an A
-        score = score_with_extra_credit if uncurved_score >= MINIMUM_SCORE_FOR_EXTRA_CREDIT else uncurved_score
+                        status_code: int=None,
+                        buffered: bool=DATABASE_WRITE_BEHIND) -> dict:
+    """
+    :param tests: the test results, as returned by run_tests(); they're written in a single statement (along with
+      any other scans in the write-behind buffer), so every test has to have finished before anything is written
+    :param buffered: hand the results to the write-behind buffer instead of writing them right away
+    :return: the finished scan, or None if it was buffered
+    """
+    rows, scan = _prepare_test_results(site_id, scan_id, tests, response_headers, status_code)
 
-        # Now we need to update the scans table
-        score, grade, likelihood_indicator = get_grade_and_likelihood_for_score(score)
+    if buffered:
+        write_behind.add(rows, scan)
+        return None
 
-        # Update the scans table
-        cur.execute("""UPDATE scans
-                         SET (end_time, tests_failed, tests_passed, grade, score, likelihood_indicator,
-                         state, response_headers, status_code) =
-                         (NOW(), %s, %s, %s, %s, %s, %s, %s, %s)
-                         WHERE id = %s
-                         RETURNING *""",
-                    (tests_failed, tests_passed, grade, score, likelihood_indicator, STATE_FINISHED,
-                        dumps(response_headers), status_code, scan_id))
+    with get_cursor() as cur:
+        _finish_scans(cur, [(rows, scan)])
 
         row = dict(cur.fetchone())
 
@@ -180,13 +595,10 @@ def periodic_maintenance() -> int:
     :return: the number of scans that were closed out
     """
     with get_cursor() as cur:
-        # Update the various materialized views
-        cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY latest_scans;")
-        cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY earliest_scans;")
-        cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY grade_distribution;")
-        cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY grade_distribution_all_scans;")
-        cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY scan_score_difference_distribution;")
-        cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY scan_score_difference_distribution_summation;")
+        # The per-site summaries (latest_scans, etc.) are kept up to date as each scan finishes, but the changes to
+        # the distributions (grade_distribution, etc.) are queued up, so that finishing scans don't all contend for
+        # the same few counters; fold them in now
+        cur.execute('SELECT fold_scan_summary_deltas();')
 
         # Mark all scans that have been sitting unfinished for at least SCANNER_ABORT_SCAN_TIME as ABORTED
         cur.execute("""UPDATE scans
@@ -200,10 +612,50 @@ def periodic_maintenance() -> int:
         return cur.rowcount
 
 
+def maintain_scan_partitions(hot: int=DATABASE_RETENTION_HOT_PARTITIONS,
+                             cold: int=DATABASE_RETENTION_COLD_PARTITIONS) -> dict:
+    """
+    Create the partitions of scans and tests that new scans are about to need, and retire the oldest ones: once a
+    partition is no longer among the newest `hot`, it is detached into the archive schema, and once it is another
+    `cold` partitions older than that, it is dropped. Whenever partitions are archived, the summaries are rebuilt
+    from the scans that are left, in the same transaction, so that they never refer to scans that are gone.
+
+    :param hot: how many partitions (of a million scans each) to keep in scans and tests, or 0 to keep them all;
+      otherwise at least 2, so that the partition that new scans are going into is never the only one
+    :param cold: how many more partitions to keep in the archive, or 0 to keep them all
+    :return: dict of how many partitions were 'created', 'archived', and 'dropped'
+    """
+    if hot < 0 or hot == 1:
+        raise ValueError('hot must be 0, to keep every partition, or at least 2')
+
+    with get_cursor() as cur:
+        cur.execute('SELECT create_scan_partitions() AS created;')
+        partitions = {'created': cur.fetchone()['created'], 'archived': 0, 'dropped': 0}
+
+        if hot > 0:
+            cur.execute('SELECT archived, dropped FROM retire_scan_partitions(%s, %s);', (hot, cold or None))
+            partitions.update(cur.fetchone())
+
+        if partitions['archived']:
+            cur.execute('SELECT refresh_scan_summaries();')
+
+    return partitions
+
+
+def refresh_scan_summaries() -> None:
+    """
+    Rebuild the summaries (latest_scans, grade_distribution, etc.) from every scan still in scans. A database trigger
+    already keeps them up to date as each scan finishes, and maintain_scan_partitions() rebuilds them when it retires
+    scans, so this is only needed to repair them, such as after scans have been deleted.
+    """
+    with get_cursor() as cur:
+        cur.execute('SELECT refresh_scan_summaries();')
+
+
 def select_star_from(table: str) -> dict:
     # Select all the rows in a given table. Note that this is specifically not parameterized.
     with get_cursor() as cur:
-        cur.execute('SELECT * FROM {table}'.format(table=table))
+        cur.execute('SELECT * FROM {table}'.format(table=LIVE_SUMMARIES.get(table, table)))
 
         return dict(cur.fetchall())
 
@@ -233,16 +685,16 @@ def select_scan_host_history(site_id: int) -> list:
 def select_scan_scanner_statistics(verbose: bool=False) -> dict:
     # Get all the scanner statistics while minimizing the number of cursors needed
     with get_cursor() as cur:
-        # Get the grade distribution across all scans (periodically refreshed)
-        cur.execute('SELECT * FROM grade_distribution;')
+        # Get the grade distribution across the latest scans (kept up to date as scans finish, see LIVE_SUMMARIES)
+        cur.execute('SELECT * FROM grade_distribution_live;')
         grade_distribution = dict(cur.fetchall())
 
-        # Get the grade distribution across all scans (periodically refreshed)
-        cur.execute('SELECT * FROM grade_distribution_all_scans;')
+        # Get the grade distribution across all scans (likewise)
+        cur.execute('SELECT * FROM grade_distribution_all_scans_live;')
         grade_distribution_all_scans = dict(cur.fetchall())
 
         # And the summation of grade differences
-        cur.execute('SELECT * FROM scan_score_difference_distribution_summation;')
+        cur.execute('SELECT * FROM scan_score_difference_distribution_summation_live;')
         scan_score_difference_distribution_summation = dict(cur.fetchall())
 
         # And the total number of scans
@@ -319,9 +771,15 @@ def select_scan_recent_scan(site_id: int, recent_in_seconds=API_CACHED_RESULT_TI
 
 
 def select_site_headers(hostname: str) -> dict:
-    # Return the site's headers
+    # Return the site's headers, along with the resources (and their validators) retrieved during its last scan
     with get_cursor() as cur:
-        cur.execute("""SELECT public_headers, private_headers, cookies FROM sites
+        cur.execute("""SELECT public_headers, private_headers, cookies,
+                         (SELECT jsonb_object_agg(path, jsonb_build_object('body', body,
+                                                                           'etag', etag,
+                                                                           'last_modified', last_modified))
+                            FROM site_resources
+                            WHERE site_id = sites.id) AS resources
+                         FROM sites
                          WHERE domain = (%s)
                          ORDER BY creation_time DESC
                          LIMIT 1""",
@@ -337,7 +795,8 @@ def select_site_headers(hostname: str) -> dict:
 
             return {
                 'cookies': {} if row.get('cookies') is None else row.get('cookies'),
-                'headers': headers
+                'headers': headers,
+                'resources': {} if row.get('resources') is None else row.get('resources')
             }
         else:
             return {}
@@ -402,17 +861,81 @@ def update_scan_state(scan_id, state: str, error=None) -> dict:
     return row
 
 
-def update_scans_dequeue_scans(num_to_dequeue: int = 0) -> dict:
+def update_site_resources(site_id: int, resources: dict, previous: dict=None) -> None:
+    """
+    Store the resources retrieved during a scan along with their validators, so that the next scan can make
+    conditional requests for them. Only the resources whose validators changed are written, all in a single
+    statement, and if none did, which is most of the time, nothing is sent to the database at all.
+
+    :param site_id: site to store the resources for
+    :param resources: path -> {'body', 'etag', 'last_modified'}, i.e. the resource_cache of retrieve_all()
+    :param previous: the 'resources' that select_site_headers() returned before the scan, so unchanged resources
+      aren't rewritten
+    :return: None
+    """
+    previous = previous or {}
+
+    def validators(resource: dict) -> tuple:
+        return resource.get('etag'), resource.get('last_modified')
+
+    # PostgreSQL's TEXT can't hold NUL, which is about the only thing a page's text can contain that it can't
+    removed = [path for path in previous if path not in resources]
+    changed = [(site_id, path, resource['etag'], resource['last_modified'], resource['body'].replace('\x00', ''))
+               for path, resource in resources.items()
+               if path not in previous or validators(previous[path]) != validators(resource)]
+
+    if not removed and not changed:
+        return
+
+    with get_cursor() as cur:
+        query = b''
+        if removed:
+            query = cur.mogrify("""DELETE FROM site_resources
+                                     WHERE site_id = (%s) AND path = ANY(%s)""",
+                                (site_id, removed))
+
+        if changed:
+            if query:
+                query = b'WITH deleted AS (' + query + b') '
+
+            # Every value is sent along as a literal, like in _finish_scans(), since the bodies could have anything in
+            # them, including %s
+            query += (b"""INSERT INTO site_resources (site_id, path, etag, last_modified, body)
+                            VALUES """ + b','.join(cur.mogrify('(%s, %s, %s, %s, %s)', row) for row in changed) + b"""
+                            ON CONFLICT (site_id, path) DO UPDATE
+                            SET (etag, last_modified, body) =
+                            (EXCLUDED.etag, EXCLUDED.last_modified, EXCLUDED.body)""")
+
+        cur.execute(query)
+
+
+def update_scans_dequeue_scans(num_to_dequeue: int = 0, skip_locked: bool=SCANNER_DEQUEUE_SKIP_LOCKED) -> dict:
+    """
+    :param num_to_dequeue: the most scans to dequeue
+    :param skip_locked: take the oldest pending scans that no other dequeuer has locked, rather than waiting on
+      whichever scans another dequeuer is in the middle of taking
+    :return: list of (domain, site_id, scan_id) for each scan dequeued
+    """
+    if skip_locked:
+        dequeue = """SELECT sites.domain, scans.site_id, scans.id AS scan_id, scans.state
+                       FROM scans
+                       INNER JOIN sites ON scans.site_id = sites.id
+                       WHERE state = %s
+                       ORDER BY scans.start_time
+                       LIMIT %s
+                       FOR UPDATE OF scans SKIP LOCKED"""
+    else:
+        dequeue = """SELECT sites.domain, scans.site_id, scans.id AS scan_id, scans.state
+                       FROM scans
+                       INNER JOIN sites ON scans.site_id = sites.id
+                       WHERE state = %s
+                       LIMIT %s
+                       FOR UPDATE"""
+
     with get_cursor() as cur:
         cur.execute("""UPDATE scans
                          SET (state) = (%s)
-                         FROM (
-                           SELECT sites.domain, scans.site_id, scans.id AS scan_id, scans.state
-                             FROM scans
-                             INNER JOIN sites ON scans.site_id = sites.id
-                             WHERE state = %s
-                             LIMIT %s
-                             FOR UPDATE) sub
+                         FROM (""" + dequeue + """) sub
                          WHERE scans.id = sub.scan_id
                          RETURNING sub.domain, sub.site_id, sub.scan_id""",
                     (STATE_STARTING, STATE_PENDING, num_to_dequeue))
@@ -14,6 +14,7 @@ CREATE TABLE IF NOT EXISTS expectations (
   expectation                         VARCHAR NOT NULL
 );
 
+/* Scans and their tests are partitioned on the scan's id, see create_scan_partitions() */
 CREATE TABLE IF NOT EXISTS scans (
   id                                  SERIAL PRIMARY KEY,
   site_id                             INTEGER REFERENCES sites (id) NOT NULL,
@@ -31,18 +32,30 @@ CREATE TABLE IF NOT EXISTS scans (
   response_headers                    JSONB NULL,
   hidden                              BOOL       NOT NULL DEFAULT FALSE,
   status_code                         SMALLINT   NULL
-);
+) PARTITION BY RANGE (id);
 
+/* scan_id can't reference scans itself, which is partitioned, so each partition of tests references the partition of
+   scans with the same bounds instead (see create_scan_partitions()), and the two are retired together */
 CREATE TABLE IF NOT EXISTS tests (
-  id                                  BIGSERIAL PRIMARY KEY,
+  id                                  BIGSERIAL,
   site_id                             INTEGER REFERENCES sites (id) NOT NULL,
-  scan_id                             INTEGER REFERENCES scans (id) NOT NULL,
+  scan_id                             INTEGER  NOT NULL,
   name                                VARCHAR  NOT NULL,
   expectation                         VARCHAR  NOT NULL,
   result                              VARCHAR  NOT NULL,
   score_modifier                      SMALLINT NOT NULL,
   pass                                BOOL     NOT NULL,
-  output                              JSONB    NOT NULL
+  output                              JSONB    NOT NULL,
+  PRIMARY KEY (scan_id, id)
+) PARTITION BY RANGE (scan_id);
+
+CREATE TABLE IF NOT EXISTS site_resources (
+  site_id                             INTEGER REFERENCES sites (id) NOT NULL,
+  path                                VARCHAR NOT NULL,
+  etag                                VARCHAR NULL,
+  last_modified                       VARCHAR NULL,
+  body                                TEXT NOT NULL,
+  PRIMARY KEY (site_id, path)
 );
 
 CREATE INDEX sites_domain_idx            ON sites (domain);
@@ -55,8 +68,8 @@ CREATE INDEX scans_algorithm_version_idx ON scans (algorithm_version);
 CREATE INDEX scans_grade_idx             ON scans (grade);
 CREATE INDEX scans_score_idx             ON scans (score);
 CREATE INDEX scans_hidden_idx            ON scans (hidden);
+CREATE INDEX scans_pending_idx           ON scans (start_time) WHERE state = 'PENDING';
 
-CREATE INDEX tests_scan_id_idx           ON tests (scan_id);
 CREATE INDEX tests_name_idx              ON tests (name);
 CREATE INDEX tests_result_idx            ON tests (result);
 CREATE INDEX tests_pass_idx              ON tests (pass);
@@ -67,6 +80,7 @@ GRANT UPDATE (domain) ON sites to httpobsscanner;  /* TODO: there's got to be a
 GRANT UPDATE on scans TO httpobsscanner;
 GRANT INSERT on tests TO httpobsscanner;
 GRANT USAGE ON SEQUENCE tests_id_seq TO httpobsscanner;
+GRANT SELECT, INSERT, UPDATE, DELETE ON site_resources TO httpobsscanner;
 
 CREATE USER httpobsapi;
 GRANT SELECT ON expectations, scans, tests to httpobsapi;
@@ -80,40 +94,388 @@ GRANT USAGE ON SEQUENCE expectations_id_seq TO httpobsapi;
 
 CREATE INDEX scans_site_id_finished_state_end_time_idx ON scans (site_id, state, end_time DESC) WHERE state = 'FINISHED';
 
-CREATE MATERIALIZED VIEW latest_scans
-  AS SELECT latest_scans.site_id, latest_scans.scan_id, s.domain, latest_scans.state,
-    latest_scans.start_time, latest_scans.end_time, latest_scans.tests_failed, latest_scans.tests_passed,
-    latest_scans.grade, latest_scans.score, latest_scans.error
-  FROM sites s,
-  LATERAL ( SELECT id AS scan_id, site_id, state, start_time, end_time, tests_failed, tests_passed, grade, score, error
-            FROM scans WHERE site_id = s.id AND state = 'FINISHED' ORDER BY end_time DESC LIMIT 1 ) latest_scans;
+/* Each partition holds a million scans, or their tests: partition n holds scan ids n * 1000000 to (n + 1) * 1000000 */
+CREATE OR REPLACE FUNCTION scan_partition_size() RETURNS INTEGER AS $$
+  SELECT 1000000;
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION scan_partition_name(parent VARCHAR, n INTEGER) RETURNS VARCHAR AS $$
+  SELECT parent || '_p' || lpad(n::TEXT, 6, '0');
+$$ LANGUAGE sql IMMUTABLE;
+
+/* Create the partitions for the scans being inserted now, and for the next few after them, if they don't exist yet */
+CREATE OR REPLACE FUNCTION create_scan_partitions(ahead INTEGER DEFAULT 2) RETURNS INTEGER AS $$
+DECLARE
+  size INTEGER := scan_partition_size();
+  newest INTEGER := (SELECT last_value FROM scans_id_seq) / scan_partition_size();
+  created INTEGER := 0;
+BEGIN
+  FOR n IN newest..newest + ahead LOOP
+    CONTINUE WHEN to_regclass(scan_partition_name('scans', n)) IS NOT NULL;
+
+    BEGIN
+      EXECUTE format('CREATE TABLE %I PARTITION OF scans FOR VALUES FROM (%s) TO (%s)',
+                     scan_partition_name('scans', n), n::BIGINT * size, (n + 1)::BIGINT * size);
+      EXECUTE format('CREATE TABLE %I PARTITION OF tests (FOREIGN KEY (scan_id) REFERENCES %I (id))
+                        FOR VALUES FROM (%s) TO (%s)',
+                     scan_partition_name('tests', n), scan_partition_name('scans', n),
+                     n::BIGINT * size, (n + 1)::BIGINT * size);
+      created := created + 1;
+    EXCEPTION WHEN invalid_object_definition THEN
+      /* Overlaps the scans from before partitioning, which are all in partition 0 */
+      NULL;
+    END;
+  END LOOP;
+
+  RETURN created;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = public;
+
+/* Retired partitions end up here, out of the way of vacuuming and of queries against scans and tests */
+CREATE SCHEMA IF NOT EXISTS archive;
+
+/* Detach every partition of scans and tests but the newest `hot` into the archive schema, dropping all their indexes
+   except their primary keys, and drop archived partitions that are `cold` partitions older than that, if given. A
+   partition of tests always goes along with the partition of scans that it references, so that neither one is ever
+   left behind without the other */
+CREATE OR REPLACE FUNCTION retire_scan_partitions(hot INTEGER, cold INTEGER DEFAULT NULL,
+                                                  OUT archived INTEGER, OUT dropped INTEGER) AS $$
+DECLARE
+  newest INTEGER := (SELECT last_value FROM scans_id_seq) / scan_partition_size();
+  retired RECORD;
+  index_name VARCHAR;
+BEGIN
+  archived := 0;
+  dropped := 0;
+
+  FOR retired IN
+    SELECT c.relname AS name, p.relname AS parent
+      FROM pg_inherits i
+      INNER JOIN pg_class c ON (c.oid = i.inhrelid)
+      INNER JOIN pg_class p ON (p.oid = i.inhparent)
+      WHERE i.inhparent IN ('scans'::REGCLASS, 'tests'::REGCLASS)
+        AND c.relname ~ '^(scans|tests)_p\d+$'
+        AND substring(c.relname FROM '_p(\d+)$')::INTEGER <= newest - hot
+  LOOP
+    EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', retired.parent, retired.name);
+    EXECUTE format('ALTER TABLE %I SET SCHEMA archive', retired.name);
+
+    FOR index_name IN
+      SELECT c.relname
+        FROM pg_index x
+        INNER JOIN pg_class c ON (c.oid = x.indexrelid)
+        WHERE x.indrelid = format('archive.%I', retired.name)::REGCLASS
+          AND NOT x.indisprimary
+    LOOP
+      EXECUTE format('DROP INDEX archive.%I', index_name);
+    END LOOP;
+
+    IF retired.parent = 'scans' THEN
+      archived := archived + 1;
+    END IF;
+  END LOOP;
+
+  IF cold IS NOT NULL THEN
+    FOR retired IN
+      SELECT relname AS name
+        FROM pg_class
+        WHERE relnamespace = 'archive'::REGNAMESPACE
+          AND relkind = 'r'
+          AND relname ~ '^(scans|tests)_p\d+$'
+          AND substring(relname FROM '_p(\d+)$')::INTEGER <= newest - hot - cold
+        ORDER BY relname DESC  /* each partition of tests before the partition of scans that it references */
+    LOOP
+      EXECUTE format('DROP TABLE archive.%I', retired.name);
+
+      IF retired.name LIKE 'scans%' THEN
+        dropped := dropped + 1;
+      END IF;
+    END LOOP;
+  END IF;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = public;
+
+REVOKE ALL ON FUNCTION create_scan_partitions(INTEGER), retire_scan_partitions(INTEGER, INTEGER) FROM PUBLIC;
+GRANT EXECUTE ON FUNCTION create_scan_partitions(INTEGER), retire_scan_partitions(INTEGER, INTEGER) TO httpobsscanner;
+
+SELECT create_scan_partitions();
+
+/* Summaries of the finished scans, kept up to date by update_scan_summaries() as each scan finishes */
+CREATE TABLE IF NOT EXISTS latest_scans (
+  site_id                             INTEGER PRIMARY KEY REFERENCES sites (id),
+  scan_id                             INTEGER    NOT NULL,
+  domain                              VARCHAR(255) NOT NULL,
+  state                               VARCHAR    NOT NULL,
+  start_time                          TIMESTAMP  NOT NULL,
+  end_time                            TIMESTAMP  NULL,
+  tests_failed                        SMALLINT   NOT NULL,
+  tests_passed                        SMALLINT   NOT NULL,
+  grade                               VARCHAR(2) NULL,
+  score                               SMALLINT   NULL,
+  error                               VARCHAR    NULL
+);
 CREATE UNIQUE INDEX latest_scans_scan_id_idx ON latest_scans (scan_id);
-COMMENT ON MATERIALIZED VIEW latest_scans IS 'Most recently completed scan for a given website';
-GRANT SELECT ON latest_scans TO httpobsapi;
+COMMENT ON TABLE latest_scans IS 'Most recently completed scan for a given website';
+
+CREATE TABLE IF NOT EXISTS earliest_scans (LIKE latest_scans INCLUDING CONSTRAINTS);
+ALTER TABLE earliest_scans ADD PRIMARY KEY (site_id);
+CREATE UNIQUE INDEX earliest_scans_scan_id_idx ON earliest_scans (scan_id);
+COMMENT ON TABLE earliest_scans IS 'Oldest completed scan for a given website';
 
-CREATE MATERIALIZED VIEW latest_tests
+CREATE TABLE IF NOT EXISTS grade_distribution (
+  grade                               VARCHAR(2) PRIMARY KEY,
+  count                               INTEGER    NOT NULL
+);
+COMMENT ON TABLE grade_distribution IS 'The grades and how many latest scans have that score';
+
+CREATE TABLE IF NOT EXISTS grade_distribution_all_scans (LIKE grade_distribution INCLUDING CONSTRAINTS);
+ALTER TABLE grade_distribution_all_scans ADD PRIMARY KEY (grade);
+COMMENT ON TABLE grade_distribution_all_scans IS 'The grades and how many scans have that score';
+
+CREATE TABLE IF NOT EXISTS scan_score_difference_distribution (
+  site_id                             INTEGER PRIMARY KEY REFERENCES sites (id),
+  domain                              VARCHAR(255) NOT NULL,
+  before                              SMALLINT   NOT NULL,
+  after                               SMALLINT   NOT NULL,
+  difference                          SMALLINT   NOT NULL
+);
+CREATE INDEX scan_score_difference_difference_distribution_idx ON scan_score_difference_distribution (difference);
+COMMENT ON TABLE scan_score_difference_distribution IS 'How much score has changed since first scan';
+
+CREATE TABLE IF NOT EXISTS scan_score_difference_distribution_summation (
+  difference                          SMALLINT PRIMARY KEY,
+  num_sites                           INTEGER  NOT NULL
+);
+COMMENT ON TABLE scan_score_difference_distribution_summation IS 'How many sites have improved by how many points';
+
+/* Finished scans only ever insert here, rather than all queueing on the same few counters in the tables above */
+CREATE TABLE IF NOT EXISTS scan_summary_deltas (
+  grade                               VARCHAR(2) NULL,
+  old_grade                           VARCHAR(2) NULL,
+  new_grade                           VARCHAR(2) NULL,
+  old_difference                      SMALLINT   NULL,
+  new_difference                      SMALLINT   NULL
+);
+COMMENT ON TABLE scan_summary_deltas IS 'Changes to the grade and score difference distributions, not yet folded in';
+
+CREATE VIEW latest_tests
   AS SELECT latest_scans.domain, tests.site_id, tests.scan_id, name, result, pass, output
   FROM tests
   INNER JOIN latest_scans
   ON (latest_scans.scan_id = tests.scan_id);
-COMMENT ON MATERIALIZED VIEW latest_tests IS 'Test results from all the most recent scans';
-
-CREATE MATERIALIZED VIEW grade_distribution
-  AS SELECT grade, count(*)
-    FROM latest_scans
-    GROUP BY grade;
-CREATE UNIQUE INDEX grade_distribution_grade_idx ON grade_distribution (grade);
-COMMENT ON MATERIALIZED VIEW grade_distribution IS 'The grades and how many latest scans have that score';
-GRANT SELECT ON grade_distribution TO httpobsapi;
-
-CREATE MATERIALIZED VIEW grade_distribution_all_scans
-  AS SELECT grade, count(*)
-    FROM scans
-    WHERE state = 'FINISHED'
-    GROUP BY grade;
-CREATE UNIQUE INDEX grade_distribution_all_scans_grade_idx ON grade_distribution_all_scans (grade);
-COMMENT ON MATERIALIZED VIEW grade_distribution_all_scans IS 'The grades and how many scans have that score';
-GRANT SELECT ON grade_distribution_all_scans TO httpobsapi;
+COMMENT ON VIEW latest_tests IS 'Test results from all the most recent scans';
+
+/* The distributions as they stand right now: what has been folded in, plus whatever is still queued up. Both come from
+   the same snapshot, so a fold that commits in the meantime is either entirely in one or entirely in the other */
+CREATE VIEW grade_distribution_live
+  AS SELECT grade, sum(count)::INTEGER AS count FROM (
+    SELECT grade, count FROM grade_distribution
+    UNION ALL
+    SELECT new_grade, 1 FROM scan_summary_deltas WHERE new_grade IS NOT NULL
+    UNION ALL
+    SELECT old_grade, -1 FROM scan_summary_deltas WHERE old_grade IS NOT NULL
+  ) counts GROUP BY grade HAVING sum(count) > 0;
+COMMENT ON VIEW grade_distribution_live IS 'grade_distribution, including the deltas not yet folded in';
+
+CREATE VIEW grade_distribution_all_scans_live
+  AS SELECT grade, sum(count)::INTEGER AS count FROM (
+    SELECT grade, count FROM grade_distribution_all_scans
+    UNION ALL
+    SELECT grade, 1 FROM scan_summary_deltas WHERE grade IS NOT NULL
+  ) counts GROUP BY grade;
+COMMENT ON VIEW grade_distribution_all_scans_live
+  IS 'grade_distribution_all_scans, including the deltas not yet folded in';
+
+CREATE VIEW scan_score_difference_distribution_summation_live
+  AS SELECT difference, sum(num_sites)::INTEGER AS num_sites FROM (
+    SELECT difference, num_sites FROM scan_score_difference_distribution_summation
+    UNION ALL
+    SELECT new_difference, 1 FROM scan_summary_deltas WHERE new_difference IS NOT NULL
+    UNION ALL
+    SELECT old_difference, -1 FROM scan_summary_deltas WHERE old_difference IS NOT NULL
+  ) counts GROUP BY difference HAVING sum(num_sites) > 0;
+COMMENT ON VIEW scan_score_difference_distribution_summation_live
+  IS 'scan_score_difference_distribution_summation, including the deltas not yet folded in';
+
+GRANT SELECT ON latest_scans, earliest_scans, grade_distribution, grade_distribution_all_scans,
+  scan_score_difference_distribution, scan_score_difference_distribution_summation, latest_tests,
+  grade_distribution_live, grade_distribution_all_scans_live, scan_score_difference_distribution_summation_live
+  TO httpobsapi;
+GRANT SELECT, INSERT, UPDATE, DELETE ON latest_scans, earliest_scans, grade_distribution, grade_distribution_all_scans,
+  scan_score_difference_distribution, scan_score_difference_distribution_summation TO httpobsscanner;
+GRANT SELECT, INSERT, DELETE ON scan_summary_deltas TO httpobsscanner;
+
+/* Fold a scan that has just finished into the per-site summaries, in the same transaction that finished it, and
+   queue up its changes to the distributions for fold_scan_summary_deltas() */
+CREATE OR REPLACE FUNCTION update_scan_summaries() RETURNS TRIGGER AS $$
+DECLARE
+  site_domain VARCHAR;
+  latest latest_scans%ROWTYPE;
+  earliest earliest_scans%ROWTYPE;
+  previous_earliest_score SMALLINT;
+BEGIN
+  /* Scans of the same site finishing at the same time take turns */
+  SELECT domain INTO site_domain FROM sites WHERE id = NEW.site_id FOR UPDATE;
+  SELECT * INTO latest FROM latest_scans WHERE site_id = NEW.site_id;
+  SELECT * INTO earliest FROM earliest_scans WHERE site_id = NEW.site_id;
+  previous_earliest_score := earliest.score;
+
+  /* A site's first scan is both its earliest and its latest. Scans can finish out of order, so one that finished
+     before the site's earliest becomes its earliest instead; like refresh_scan_summaries(), ties go to the lower id */
+  IF earliest.scan_id IS NULL OR (NEW.end_time, NEW.id) < (earliest.end_time, earliest.scan_id) THEN
+    INSERT INTO earliest_scans (site_id, scan_id, domain, state, start_time, end_time, tests_failed, tests_passed,
+                                grade, score, error)
+      VALUES (NEW.site_id, NEW.id, site_domain, NEW.state, NEW.start_time, NEW.end_time, NEW.tests_failed,
+              NEW.tests_passed, NEW.grade, NEW.score, NEW.error)
+      ON CONFLICT (site_id) DO UPDATE SET (scan_id, domain, state, start_time, end_time, tests_failed, tests_passed,
+                                           grade, score, error) =
+        (EXCLUDED.scan_id, EXCLUDED.domain, EXCLUDED.state, EXCLUDED.start_time, EXCLUDED.end_time,
+         EXCLUDED.tests_failed, EXCLUDED.tests_passed, EXCLUDED.grade, EXCLUDED.score, EXCLUDED.error)
+      RETURNING * INTO earliest;
+  END IF;
+
+  /* Likewise, one that finished before the site's latest doesn't replace it, but if it's the new earliest, the site's
+     score has changed by a different amount since then */
+  IF latest.scan_id IS NOT NULL AND (latest.end_time, latest.scan_id) > (NEW.end_time, NEW.id) THEN
+    IF earliest.scan_id = NEW.id THEN
+      UPDATE scan_score_difference_distribution SET (before, difference) = (NEW.score, latest.score - NEW.score)
+        WHERE site_id = NEW.site_id;
+
+      INSERT INTO scan_summary_deltas (grade, old_difference, new_difference)
+        VALUES (NEW.grade, latest.score - previous_earliest_score, latest.score - NEW.score);
+    ELSE
+      INSERT INTO scan_summary_deltas (grade) VALUES (NEW.grade);
+    END IF;
+
+    RETURN NULL;
+  END IF;
+
+  INSERT INTO latest_scans (site_id, scan_id, domain, state, start_time, end_time, tests_failed, tests_passed,
+                            grade, score, error)
+    VALUES (NEW.site_id, NEW.id, site_domain, NEW.state, NEW.start_time, NEW.end_time, NEW.tests_failed,
+            NEW.tests_passed, NEW.grade, NEW.score, NEW.error)
+    ON CONFLICT (site_id) DO UPDATE SET (scan_id, domain, state, start_time, end_time, tests_failed, tests_passed,
+                                         grade, score, error) =
+      (EXCLUDED.scan_id, EXCLUDED.domain, EXCLUDED.state, EXCLUDED.start_time, EXCLUDED.end_time,
+       EXCLUDED.tests_failed, EXCLUDED.tests_passed, EXCLUDED.grade, EXCLUDED.score, EXCLUDED.error);
+
+  INSERT INTO scan_score_difference_distribution (site_id, domain, before, after, difference)
+    VALUES (NEW.site_id, site_domain, earliest.score, NEW.score, NEW.score - earliest.score)
+    ON CONFLICT (site_id) DO UPDATE SET (after, difference) = (EXCLUDED.after, EXCLUDED.difference);
+
+  /* Take the site's previous latest scan out of the distributions, and put this one in */
+  INSERT INTO scan_summary_deltas (grade, old_grade, new_grade, old_difference, new_difference)
+    VALUES (NEW.grade, latest.grade, NEW.grade, latest.score - earliest.score, NEW.score - earliest.score);
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER scans_update_scan_summaries
+  AFTER UPDATE OF state ON scans
+  FOR EACH ROW
+  WHEN (NEW.state = 'FINISHED' AND OLD.state <> 'FINISHED')
+  EXECUTE PROCEDURE update_scan_summaries();
+
+/* Fold the queued up deltas into the grade and score difference distributions, a row at a time in a fixed order; only
+   one caller at a time does the folding, and the rest return straight away. Until then, the *_live views add them on
+   when the distributions are read. */
+CREATE OR REPLACE FUNCTION fold_scan_summary_deltas() RETURNS INTEGER AS $$
+DECLARE
+  folded INTEGER;
+BEGIN
+  IF NOT pg_try_advisory_xact_lock('scan_summary_deltas'::REGCLASS::OID::BIGINT) THEN
+    RETURN 0;
+  END IF;
+
+  /* Every part of the statement sees the same snapshot, so the deltas that get added up are exactly the ones that get
+     deleted, and any queued up in the meantime are left for next time */
+  WITH folding AS (
+    DELETE FROM scan_summary_deltas RETURNING *
+  ), all_scans AS (
+    INSERT INTO grade_distribution_all_scans (grade, count)
+      SELECT grade, count(*) FROM folding WHERE grade IS NOT NULL GROUP BY grade ORDER BY grade
+      ON CONFLICT (grade) DO UPDATE SET count = grade_distribution_all_scans.count + EXCLUDED.count
+  ), latest AS (
+    INSERT INTO grade_distribution (grade, count)
+      SELECT grade, sum(delta) FROM (
+        SELECT new_grade AS grade, 1 AS delta FROM folding WHERE new_grade IS NOT NULL
+        UNION ALL
+        SELECT old_grade, -1 FROM folding WHERE old_grade IS NOT NULL
+      ) deltas GROUP BY grade ORDER BY grade
+      ON CONFLICT (grade) DO UPDATE SET count = grade_distribution.count + EXCLUDED.count
+  ), differences AS (
+    INSERT INTO scan_score_difference_distribution_summation (difference, num_sites)
+      SELECT difference, sum(delta) FROM (
+        SELECT new_difference AS difference, 1 AS delta FROM folding WHERE new_difference IS NOT NULL
+        UNION ALL
+        SELECT old_difference, -1 FROM folding WHERE old_difference IS NOT NULL
+      ) deltas GROUP BY difference ORDER BY difference
+      ON CONFLICT (difference) DO UPDATE
+        SET num_sites = scan_score_difference_distribution_summation.num_sites + EXCLUDED.num_sites
+  )
+  SELECT count(*) INTO folded FROM folding;
+
+  DELETE FROM grade_distribution WHERE count <= 0;
+  DELETE FROM scan_score_difference_distribution_summation WHERE num_sites <= 0;
+
+  RETURN folded;
+END;
+$$ LANGUAGE plpgsql;
+
+/* Rebuild the summaries from every scan still in scans, which is only needed to repair them, e.g. after deleting
+   scans, or for them to forget scans that retire_scan_partitions() has retired, which maintain_scan_partitions() does
+   in the same transaction */
+CREATE OR REPLACE FUNCTION refresh_scan_summaries() RETURNS VOID AS $$
+BEGIN
+  /* Scans finishing in the meantime wait for this to be done */
+  LOCK TABLE latest_scans, earliest_scans, grade_distribution, grade_distribution_all_scans,
+    scan_score_difference_distribution, scan_score_difference_distribution_summation, scan_summary_deltas
+    IN EXCLUSIVE MODE;
+
+  /* Everything still queued up is about to be counted from scratch */
+  DELETE FROM scan_summary_deltas;
+
+  DELETE FROM latest_scans;
+  INSERT INTO latest_scans
+    SELECT latest.site_id, latest.scan_id, s.domain, latest.state, latest.start_time, latest.end_time,
+      latest.tests_failed, latest.tests_passed, latest.grade, latest.score, latest.error
+    FROM sites s,
+    LATERAL ( SELECT id AS scan_id, site_id, state, start_time, end_time, tests_failed, tests_passed, grade, score, error
+              FROM scans WHERE site_id = s.id AND state = 'FINISHED'
+              ORDER BY end_time DESC, id DESC LIMIT 1 ) latest;
+
+  DELETE FROM earliest_scans;
+  INSERT INTO earliest_scans
+    SELECT earliest.site_id, earliest.scan_id, s.domain, earliest.state, earliest.start_time, earliest.end_time,
+      earliest.tests_failed, earliest.tests_passed, earliest.grade, earliest.score, earliest.error
+    FROM sites s,
+    LATERAL ( SELECT id AS scan_id, site_id, state, start_time, end_time, tests_failed, tests_passed, grade, score, error
+              FROM scans WHERE site_id = s.id AND state = 'FINISHED'
+              ORDER BY end_time ASC, id ASC LIMIT 1 ) earliest;
+
+  DELETE FROM grade_distribution;
+  INSERT INTO grade_distribution
+    SELECT grade, count(*) FROM latest_scans WHERE grade IS NOT NULL GROUP BY grade;
+
+  DELETE FROM grade_distribution_all_scans;
+  INSERT INTO grade_distribution_all_scans
+    SELECT grade, count(*) FROM scans WHERE state = 'FINISHED' AND grade IS NOT NULL GROUP BY grade;
+
+  DELETE FROM scan_score_difference_distribution;
+  INSERT INTO scan_score_difference_distribution
+    SELECT earliest_scans.site_id, earliest_scans.domain, earliest_scans.score, latest_scans.score,
+      latest_scans.score - earliest_scans.score
+    FROM earliest_scans, latest_scans
+    WHERE earliest_scans.site_id = latest_scans.site_id
+      AND earliest_scans.score IS NOT NULL
+      AND latest_scans.score IS NOT NULL;
+
+  DELETE FROM scan_score_difference_distribution_summation;
+  INSERT INTO scan_score_difference_distribution_summation
+    SELECT difference, count(*) FROM scan_score_difference_distribution GROUP BY difference;
+END;
+$$ LANGUAGE plpgsql;
 
 /* Update to add cookies */
 /*
@@ -132,47 +494,148 @@ GRANT SELECT ON latest_scans TO httpobsapi;
 ALTER MATERIALIZED VIEW latest_scans OWNER TO httpobsscanner;
 */
 
-/* Update to add earliest scans and a way to compare earliest and latest */
-CREATE MATERIALIZED VIEW earliest_scans
-  AS SELECT earliest_scans.site_id, earliest_scans.scan_id, s.domain, earliest_scans.state,
-    earliest_scans.start_time, earliest_scans.end_time, earliest_scans.tests_failed, earliest_scans.tests_passed,
-    earliest_scans.grade, earliest_scans.score, earliest_scans.error
-  FROM sites s,
-  LATERAL ( SELECT id AS scan_id, site_id, state, start_time, end_time, tests_failed, tests_passed, grade, score, error
-            FROM scans WHERE site_id = s.id AND state = 'FINISHED' ORDER BY end_time ASC LIMIT 1 ) earliest_scans;
-CREATE UNIQUE INDEX earliest_scans_scan_id_idx ON earliest_scans (scan_id);
-COMMENT ON MATERIALIZED VIEW earliest_scans IS 'Oldest completed scan for a given website';
-GRANT SELECT ON earliest_scans TO httpobsapi;
-
-CREATE MATERIALIZED VIEW scan_score_difference_distribution
-  AS SELECT earliest_scans.site_id, earliest_scans.domain, earliest_scans.score AS before, latest_scans.score AS after,
-    (latest_scans.score - earliest_scans.score) AS difference
-  FROM earliest_scans, latest_scans
-  WHERE earliest_scans.site_id = latest_scans.site_id;
-COMMENT ON MATERIALIZED VIEW scan_score_difference_distribution IS 'How much score has changed since first scan';
-GRANT SELECT ON scan_score_difference_distribution TO httpobsapi;
-CREATE UNIQUE INDEX scan_score_difference_distribution_site_id_idx ON scan_score_difference_distribution (site_id);
-CREATE INDEX scan_score_difference_difference_distribution_idx ON scan_score_difference_distribution (difference);
-
-CREATE MATERIALIZED VIEW scan_score_difference_distribution_summation
-  AS SELECT DISTINCT difference, COUNT(difference) AS num_sites
-  FROM scan_score_difference_distribution
-  GROUP BY difference
-  ORDER BY difference DESC;
-CREATE UNIQUE INDEX scan_score_difference_distribution_summation_difference_idx ON scan_score_difference_distribution_summation (difference);
-COMMENT ON MATERIALIZED VIEW scan_score_difference_distribution_summation IS 'How many sites have improved by how many points';
-GRANT SELECT ON scan_score_difference_distribution_summation TO httpobsapi;
-
-ALTER MATERIALIZED VIEW grade_distribution OWNER TO httpobsscanner;  /* so it can refresh */
-ALTER MATERIALIZED VIEW grade_distribution_all_scans OWNER TO httpobsscanner;  /* so it can refresh */
-ALTER MATERIALIZED VIEW latest_scans OWNER TO httpobsscanner;
-ALTER MATERIALIZED VIEW earliest_scans OWNER TO httpobsscanner;
-ALTER MATERIALIZED VIEW scan_score_difference_distribution OWNER TO httpobsscanner;
-ALTER MATERIALIZED VIEW scan_score_difference_distribution_summation OWNER TO httpobsscanner;
-ALTER MATERIALIZED VIEW latest_tests OWNER TO httpobsscanner;
-
 /* Database updates to allow us to track changes in scoring over time */
 /*
 ALTER TABLE scans ADD COLUMN algorithm_version SMALLINT NOT NULL DEFAULT 1;
 CREATE INDEX scans_algorithm_version_idx ON scans (algorithm_version);
-*/
\ No newline at end of file
+*/
+
+/* Update to cache the well-known resources between scans, for conditional requests */
+/*
+CREATE TABLE IF NOT EXISTS site_resources (
+  site_id                             INTEGER REFERENCES sites (id) NOT NULL,
+  path                                VARCHAR NOT NULL,
+  etag                                VARCHAR NULL,
+  last_modified                       VARCHAR NULL,
+  body                                TEXT NOT NULL,
+  PRIMARY KEY (site_id, path)
+);
+GRANT SELECT, INSERT, UPDATE, DELETE ON site_resources TO httpobsscanner;
+*/
+
+/* Update to dequeue pending scans oldest first without scanning the whole table */
+/*
+CREATE INDEX scans_pending_idx ON scans (start_time) WHERE state = 'PENDING';
+*/
+
+/* Update to keep the summaries up to date as each scan finishes, instead of refreshing materialized views */
+/*
+DROP MATERIALIZED VIEW scan_score_difference_distribution_summation, scan_score_difference_distribution,
+  grade_distribution_all_scans, grade_distribution, earliest_scans, latest_scans CASCADE;
+-- then create the summary tables, latest_tests, the functions, and the trigger above, followed by:
+SELECT refresh_scan_summaries();
+*/
+
+/* Update to queue up changes to the distributions rather than updating them as each scan finishes */
+/*
+-- create scan_summary_deltas and its grant, update_scan_summaries() and fold_scan_summary_deltas() above, then the
+-- *_live views and their grant
+*/
+
+/* Update to partition scans and tests on the scan's id, which needs PostgreSQL 11 or later. Everything so far becomes
+   partition 0, up to the next multiple of a million, where tests_scan_id_fkey now references scans_p000000, just like
+   the foreign keys of the partitions that come after it. Create scan_partition_size(), scan_partition_name(),
+   create_scan_partitions(), the archive schema, retire_scan_partitions() and their grants above first. */
+/*
+DROP VIEW latest_tests;
+DROP TRIGGER scans_update_scan_summaries ON scans;
+DO $$
+DECLARE
+  i RECORD;
+BEGIN
+  FOR i IN SELECT indexname, tablename FROM pg_indexes WHERE schemaname = 'public' AND tablename IN ('scans', 'tests')
+  LOOP
+    EXECUTE format('ALTER INDEX %I RENAME TO %I',
+                   i.indexname, replace(i.indexname, i.tablename, i.tablename || '_p000000'));
+  END LOOP;
+END;
+$$;
+ALTER TABLE scans RENAME TO scans_p000000;
+ALTER TABLE tests RENAME TO tests_p000000;
+ALTER SEQUENCE scans_id_seq RENAME TO scans_p000000_id_seq;
+ALTER SEQUENCE tests_id_seq RENAME TO tests_p000000_id_seq;
+
+-- the primary key of tests is now (scan_id, id), which also covers looking up a scan's tests
+ALTER TABLE tests_p000000 DROP CONSTRAINT tests_p000000_pkey;
+DROP INDEX tests_p000000_scan_id_idx;
+ALTER TABLE tests_p000000 ADD PRIMARY KEY (scan_id, id);
+
+CREATE TABLE scans (
+  id                                  SERIAL PRIMARY KEY,
+  site_id                             INTEGER REFERENCES sites (id) NOT NULL,
+  state                               VARCHAR    NOT NULL,
+  start_time                          TIMESTAMP  NOT NULL,
+  end_time                            TIMESTAMP  NULL,
+  algorithm_version                   SMALLINT   NOT NULL DEFAULT 1,
+  tests_failed                        SMALLINT   NOT NULL DEFAULT 0,
+  tests_passed                        SMALLINT   NOT NULL DEFAULT 0,
+  tests_quantity                      SMALLINT   NOT NULL,
+  grade                               VARCHAR(2) NULL,
+  score                               SMALLINT   NULL,
+  likelihood_indicator                VARCHAR    NULL,
+  error                               VARCHAR    NULL,
+  response_headers                    JSONB NULL,
+  hidden                              BOOL       NOT NULL DEFAULT FALSE,
+  status_code                         SMALLINT   NULL
+) PARTITION BY RANGE (id);
+CREATE TABLE tests (
+  id                                  BIGSERIAL,
+  site_id                             INTEGER REFERENCES sites (id) NOT NULL,
+  scan_id                             INTEGER  NOT NULL,
+  name                                VARCHAR  NOT NULL,
+  expectation                         VARCHAR  NOT NULL,
+  result                              VARCHAR  NOT NULL,
+  score_modifier                      SMALLINT NOT NULL,
+  pass                                BOOL     NOT NULL,
+  output                              JSONB    NOT NULL,
+  PRIMARY KEY (scan_id, id)
+) PARTITION BY RANGE (scan_id);
+
+CREATE INDEX scans_site_id_idx           ON scans (site_id);
+CREATE INDEX scans_state_idx             ON scans (state);
+CREATE INDEX scans_start_time_idx        ON scans (start_time);
+CREATE INDEX scans_end_time_idx          ON scans (end_time);
+CREATE INDEX scans_algorithm_version_idx ON scans (algorithm_version);
+CREATE INDEX scans_grade_idx             ON scans (grade);
+CREATE INDEX scans_score_idx             ON scans (score);
+CREATE INDEX scans_hidden_idx            ON scans (hidden);
+CREATE INDEX scans_pending_idx           ON scans (start_time) WHERE state = 'PENDING';
+CREATE INDEX scans_site_id_finished_state_end_time_idx ON scans (site_id, state, end_time DESC) WHERE state = 'FINISHED';
+CREATE INDEX tests_name_idx              ON tests (name);
+CREATE INDEX tests_result_idx            ON tests (result);
+CREATE INDEX tests_pass_idx              ON tests (pass);
+
+GRANT SELECT on scans, tests TO httpobsscanner;
+GRANT UPDATE on scans TO httpobsscanner;
+GRANT INSERT on tests TO httpobsscanner;
+GRANT USAGE ON SEQUENCE tests_id_seq TO httpobsscanner;
+GRANT SELECT ON scans, tests to httpobsapi;
+GRANT INSERT ON scans TO httpobsapi;
+GRANT UPDATE ON scans TO httpobsapi;
+GRANT USAGE ON SEQUENCE scans_id_seq TO httpobsapi;
+
+SELECT setval('scans_id_seq', (SELECT max(id) FROM scans_p000000));
+SELECT setval('tests_id_seq', (SELECT max(id) FROM tests_p000000));
+DO $$
+DECLARE
+  bound BIGINT := ((SELECT last_value FROM scans_id_seq) / scan_partition_size() + 1)::BIGINT * scan_partition_size();
+BEGIN
+  EXECUTE format('ALTER TABLE scans ATTACH PARTITION scans_p000000 FOR VALUES FROM (MINVALUE) TO (%s)', bound);
+  EXECUTE format('ALTER TABLE tests ATTACH PARTITION tests_p000000 FOR VALUES FROM (MINVALUE) TO (%s)', bound);
+END;
+$$;
+SELECT create_scan_partitions();
+
+CREATE VIEW latest_tests
+  AS SELECT latest_scans.domain, tests.site_id, tests.scan_id, name, result, pass, output
+  FROM tests
+  INNER JOIN latest_scans
+  ON (latest_scans.scan_id = tests.scan_id);
+COMMENT ON VIEW latest_tests IS 'Test results from all the most recent scans';
+GRANT SELECT ON latest_tests TO httpobsapi;
+CREATE TRIGGER scans_update_scan_summaries
+  AFTER UPDATE OF state ON scans
+  FOR EACH ROW
+  WHEN (NEW.state = 'FINISHED' AND OLD.state <> 'FINISHED')
+  EXECUTE PROCEDURE update_scan_summaries();
+*/
@@ -1,10 +1,27 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from io import BytesIO
+from itertools import islice
+from multiprocessing import Pool
+
+from httpobs.conf import SCANNER_ANALYZER_THREADS, SCANNER_ANALYZER_TIMEOUT
+from httpobs.scanner.grader import get_curved_score, get_grade_and_likelihood_for_score, get_score_description
+from httpobs.scanner.retriever.capture import dump_retrievals, load_retrievals
+
 from .content import contribute, subresource_integrity
 from .headers import (content_security_policy, cookies, public_key_pinning, referrer_policy, strict_transport_security,
                       x_content_type_options, x_xss_protection, x_frame_options)
 from .misc import cross_origin_resource_sharing, redirection
+from .utils import Facts, get_fact
+
+import sys
 
 __all__ = [
+    'AnalyzerTimeout',
+    'analyze',
+    'analyze_many',
+    'iter_tests',
     'NUM_TESTS',
+    'run_tests',
     'tests',
     'TEST_NAMES'
 ]
@@ -26,3 +43,152 @@ tests = (
 
 NUM_TESTS = len(tests)
 TEST_NAMES = [test.__name__.replace('_', '-') for test in tests]
+
+
+class AnalyzerTimeout(Exception):
+    pass
+
+
+def iter_tests(reqs: dict, threads: int=SCANNER_ANALYZER_THREADS, timeout: float=SCANNER_ANALYZER_TIMEOUT):
+    """
+    Run every test against a scan, deriving each fact that the tests share (including other tests' results) only
+    once. With threads, the tests run concurrently, and each result is handed back as soon as it and all the ones
+    before it are ready, so that whatever consumes them can get started on them.
+
+    :param reqs: dictionary containing all the request and response objects
+    :param threads: how many tests to run at once, or 0 to run them one after another
+    :param timeout: with threads, how long to wait on each test after the one before it, in seconds
+    :return: generator of test results, in the same order as tests
+    """
+    # The facts hang off a copy of reqs that belongs to this run alone, rather than off reqs itself, since a test
+    # that has timed out can still be running (and deriving facts) long after this has returned
+    reqs = dict(reqs, facts=Facts())
+
+    if not threads:
+        for name in TEST_NAMES:
+            yield get_fact(reqs, name)
+
+        return
+
+    executor = ThreadPoolExecutor(threads)
+    futures = [executor.submit(get_fact, reqs, name) for name in TEST_NAMES]
+
+    try:
+        for name, future in zip(TEST_NAMES, futures):
+            try:
+                yield future.result(timeout=timeout)
+            except TimeoutError:
+                raise AnalyzerTimeout('{name} took longer than {timeout} seconds'.format(name=name,
+                                                                                         timeout=timeout))
+    finally:
+        # A test that's stuck can't be interrupted, but there's no need to wait for it either
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def run_tests(reqs: dict, threads: int=SCANNER_ANALYZER_THREADS, timeout: float=SCANNER_ANALYZER_TIMEOUT) -> list:
+    """
+    Run every test against a scan; see iter_tests()
+
+    :param reqs: dictionary containing all the request and response objects
+    :param threads: how many tests to run at once, or 0 to run them one after another
+    :param timeout: with threads, how long to wait on each test after the one before it, in seconds
+    :return: list of test results, in the same order as tests
+    """
+    return list(iter_tests(reqs, threads=threads, timeout=timeout))
+
+
+def analyze(reqs: dict) -> dict:
+    """
+    Run every test against a retrieval, and grade the results
+
+    :param reqs: dictionary containing all the request and response objects, as returned by retrieve_all()
+    :return: dictionary with the scan's grade and score under 'scan', and each test's result under 'tests', or just
+      an 'error' if the site was down
+    """
+    # If we can't connect at all, there's nothing to analyze
+    if reqs['responses']['auto'] is None:
+        return {'error': 'site down'}
+
+    # Get all the results
+    results = run_tests(reqs)
+    for result in results:
+        result['score_description'] = get_score_description(result['result'])
+
+    # Get the score, grade, etc.
+    grades = get_grade_and_likelihood_for_score(get_curved_score(result.get('score_modifier', 0)
+                                                                 for result in results))
+    tests_passed = sum([1 if result.get('pass') else 0 for result in results])
+
+    return {
+        'scan': {
+            'grade': grades[1],
+            'likelihood_indicator': grades[2],
+            'response_headers': dict(reqs['responses']['auto'].headers),
+            'score': grades[0],
+            'tests_failed': NUM_TESTS - tests_passed,
+            'tests_passed': tests_passed,
+            'tests_quantity': NUM_TESTS,
+        },
+        'tests': {result.pop('name'): result for result in results}
+    }
+
+
+def __analyze_safely(reqs) -> dict:
+    # One bad retrieval shouldn't stop the rest of the batch
+    try:
+        # Retrievals travel to the pool's processes in the capture format, since live sessions can't be pickled
+        if isinstance(reqs, bytes):
+            reqs = load_retrievals(BytesIO(reqs))
+        elif isinstance(reqs, Exception):
+            raise reqs  # it couldn't be captured in the first place
+
+        return analyze(reqs)
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except:
+        return {'error': repr(sys.exc_info()[1])}
+
+
+def __capture(reqs: dict):
+    capture = BytesIO()
+
+    try:
+        dump_retrievals(reqs, capture)
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except Exception as e:
+        return e
+
+    return capture.getvalue()
+
+
+def analyze_many(retrievals, processes: int=0, chunksize: int=32):
+    """
+    Analyze any number of retrievals, such as all the ones in a capture file or a set of scans being regraded. Each
+    process reuses its header evaluation caches from one retrieval to the next, so sites that send the same headers
+    (which is a lot of them) only have them evaluated once per process.
+
+    :param retrievals: iterable of dictionaries as returned by retrieve_all() or iter_retrievals()
+    :param processes: how many processes to spread the analysis across, or 0 to do it all in this one
+    :param chunksize: how many retrievals to hand to a process at a time
+    :return: generator of analyze() results, in the same order as retrievals
+    """
+    if not processes:
+        for reqs in retrievals:
+            yield __analyze_safely(reqs)
+
+        return
+
+    retrievals = iter(retrievals)
+
+    with Pool(processes) as pool:
+        # Pool.imap() would read in every last retrieval up front, so feed it a batch at a time instead
+        while True:
+            batch = [__capture(reqs) for reqs in islice(retrievals, processes * chunksize * 4)]
+            if not batch:
+                return
+
+            for result in pool.imap(__analyze_safely, batch, chunksize):
+                yield result
@@ -1,11 +1,10 @@
-from bs4 import BeautifulSoup as bs
-from publicsuffixlist import PublicSuffixList
 from urllib.parse import urlparse
 
 from httpobs.conf import SCANNER_MOZILLA_DOMAINS
 from httpobs.scanner.analyzer.decorators import scored_test
-from httpobs.scanner.analyzer.utils import only_if_worse
+from httpobs.scanner.analyzer.utils import get_document, get_fact, only_if_worse
 from httpobs.scanner.retriever.retriever import HTML_TYPES
+from httpobs.scanner.utils import privatesuffix
 
 
 import json
@@ -44,11 +43,11 @@ def contribute(reqs: dict, expectation='contribute-json-with-required-keys') ->
     # The keys that are required to be in contribute.json
     required_keys = ('name', 'description', 'participate', 'bugs', 'urls')
 
-    response = reqs['responses']['auto']
+    url = get_fact(reqs, 'url')
 
     # This finds the SLD ('mozilla' out of 'mozilla.org') if it exists
-    if '.' in urlparse(response.url).netloc:
-        second_level_domain = urlparse(response.url).netloc.split('.')[-2]
+    if '.' in url.netloc:
+        second_level_domain = url.netloc.split('.')[-2]
     else:
         second_level_domain = ''
 
@@ -135,9 +134,9 @@ def subresource_integrity(reqs: dict, expectation='sri-implemented-and-external-
         output['result'] = 'sri-not-implemented-response-not-html'
 
     else:
-        # Try to parse the HTML
+        # Try to parse the HTML, and get all the scripts
         try:
-            soup = bs(reqs['resources']['__path__'], 'html.parser')
+            scripts = get_document(reqs, '__path__').scripts
         except:
             output['result'] = 'html-not-parsable'
             return output
@@ -145,8 +144,10 @@ def subresource_integrity(reqs: dict, expectation='sri-implemented-and-external-
         # Track to see if any scripts were on foreign TLDs
         scripts_on_foreign_origin = False
 
-        # Get all the scripts
-        scripts = soup.find_all('script')
+        # The page itself is the same for every script
+        page = get_fact(reqs, 'url')
+        page_privatesuffix = privatesuffix(page.netloc)
+
         for script in scripts:
             if script.has_attr('src'):
                 # Script tag parameters
@@ -155,10 +156,7 @@ def subresource_integrity(reqs: dict, expectation='sri-implemented-and-external-
                 crossorigin = script.get('crossorigin')
 
                 # Check to see if they're on the same second-level domain
-                # TODO: update the PSL list on startup
-                psl = PublicSuffixList()
-                samesld = True if (psl.privatesuffix(urlparse(response.url).netloc) ==
-                                   psl.privatesuffix(src.netloc)) else False
+                samesld = True if page_privatesuffix == privatesuffix(src.netloc) else False
 
                 # Check to see if it's the same origin or second-level domain
                 if src.netloc == '' or samesld:
@@ -171,7 +169,7 @@ def subresource_integrity(reqs: dict, expectation='sri-implemented-and-external-
                     scripts_on_foreign_origin = True
 
                 # See if it's a secure scheme
-                if src.scheme == 'https' or (src.scheme == '' and urlparse(response.url).scheme == 'https'):
+                if src.scheme == 'https' or (src.scheme == '' and page.scheme == 'https'):
                     securescheme = True
                 else:
                     securescheme = False
@@ -1,15 +1,28 @@
 from functools import wraps
 
+from httpobs.scanner.analyzer.utils import FACTS
 from httpobs.scanner.grader import get_score_modifier
 
 
 def scored_test(func):
+    """
+    Turn an analyzer function into a test, which is also registered as a fact, so that other tests can get its result
+    with get_fact()
+
+    :param func: analyzer function
+    :return: the test
+    """
+    name = func.__name__.replace('_', '-')
+
     @wraps(func)
     def wrapper(*args, **kwargs):
         test_result = func(*args, **kwargs)
-        test_result['name'] = func.__name__.replace('_', '-')  # add the test name
+        test_result['name'] = name  # add the test name
         test_result['score_modifier'] = get_score_modifier(test_result['result'])  # and its score modifier
 
         return test_result
 
+    # Other tests can use this test's result as a fact, so that it still only runs once per scan
+    FACTS[name] = wrapper
+
     return wrapper
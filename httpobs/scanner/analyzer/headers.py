@@ -1,7 +1,10 @@
-from urllib.parse import urlparse
-
 from httpobs.scanner.analyzer.decorators import scored_test
-from httpobs.scanner.analyzer.utils import is_hpkp_preloaded, is_hsts_preloaded, only_if_worse
+from httpobs.scanner.analyzer.utils import (AnalyzerCache,
+                                            get_fact,
+                                            is_hpkp_preloaded,
+                                            is_hsts_preloaded,
+                                            only_if_worse)
+from httpobs.scanner.bypasses import ANGULAR, FLASH, JSONP, load_bypasses
 
 
 # Ignore the CloudFlare __cfduid tracking cookies. They *are* actually bad, but it is out of a site's
@@ -16,6 +19,14 @@ COOKIES_TO_DELETE = ['__cfduid', 'heroku-session-affinity']
 SHORTEST_DIRECTIVE = 'img-src'
 SHORTEST_DIRECTIVE_LENGTH = len(SHORTEST_DIRECTIVE) - 1  # the shortest policy accepted by the CSP test
 
+# Header evaluations, cached on the headers' values
+csp_cache = AnalyzerCache('content-security-policy')
+referrer_policy_cache = AnalyzerCache('referrer-policy')
+sts_cache = AnalyzerCache('strict-transport-security')
+
+# The known ways around CSP host allowlists, compiled once at startup
+csp_bypasses = load_bypasses()
+
 
 def __parse_csp(csp_string: str) -> dict:
     """
@@ -66,40 +77,23 @@ def __parse_csp(csp_string: str) -> dict:
     return csp
 
 
-@scored_test
-def content_security_policy(reqs: dict, expectation='csp-implemented-with-no-unsafe') -> dict:
-    """
-    :param reqs: dictionary containing all the request and response objects
-    :param expectation: test expectation
-        csp-implemented-with-no-unsafe: CSP implemented with no unsafe inline keywords [default]
-        csp-implemented-with-unsafe-in-style-src-only: Allow the 'unsafe' keyword in style-src only
-        csp-implemented-with-insecure-scheme-in-passive-content-only:
-          CSP implemented with insecure schemes (http, ftp) in img/media-src
-        csp-implemented-with-unsafe-inline: CSP implemented with unsafe-inline
-        csp-implemented-with-unsafe-eval: CSP implemented with unsafe-eval
-        csp-implemented-with-insecure-scheme: CSP implemented with having sources over http:
-        csp-invalid-header: Invalid CSP header
-        csp-not-implemented: CSP not implemented
-    :return: dictionary with:
-        data: the CSP lookup dictionary
-        expectation: test expectation
-        pass: whether the site's configuration met its expectation
-        result: short string describing the result of the test
+def __evaluate_csp(http: str, meta: str, scheme: str) -> dict:
     """
+    Everything in the CSP test that doesn't depend on its expectation, which is only a function of the policies
+    themselves and the scheme of the page that they came with
 
+    :param http: the Content-Security-Policy header, or None if there wasn't one
+    :param meta: the Content-Security-Policy http-equiv, or None if there wasn't one
+    :param scheme: the page's scheme, e.g. 'https'
+    :return: dictionary with data, http, meta, policy, and result, as in content_security_policy()
+    """
     output = {
         'data': None,
-        'expectation': expectation,
         'http': False,    # whether an HTTP header was available
         'meta': False,    # whether an HTTP meta-equiv was available
-        'pass': False,
         'policy': None,
         'result': None,
     }
-    response = reqs['responses']['auto']
-
-    # TODO: check for CSP meta tags
-    # TODO: try to parse when there are multiple CSP headers
 
     # Obviously you can get around it with things like https://*.org, but you're only hurting yourself
     DANGEROUSLY_BROAD = ('ftp:', 'http:', 'https:', '*', 'http://*', 'http://*.*', 'https://*', 'https://*.*')
@@ -114,10 +108,8 @@ def content_security_policy(reqs: dict, expectation='csp-implemented-with-no-uns
     # First we need to combine the HTTP header and HTTP Equiv "header"
     try:
         headers = {
-            'http': __parse_csp(response.headers.get('Content-Security-Policy'))
-            if 'Content-Security-Policy' in response.headers else None,
-            'meta': __parse_csp(response.http_equiv.get('Content-Security-Policy'))
-            if 'Content-Security-Policy' in response.http_equiv else None,
+            'http': __parse_csp(http) if http is not None else None,
+            'meta': __parse_csp(meta) if meta is not None else None,
         }
     except:
         output['result'] = 'csp-header-invalid'
@@ -131,6 +123,7 @@ def content_security_policy(reqs: dict, expectation='csp-implemented-with-no-uns
     # If we make it this far, we have a policy object
     output['policy'] = {
         'antiClickjacking': False,
+        'bypassableAllowlist': False,
         'defaultNone': False,
         'insecureBaseUri': False,
         'insecureSchemeActive': False,
@@ -207,7 +200,7 @@ def content_security_policy(reqs: dict, expectation='csp-implemented-with-no-uns
         output['policy']['unsafeInline'] = True
 
     # If the site is https, it shouldn't allow any http: as a source (active content)
-    if (urlparse(response.url).scheme == 'https' and
+    if (scheme == 'https' and
        [source for source in active_csp_sources if 'http:' in source or 'ftp:' in source] and
        not output['policy']['strictDynamic']):
         output['result'] = ('csp-implemented-with-insecure-scheme' if output['result'] is None
@@ -221,7 +214,7 @@ def content_security_policy(reqs: dict, expectation='csp-implemented-with-no-uns
         output['policy']['unsafeEval'] = True
 
     # If the site is https, it shouldn't allow any http: as a source (active content)
-    if (urlparse(response.url).scheme == 'https' and
+    if (scheme == 'https' and
        [source for source in passive_csp_sources if 'http:' in source or 'ftp:' in source]):
         output['result'] = ('csp-implemented-with-insecure-scheme-in-passive-content-only' if output['result'] is None
                             else output['result'])
@@ -247,6 +240,13 @@ def content_security_policy(reqs: dict, expectation='csp-implemented-with-no-uns
     output['policy']['insecureBaseUri'] = bool(base_uri.intersection(DANGEROUSLY_BROAD + UNSAFE_INLINE))
     output['policy']['unsafeObjects'] = bool(object_src.intersection(DANGEROUSLY_BROAD))
 
+    # Allowing a host that serves AngularJS or JSONP lets anyone run script through it, unless 'strict-dynamic' has
+    # the browser ignore the hosts in script-src entirely; likewise for hosts in object-src that serve Flash
+    output['policy']['bypassableAllowlist'] = bool(
+        (not output['policy']['strictDynamic'] and
+         csp_bypasses.bypassable(script_src, (ANGULAR, JSONP), unsafe_eval='\'unsafe-eval\'' in script_src)) or
+        csp_bypasses.bypassable(object_src, (FLASH,)))
+
     # Once we're done, convert every set() in csp to an array
     csp = {k: list(v) for k, v in csp.items()}
 
@@ -255,11 +255,59 @@ def content_security_policy(reqs: dict, expectation='csp-implemented-with-no-uns
     # Code defensively on the size of the data
     output['data'] = csp if len(str(csp)) < 32768 else {}
 
-    # Check to see if the test passed or failed
-    if output['result'] in (expectation,
-                            'csp-implemented-with-no-unsafe-default-src-none',
-                            'csp-implemented-with-unsafe-inline-in-style-src-only',
-                            'csp-implemented-with-insecure-scheme-in-passive-content-only'):
+    return output
+
+
+@scored_test
+def content_security_policy(reqs: dict, expectation='csp-implemented-with-no-unsafe') -> dict:
+    """
+    :param reqs: dictionary containing all the request and response objects
+    :param expectation: test expectation
+        csp-implemented-with-no-unsafe: CSP implemented with no unsafe inline keywords [default]
+        csp-implemented-with-unsafe-in-style-src-only: Allow the 'unsafe' keyword in style-src only
+        csp-implemented-with-insecure-scheme-in-passive-content-only:
+          CSP implemented with insecure schemes (http, ftp) in img/media-src
+        csp-implemented-with-unsafe-inline: CSP implemented with unsafe-inline
+        csp-implemented-with-unsafe-eval: CSP implemented with unsafe-eval
+        csp-implemented-with-insecure-scheme: CSP implemented with having sources over http:
+        csp-invalid-header: Invalid CSP header
+        csp-not-implemented: CSP not implemented
+    :return: dictionary with:
+        data: the CSP lookup dictionary
+        expectation: test expectation
+        pass: whether the site's configuration met its expectation
+        result: short string describing the result of the test
+    """
+
+    output = {
+        'data': None,
+        'expectation': expectation,
+        'http': False,    # whether an HTTP header was available
+        'meta': False,    # whether an HTTP meta-equiv was available
+        'pass': False,
+        'policy': None,
+        'result': None,
+    }
+    response = reqs['responses']['auto']
+
+    # TODO: check for CSP meta tags
+    # TODO: try to parse when there are multiple CSP headers
+
+    # The same policies always evaluate the same way, so the evaluation is cached on the policies themselves
+    http = response.headers.get('Content-Security-Policy')
+    meta = response.http_equiv.get('Content-Security-Policy')
+    scheme = get_fact(reqs, 'url').scheme
+
+    key = tuple(policy.replace('\r', '').replace('\n', '').strip() if policy is not None else None
+                for policy in (http, meta)) + (scheme,)
+    output.update(csp_cache.get(key, __evaluate_csp, http, meta, scheme))
+
+    # Check to see if the test passed or failed; invalid and missing policies never pass
+    if output['policy'] is not None and output['result'] in (
+            expectation,
+            'csp-implemented-with-no-unsafe-default-src-none',
+            'csp-implemented-with-unsafe-inline-in-style-src-only',
+            'csp-implemented-with-insecure-scheme-in-passive-content-only'):
         output['pass'] = True
 
     return output
@@ -303,7 +351,7 @@ def cookies(reqs: dict, expectation='cookies-secure-with-httponly-sessions') ->
     # https://github.com/mozilla/http-observatory/issues/265
 
     # Get their HTTP Strict Transport Security status, which can help when cookies are set without Secure
-    hsts = strict_transport_security(reqs)['pass']
+    hsts = get_fact(reqs, 'strict-transport-security')['pass']
 
     # If there are no cookies
     if not session.cookies:
@@ -448,7 +496,7 @@ def public_key_pinning(reqs: dict, expectation='hpkp-not-implemented') -> dict:
 
     # If they're in the preloaded list, this overrides most anything else
     if response is not None:
-        preloaded = is_hpkp_preloaded(urlparse(response.url).netloc)
+        preloaded = is_hpkp_preloaded(get_fact(reqs, 'https-url').netloc)
         if preloaded:
             output['result'] = 'hpkp-preloaded'
             output['includeSubDomains'] = preloaded['includeSubDomainsForPinning']
@@ -515,18 +563,21 @@ def referrer_policy(reqs: dict, expectation='referrer-policy-private') -> dict:
         output['pass'] = True
         return output
 
-    # Find the last known valid policy value in the Referer Policy
-    policy = [token.strip() for token in output['data'].lower().split(',') if token.strip() in valid]
-    policy = policy.pop() if policy else None
+    def evaluate(data: str) -> str:
+        # Find the last known valid policy value in the Referer Policy
+        policy = [token.strip() for token in data.lower().split(',') if token.strip() in valid]
+        policy = policy.pop() if policy else None
+
+        if policy in goodness:
+            return 'referrer-policy-private'
+        elif policy == 'no-referrer-when-downgrade':
+            return 'referrer-policy-no-referrer-when-downgrade'
+        elif policy in badness:
+            return 'referrer-policy-unsafe'
+        else:
+            return 'referrer-policy-header-invalid'
 
-    if policy in goodness:
-        output['result'] = 'referrer-policy-private'
-    elif policy == 'no-referrer-when-downgrade':
-        output['result'] = 'referrer-policy-no-referrer-when-downgrade'
-    elif policy in badness:
-        output['result'] = 'referrer-policy-unsafe'
-    else:
-        output['result'] = 'referrer-policy-header-invalid'
+    output['result'] = referrer_policy_cache.get(output['data'], evaluate, output['data'])
 
     # Test passed or failed
     if output['result'] in ('referrer-policy-private',
@@ -582,37 +633,48 @@ def strict_transport_security(reqs: dict, expectation='hsts-implemented-max-age-
     elif 'Strict-Transport-Security' in response.headers:
         output['data'] = response.headers['Strict-Transport-Security'][0:1024]  # code against malicious headers
 
-        try:
-            sts = [i.lower().strip() for i in output['data'].split(';')]
-
-            # Throw an error if the header is set twice
-            if ',' in output['data']:
-                raise ValueError
+        def evaluate(data: str) -> dict:
+            parsed = {
+                'includeSubDomains': False,
+                'max-age': None,
+                'preload': False,
+            }
+
+            try:
+                sts = [i.lower().strip() for i in data.split(';')]
+
+                # Throw an error if the header is set twice
+                if ',' in data:
+                    raise ValueError
+
+                for parameter in sts:
+                    if parameter.startswith('max-age='):
+                        parsed['max-age'] = int(parameter[8:128])  # defense
+                    elif parameter == 'includesubdomains':
+                        parsed['includeSubDomains'] = True
+                    elif parameter == 'preload':
+                        parsed['preload'] = True
+
+                if parsed['max-age']:
+                    if parsed['max-age'] < SIX_MONTHS:  # must be at least six months
+                        parsed['result'] = 'hsts-implemented-max-age-less-than-six-months'
+                    else:
+                        parsed['result'] = 'hsts-implemented-max-age-at-least-six-months'
+                else:
+                    raise ValueError
 
-            for parameter in sts:
-                if parameter.startswith('max-age='):
-                    output['max-age'] = int(parameter[8:128])  # defense
-                elif parameter == 'includesubdomains':
-                    output['includeSubDomains'] = True
-                elif parameter == 'preload':
-                    output['preload'] = True
+            except:
+                parsed['result'] = 'hsts-header-invalid'
 
-            if output['max-age']:
-                if output['max-age'] < SIX_MONTHS:  # must be at least six months
-                    output['result'] = 'hsts-implemented-max-age-less-than-six-months'
-                else:
-                    output['result'] = 'hsts-implemented-max-age-at-least-six-months'
-            else:
-                raise ValueError
+            return parsed
 
-        except:
-            output['result'] = 'hsts-header-invalid'
+        output.update(sts_cache.get(output['data'], evaluate, output['data']))
 
     # If they're in the preloaded list, this overrides most anything else
     # TODO: Check to see if all redirect domains are preloaded
     # TODO: Check every redirect along the way for HSTS
     if response is not None:
-        preloaded = is_hsts_preloaded(urlparse(response.url).netloc)
+        preloaded = is_hsts_preloaded(get_fact(reqs, 'https-url').netloc)
         if preloaded:
             output['result'] = 'hsts-preloaded'
             output['includeSubDomains'] = preloaded['includeSubDomains']
@@ -706,7 +768,7 @@ def x_frame_options(reqs: dict, expectation='x-frame-options-sameorigin-or-deny'
         output['result'] = 'x-frame-options-not-implemented'
 
     # Check to see if frame-ancestors is implemented in CSP; if it is, then it isn't needed
-    csp = content_security_policy(reqs)
+    csp = get_fact(reqs, 'content-security-policy')
     if csp['data']:
         if 'frame-ancestors' in csp['data']:  # specifically not checking for * in frame-ancestors
             output['result'] = 'x-frame-options-implemented-via-csp'
@@ -782,7 +844,7 @@ def x_xss_protection(reqs: dict, expectation='x-xss-protection-1-mode-block') ->
 
     # Allow sites to skip out of having X-XSS-Protection if they implement a strong CSP policy
     if output['pass'] is False:
-        if content_security_policy(reqs)['pass']:
+        if get_fact(reqs, 'content-security-policy')['pass']:
             output['pass'] = True
             output['result'] = 'x-xss-protection-not-needed-due-to-csp'
 
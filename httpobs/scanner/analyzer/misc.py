@@ -1,27 +1,24 @@
-from bs4 import BeautifulSoup as bs
 from urllib.parse import urlparse
 
 from httpobs.scanner.analyzer.decorators import scored_test
-from httpobs.scanner.analyzer.utils import is_hsts_preloaded
+from httpobs.scanner.analyzer.utils import get_document, is_hsts_preloaded
+from httpobs.scanner.document import Document
 
 
-def __parse_acao_xml_get_domains(xml, type='crossdomain') -> list:
-    if xml is None:
+def __parse_acao_xml_get_domains(xml: Document, type='crossdomain') -> list:
+    if xml.text is None:
         return []
 
-    # Attempt to parse the XML file
+    # Attempt to parse the XML file, and then the domains out of it
     try:
-        soup = bs(xml, 'html.parser')
+        if type == 'crossdomain':
+            return [domains.get('domain').strip()
+                    for domains in xml.find_all('allow-access-from') if domains.get('domain')]
+        elif type == 'clientaccesspolicy':
+            return [domains.get('uri').strip() for domains in xml.find_all('domain') if domains.get('uri')]
     except:
         raise KeyError
 
-    # Parse the files
-    if type == 'crossdomain':
-        return [domains.get('domain').strip()
-                for domains in soup.find_all('allow-access-from') if domains.get('domain')]
-    elif type == 'clientaccesspolicy':
-        return [domains.get('uri').strip() for domains in soup.find_all('domain') if domains.get('uri')]
-
 
 @scored_test
 def cross_origin_resource_sharing(reqs: dict, expectation='cross-origin-resource-sharing-not-implemented') -> dict:
@@ -68,8 +65,8 @@ def cross_origin_resource_sharing(reqs: dict, expectation='cross-origin-resource
     if reqs['resources']['/crossdomain.xml'] or reqs['resources']['/clientaccesspolicy.xml']:
         # Get the domains from each
         try:
-            cd = __parse_acao_xml_get_domains(reqs['resources']['/crossdomain.xml'], 'crossdomain')
-            cl = __parse_acao_xml_get_domains(reqs['resources']['/clientaccesspolicy.xml'], 'clientaccesspolicy')
+            cd = __parse_acao_xml_get_domains(get_document(reqs, '/crossdomain.xml'), 'crossdomain')
+            cl = __parse_acao_xml_get_domains(get_document(reqs, '/clientaccesspolicy.xml'), 'clientaccesspolicy')
             domains = cd + cl
 
             # Code defensively against infinitely sized xml files when storing their contents
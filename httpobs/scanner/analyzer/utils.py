@@ -1,49 +1,225 @@
-import json
-import os.path
+from collections import OrderedDict
+from copy import deepcopy
+from threading import Lock, RLock
+from time import monotonic
+from urllib.parse import urlparse
 
+from httpobs.conf import SCANNER_ANALYZER_CACHE_SIZE, SCANNER_ANALYZER_CACHE_STATS_INTERVAL
+from httpobs.scanner.document import Document
+from httpobs.scanner.preload import PreloadList
 
-# Load the HSTS list from disk
-__dirname = os.path.abspath(os.path.dirname(__file__))
-__filename = os.path.join(__dirname, '..', '..', 'conf', 'hsts-preload.json')
+import datetime
+import sys
 
-with open(__filename, 'r') as f:
-    hsts = json.load(f)
 
+# The HSTS list on disk, as a compact index that's shared between every process on the machine, and that gets
+# picked up again whenever it's regenerated
+hsts = PreloadList()
 
-def is_hpkp_preloaded(hostname):
-    # Just see if the hostname is in the HSTS list and pinned
-    if hsts.get(hostname, {}).get('pinned'):
-        return hsts[hostname]
 
-    # Either the hostname is in the list *or* one of its subdomains is
-    host = hostname.split('.')
-    levels = len(host)
+class AnalyzerCache:
+    """
+    A size-bounded cache of the parts of an analyzer that depend only on a header's value, since so many sites send
+    byte-identical headers (CDN and framework defaults, mostly). Values are copied going into and coming out of the
+    cache, so that nothing a test does to its output can ever leak into another site's results.
+    """
+    def __init__(self, name: str, max_size: int=SCANNER_ANALYZER_CACHE_SIZE):
+        self.name = name
+        self.max_size = max_size
 
-    # If hostname is foo.bar.baz.mozilla.org, check bar.baz.mozilla.org, baz.mozilla.org, mozilla.org, and .org
-    for i in range(1, levels):
-        domain = '.'.join(host[i:levels])
+        self.hits = 0
+        self.misses = 0
 
-        if hsts.get(domain, {}).get('pinned') is True and hsts.get(domain, {}).get('includeSubDomainsForPinning'):
-            return hsts[domain]
+        self._cache = OrderedDict()
+        self._lock = Lock()
 
-    return False
+        caches[name] = self
 
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = self.misses = 0
+
+    def get(self, key, func, *args):
+        """
+        :param key: hashable key that captures everything that func's result depends on
+        :param func: function to call on a miss
+        :param args: arguments to call func with
+        :return: a copy of func(*args), from the cache if possible
+        """
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+
+                return deepcopy(self._cache[key])
+
+            self.misses += 1
+
+        value = func(*args)
+
+        if self.max_size > 0:
+            with self._lock:
+                self._cache[key] = deepcopy(value)
+
+                while len(self._cache) > self.max_size:
+                    self._cache.popitem(last=False)
+
+        return value
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._cache),
+        }
+
+
+# Every AnalyzerCache in the process, by name
+caches = {}
+
+
+def cache_stats() -> dict:
+    """
+    :return: dictionary of cache name -> {hits, misses, size} for every analyzer cache in this process
+    """
+    return {name: cache.stats() for name, cache in sorted(caches.items())}
+
+
+# When this process last reported its cache stats
+__cache_stats_reported = monotonic()
+
+
+def report_cache_stats(interval: float=SCANNER_ANALYZER_CACHE_STATS_INTERVAL, file=None) -> bool:
+    """
+    Print the stats of every analyzer cache in this process to stderr, if it's been at least interval seconds since
+    they were last printed. The caches live in the scanner's worker processes, so this is how their hit rates can be
+    seen at all.
+
+    :param interval: how often to print them, in seconds; 0 to never print them
+    :param file: where to print them, if not stderr
+    :return: whether they were printed
+    """
+    global __cache_stats_reported
+
+    if not interval or monotonic() - __cache_stats_reported < interval:
+        return False
+
+    __cache_stats_reported = monotonic()
+
+    stats = ', '.join('{name} {hits} hits, {misses} misses, {size} cached'.format(name=name, **stats)
+                      for name, stats in cache_stats().items())
+
+    print('[{time}] INFO: Analyzer caches: {stats}.'.format(
+        time=str(datetime.datetime.now()).split('.')[0],
+        stats=stats or 'none'),
+        file=file or sys.stderr)
+
+    return True
+
+
+# Facts about a scan that more than one test needs, by name -> function(reqs) that derives the fact. Every scored
+# test is also a fact, namely its result with its default expectation.
+FACTS = {}
 
-def is_hsts_preloaded(hostname):
-    # Just see if the hostname is the HSTS list with the right mode -- no need to check includeSubDomains
-    if hsts.get(hostname, {}).get('mode') == 'force-https':
-        return hsts[hostname]
 
-    # Either the hostname is in the list *or* the TLD is and includeSubDomains is true
-    host = hostname.split('.')
-    levels = len(host)
+def fact(name: str):
+    """
+    Register a function as the way to derive a fact
 
-    # If hostname is foo.bar.baz.mozilla.org, check bar.baz.mozilla.org, baz.mozilla.org, mozilla.org, and .org
-    for i in range(1, levels):
-        domain = '.'.join(host[i:levels])
+    :param name: name of the fact, e.g. 'url'
+    :return: decorator
+    """
+    def decorator(func):
+        FACTS[name] = func
+        return func
 
-        if hsts.get(domain, {}).get('mode') == 'force-https' and hsts.get(domain, {}).get('includeSubDomains'):
-            return hsts[domain]
+    return decorator
+
+
+class Facts(dict):
+    """
+    The facts derived so far in a single run of the tests. Tests can run in separate threads, so each fact has its
+    own lock, and a test that needs a fact that another test is busy deriving waits for it instead of deriving it too.
+    """
+    def __init__(self):
+        super().__init__()
+
+        self._lock = Lock()
+        self._locks = {}
+
+    def derive(self, reqs: dict, name: str):
+        with self._lock:
+            lock = self._locks.setdefault(name, RLock())
+
+        with lock:
+            if name not in self:
+                self[name] = FACTS[name](reqs)
+
+        return self[name]
+
+
+def get_fact(reqs: dict, name: str):
+    """
+    :param reqs: dictionary containing all the request and response objects
+    :param name: name of the fact, e.g. 'url' or 'content-security-policy'
+    :return: the fact, derived only once per run_tests(); outside of that, it's derived every time, since the
+      retrievals could have changed in between
+    """
+    facts = reqs.get('facts')
+
+    if facts is None:
+        return FACTS[name](reqs)
+
+    return facts.derive(reqs, name)
+
+
+@fact('url')
+def __url(reqs: dict):
+    # The urlparsed final location of the page that gets tested
+    return urlparse(reqs['responses']['auto'].url)
+
+
+@fact('https-url')
+def __https_url(reqs: dict):
+    # The urlparsed final location of the HTTPS retrieval, if there was one
+    response = reqs['responses']['https']
+
+    return urlparse(response.url) if response is not None else None
+
+
+def get_document(reqs: dict, resource: str) -> Document:
+    """
+    :param reqs: dictionary containing all the request and response objects
+    :param resource: name of the resource, e.g. '__path__' or '/crossdomain.xml'
+    :return: the resource's shared Document, creating it if the retriever didn't (or the resource has since changed)
+    """
+    documents = reqs.setdefault('documents', {})
+    text = reqs['resources'].get(resource)
+
+    if resource not in documents or documents[resource].text is not text:
+        documents[resource] = Document(text)
+
+    return documents[resource]
+
+
+def is_hpkp_preloaded(hostname):
+    # Either the hostname is in the HSTS list and pinned, *or* one of its parent domains is, including its subdomains;
+    # if hostname is foo.bar.baz.mozilla.org, that's bar.baz.mozilla.org, baz.mozilla.org, mozilla.org, and org, all
+    # of which come out of a single walk of the list, longest first
+    for suffix, entry in hsts.suffixes(hostname):
+        if entry['pinned'] and (suffix == hostname or entry['includeSubDomainsForPinning']):
+            return entry
+
+    return False
+
+
+def is_hsts_preloaded(hostname):
+    # Either the hostname is in the HSTS list with the right mode -- no need to check includeSubDomains -- *or* one of
+    # its parent domains is, and includeSubDomains is true
+    for suffix, entry in hsts.suffixes(hostname):
+        if entry['mode'] == 'force-https' and (suffix == hostname or entry['includeSubDomains']):
+            return entry
 
     return False
 
@@ -60,4 +236,4 @@ def only_if_worse(new_result: str, old_result: str, order) -> str:
 
 # Let this file be run directly so you can see the JSON for the Google HSTS thingie
 if __name__ == '__main__':
-    print(hsts)
+    print(dict(hsts.items()))
@@ -0,0 +1,162 @@
+import json
+import os.path
+
+
+# The known CSP allowlist bypasses: URLs on popular hosts that serve AngularJS, Flash objects, or JSONP endpoints,
+# any of which lets an attacker run script on a page whose policy allows the host
+__dirname = os.path.abspath(os.path.dirname(__file__))
+BYPASSES_PATH = os.path.join(__dirname, '..', 'conf', 'bypasses')
+
+# The kinds of bypass, each of which is a file in BYPASSES_PATH
+ANGULAR = 'angular'
+FLASH = 'flash'
+JSONP = 'jsonp'
+KINDS = (ANGULAR, FLASH, JSONP)
+
+# JSONP bypasses on hosts that only serve code that needs eval() to do any harm
+_JSONP_NEEDS_EVAL = 'jsonp-needs-eval'
+
+
+class _Node:
+    # A path segment in a host's trie: the kinds of bypass at exactly this path, and anywhere below it
+    __slots__ = ('children', 'kinds', 'below')
+
+    def __init__(self):
+        self.children = {}
+        self.kinds = set()
+        self.below = set()
+
+
+def _split_source(source: str):
+    """
+    :param source: a CSP source expression, e.g. 'https://*.example.com:443/js/'
+    :return: (host, path), or None if the source isn't a host source
+    """
+    if source.startswith('\'') or source == '*':
+        return None
+
+    if '://' in source:
+        source = source.split('://', 1)[1]
+    elif source.startswith('//'):
+        source = source[2:]  # the bypasses are all scheme-relative
+    elif source.endswith(':'):
+        return None  # scheme sources, e.g. https:
+
+    host, slash, path = source.partition('/')
+    host = host.split(':', 1)[0]  # drop the port, which the bypasses don't care about
+    path = (slash + path).split('?', 1)[0].split('#', 1)[0]
+
+    return (host, path) if host else None
+
+
+def _segments(path: str) -> list:
+    # '' -> [], '/' -> [''], '/a/b' -> ['a', 'b'], '/a/' -> ['a', '']
+    return path.split('/')[1:]
+
+
+class BypassMatcher:
+    """
+    Every known bypass, compiled into a dictionary of hosts, each with a trie of its bypasses' path segments. Checking
+    a CSP source against all of them is then a dictionary lookup for its host and one more for each segment of its
+    path, rather than a comparison against every bypass there is.
+    """
+    def __init__(self, bypasses: dict, needs_eval=()):
+        """
+        :param bypasses: mapping of kind -> list of bypass URLs, e.g. {'jsonp': ['//example.com/api/jsonp']}
+        :param needs_eval: hosts whose JSONP bypasses only work if the policy also allows 'unsafe-eval'
+        """
+        self.hosts = {}       # host -> root of its trie
+        self.subdomains = {}  # domain -> every host with a bypass below it, for wildcard sources like *.example.com
+
+        for kind, urls in bypasses.items():
+            for url in urls:
+                host, path = _split_source(url.lower())
+                bypass = _JSONP_NEEDS_EVAL if kind == JSONP and host in needs_eval else kind
+
+                if host not in self.hosts:
+                    self.hosts[host] = _Node()
+
+                    labels = host.split('.')
+                    for i in range(1, len(labels)):
+                        self.subdomains.setdefault('.'.join(labels[i:]), []).append(host)
+
+                node = self.hosts[host]
+                for segment in _segments(path):
+                    node.below.add(bypass)
+                    node = node.children.setdefault(segment, _Node())
+                node.kinds.add(bypass)
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def __match_host(self, host: str, path: str) -> set:
+        node = self.hosts.get(host)
+        if node is None:
+            return set()
+
+        # No path allows everything on the host, a path ending in / allows itself and everything below it, and any
+        # other path allows only itself
+        if not path:
+            return node.kinds | node.below
+
+        segments = _segments(path)
+        prefix = segments[-1] == ''
+        for segment in segments[:-1] if prefix else segments:
+            node = node.children.get(segment)
+            if node is None:
+                return set()
+
+        return node.kinds | node.below if prefix else node.kinds
+
+    def match(self, source: str, unsafe_eval: bool=False) -> set:
+        """
+        :param source: a CSP source expression, in lower case as parsed by the CSP test
+        :param unsafe_eval: whether the policy allows 'unsafe-eval'
+        :return: the kinds of bypass that the source allows, if any
+        """
+        split = _split_source(source)
+        if split is None:
+            return set()
+
+        host, path = split
+        if host.startswith('*.'):
+            kinds = set()
+            for subdomain in self.subdomains.get(host[2:], ()):
+                kinds.update(self.__match_host(subdomain, path))
+        else:
+            kinds = set(self.__match_host(host, path))
+
+        if _JSONP_NEEDS_EVAL in kinds:
+            kinds.remove(_JSONP_NEEDS_EVAL)
+            if unsafe_eval:
+                kinds.add(JSONP)
+
+        return kinds
+
+    def bypassable(self, sources, kinds, unsafe_eval: bool=False) -> list:
+        """
+        :param sources: CSP source expressions, e.g. a policy's script-src
+        :param kinds: the kinds of bypass to look for
+        :param unsafe_eval: whether the policy allows 'unsafe-eval'
+        :return: the sources that allow any of those kinds of bypass, sorted
+        """
+        return sorted(source for source in sources if self.match(source, unsafe_eval=unsafe_eval).intersection(kinds))
+
+
+def load_bypasses(path: str=BYPASSES_PATH) -> BypassMatcher:
+    """
+    :param path: directory with a JSON file for each kind of bypass, each with a list of its 'urls', and optionally
+      the 'needsEval' hosts among them
+    :return: the compiled bypasses
+    """
+    bypasses = {}
+    needs_eval = set()
+
+    for kind in KINDS:
+        with open(os.path.join(path, kind + '.json'), 'r') as f:
+            data = json.load(f)
+
+        bypasses[kind] = data.get('urls', [])
+        needs_eval.update(host.lower() for host in data.get('needsEval', []))
+
+    return BypassMatcher(bypasses, needs_eval=needs_eval)
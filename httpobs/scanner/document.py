@@ -0,0 +1,203 @@
+from bs4 import BeautifulSoup as bs
+from html.parser import HTMLParser
+from threading import RLock
+
+from httpobs.conf import SCANNER_DOCUMENT_ENGINE
+
+try:
+    import lxml.etree
+except ImportError:  # pragma: no cover
+    lxml = None
+
+
+# The only elements that the analyzers ever look at, which are all that the streaming engines hang onto
+EXTRACTED_TAGS = frozenset(('allow-access-from',  # crossdomain.xml
+                            'domain',             # clientaccesspolicy.xml
+                            'meta',
+                            'script'))
+
+
+class Element:
+    """
+    An element pulled out of a document by one of the streaming engines: just its name and attributes, with the
+    same accessors as the BeautifulSoup tags that the analyzers were written against
+    """
+    __slots__ = ('name', 'attrs')
+
+    def __init__(self, name: str, attrs):
+        self.name = name
+
+        # Like BeautifulSoup, attributes without a value are empty strings, and the last duplicate attribute wins
+        self.attrs = {key: '' if value is None else value for key, value in attrs}
+
+    def __getitem__(self, key: str) -> str:
+        return self.attrs[key]
+
+    def __repr__(self):
+        return '<Element {name} {attrs}>'.format(name=self.name, attrs=self.attrs)
+
+    def get(self, key: str, default=None):
+        return self.attrs.get(key, default)
+
+    def has_attr(self, key: str) -> bool:
+        return key in self.attrs
+
+
+class _TagExtractor(HTMLParser):
+    # The same tokenizer that BeautifulSoup's html.parser builder uses, minus building the tree
+    def __init__(self, tags: frozenset):
+        super().__init__(convert_charrefs=True)
+        self.elements = []
+        self.tags = tags
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.tags:
+            self.elements.append(Element(tag, attrs))
+
+
+class _LxmlTarget:
+    # libxml2's HTML parser calls these as it goes, so lxml never builds a tree either
+    def __init__(self, tags: frozenset):
+        self.elements = []
+        self.tags = tags
+
+    def start(self, tag, attrib):
+        if tag in self.tags:
+            self.elements.append(Element(tag, attrib.items()))
+
+    def end(self, tag):
+        pass
+
+    def data(self, data):
+        pass
+
+    def comment(self, text):
+        pass
+
+    def close(self) -> list:
+        return self.elements
+
+
+def extract_html_parser(text: str, tags: frozenset=EXTRACTED_TAGS) -> list:
+    if not isinstance(text, str):
+        raise TypeError('document must be a string, not {type}'.format(type=type(text).__name__))
+
+    extractor = _TagExtractor(tags)
+    extractor.feed(text)
+    extractor.close()
+
+    return extractor.elements
+
+
+def extract_lxml(text: str, tags: frozenset=EXTRACTED_TAGS) -> list:
+    if not isinstance(text, str):
+        raise TypeError('document must be a string, not {type}'.format(type=type(text).__name__))
+    elif not text.strip():
+        return []  # libxml2 refuses to parse empty documents
+
+    # Feed it bytes, so that libxml2 doesn't choke on XML declarations with an encoding in them
+    parser = lxml.etree.HTMLParser(target=_LxmlTarget(tags), encoding='utf-8')
+    parser.feed(text.encode('utf-8'))
+
+    return parser.close()
+
+
+# The engines that stream the document instead of building a tree. html.parser extracts exactly what BeautifulSoup
+# would; lxml is several times faster still, but libxml2 recovers from markup differently (the first duplicate
+# attribute wins, <title> and <textarea> contents are text, and it never gives up on a document), so it can
+# occasionally change test results, and isn't the default.
+ENGINES = {
+    'html.parser': extract_html_parser,
+    'lxml': extract_lxml if lxml is not None else None,
+}
+
+
+class Document:
+    """
+    A resource's text, parsed at most once no matter how many analyzers look at it. Nothing is parsed until the
+    first time the document is actually used, and the first use also indexes every element by its tag name, so that
+    looking up all the <meta> or <script> tags doesn't walk the whole tree again.
+
+    By default, rather than building a full BeautifulSoup tree, the document is streamed through one of the
+    ENGINES, which only keeps the EXTRACTED_TAGS. Asking for any other tag streams the document again for it, and
+    the full tree is still available as .soup for anything that really needs it.
+
+    A document is shared by every test in a scan, which can run in different threads (see iter_tests()), so parsing
+    and indexing it happen under a lock.
+    """
+    def __init__(self, text: str, parser: str='html.parser', engine: str=None):
+        self.text = text
+        self.parser = parser
+        self.engine = engine or SCANNER_DOCUMENT_ENGINE
+
+        if self.engine != 'bs4' and ENGINES.get(self.engine) is None:
+            raise ValueError('unknown or unavailable document engine: {engine}'.format(engine=self.engine))
+
+        self._error = None
+        self._index = None
+        self._lock = RLock()
+        self._soup = None
+
+    def __parse(self):
+        if self._soup is None and self._error is None:
+            try:
+                self._soup = bs(self.text, self.parser)
+            except Exception as e:
+                self._error = e
+
+        # Every attempt to use an unparsable document fails the same way
+        if self._error is not None:
+            raise self._error
+
+    def __index(self, tags: frozenset):
+        if self._error is None:
+            try:
+                if self.engine == 'bs4':
+                    self.__parse()
+                    elements = self._soup.find_all(True)
+                    tags = frozenset(element.name for element in elements)
+                else:
+                    elements = ENGINES[self.engine](self.text, tags)
+
+                self._index = self._index or {}
+                for tag in tags:
+                    self._index.setdefault(tag, [])
+                for element in elements:
+                    self._index[element.name].append(element)
+            except Exception as e:
+                self._error = e
+
+        if self._error is not None:
+            raise self._error
+
+    @property
+    def soup(self) -> bs:
+        with self._lock:
+            self.__parse()
+            return self._soup
+
+    def find_all(self, name: str) -> list:
+        """
+        :param name: tag name to look for, in lower case
+        :return: every element with that tag name, in document order
+        """
+        with self._lock:
+            if self._index is None:
+                self.__index(EXTRACTED_TAGS)
+
+            if name not in self._index:
+                # The bs4 engine indexes everything in one go, so if it isn't there, it isn't in the document
+                if self.engine == 'bs4':
+                    return []
+
+                self.__index(frozenset((name,)))
+
+            return self._index[name]
+
+    @property
+    def metas(self) -> list:
+        return self.find_all('meta')
+
+    @property
+    def scripts(self) -> list:
+        return self.find_all('script')
@@ -1,11 +1,13 @@
-from .grade import (get_score_description,
+from .grade import (get_curved_score,
+                    get_score_description,
                     get_score_modifier,
                     get_grade_and_likelihood_for_score,
                     GRADES,
                     MINIMUM_SCORE_FOR_EXTRA_CREDIT)
 
 
-__all__ = ['get_score_description',
+__all__ = ['get_curved_score',
+           'get_score_description',
            'get_score_modifier',
            'get_grade_and_likelihood_for_score',
            'GRADES',
@@ -387,6 +387,20 @@ SCORE_TABLE = {
 }
 
 
+def get_curved_score(score_modifiers) -> int:
+    """
+    :param score_modifiers: the score_modifier of each test
+    :return: raw score based on all of the tests, only including any extra credit if the site would get an A without it
+    """
+    score_modifiers = list(score_modifiers)
+
+    score_with_extra_credit = 100 + sum(score_modifiers)
+    uncurved_score = 100 + sum(modifier for modifier in score_modifiers if modifier < 0)
+
+    # Only record the full score if the uncurved score already receives an A
+    return score_with_extra_credit if uncurved_score >= MINIMUM_SCORE_FOR_EXTRA_CREDIT else uncurved_score
+
+
 def get_grade_and_likelihood_for_score(score: int) -> tuple:
     """
     :param score: raw score based on all of the tests
@@ -1,7 +1,6 @@
 import httpobs.conf
 
-from httpobs.scanner.analyzer import NUM_TESTS, tests
-from httpobs.scanner.grader import get_grade_and_likelihood_for_score, get_score_description
+from httpobs.scanner.analyzer import analyze
 from httpobs.scanner.retriever import retrieve_all
 
 
@@ -48,29 +47,5 @@ def scan(hostname, **kwargs):
     # Attempt to retrieve all the resources, not capturing exceptions
     reqs = retrieve_all(hostname, **kwargs)
 
-    # If we can't connect at all, let's abort the test
-    if reqs['responses']['auto'] is None:
-        return {'error': 'site down'}
-
-    # Get all the results
-    results = [test(reqs) for test in tests]
-    for result in results:
-        result['score_description'] = get_score_description(result['result'])
-
-    # Get the score, grade, etc.
-    grades = get_grade_and_likelihood_for_score(100 + sum([result.get('score_modifier', 0) for result in results]))
-    tests_passed = sum([1 if result.get('pass') else 0 for result in results])
-
-    # Return the results
-    return({
-        'scan': {
-            'grade': grades[1],
-            'likelihood_indicator': grades[2],
-            'response_headers': dict(reqs['responses']['auto'].headers),
-            'score': grades[0],
-            'tests_failed': NUM_TESTS - tests_passed,
-            'tests_passed': tests_passed,
-            'tests_quantity': NUM_TESTS,
-        },
-        'tests': {result.pop('name'): result for result in results}
-    })
+    # Run all the tests, and grade the results
+    return analyze(reqs)
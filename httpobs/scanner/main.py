@@ -8,10 +8,14 @@ from httpobs.conf import (BROKER_URL,
                           SCANNER_BROKER_RECONNECTION_SLEEP_TIME,
                           SCANNER_CYCLE_SLEEP_TIME,
                           SCANNER_DATABASE_RECONNECTION_SLEEP_TIME,
+                          SCANNER_DEQUEUE_LISTEN,
+                          SCANNER_DEQUEUE_LISTEN_TIMEOUT,
                           SCANNER_MAINTENANCE_CYCLE_FREQUENCY,
                           SCANNER_MAX_CPU_UTILIZATION,
                           SCANNER_MAX_LOAD)
-from httpobs.database import (periodic_maintenance,
+from httpobs.database import (maintain_scan_partitions,
+                              periodic_maintenance,
+                              PendingScansListener,
                               update_scans_dequeue_scans)
 from httpobs.scanner.tasks import scan
 
@@ -33,6 +37,9 @@ def main():
         print('Sorry, the scanner currently only supports redis.', file=sys.stderr)
         sys.exit(1)
 
+    # Rather than polling for new scans when the queue is empty, wait to hear about them
+    listener = PendingScansListener(SCANNER_CYCLE_SLEEP_TIME) if SCANNER_DEQUEUE_LISTEN else None
+
     # Get the current CPU utilization and wait a second to begin the loop for the next reading
     psutil.cpu_percent()
     sleep(1)
@@ -62,7 +69,6 @@ def main():
             continue
 
         # Every so many scans, let's opportunistically clear out any PENDING scans that are older than 1800 seconds
-        # Also update the grade_distribution table
         # If it fails, we don't care. Of course, nobody reads the comments, so I should say that *I* don't care.
         try:
             if dequeue_loop_count % SCANNER_MAINTENANCE_CYCLE_FREQUENCY == 0:
@@ -73,6 +79,21 @@ def main():
                 dequeue_loop_count = 0
                 num = periodic_maintenance()
 
+                # Make room for the scans to come, and retire the oldest ones if there's a retention policy
+                try:
+                    partitions = maintain_scan_partitions()
+
+                    if partitions['archived'] or partitions['dropped']:
+                        print('[{time}] INFO: Archived {archived} and dropped {dropped} old partition(s).'.format(
+                            time=str(datetime.datetime.now()).split('.')[0],
+                            archived=partitions['archived'],
+                            dropped=partitions['dropped']),
+                            file=sys.stderr)
+                except IOError:
+                    print('[{time}] WARNING: Unable to maintain the scan partitions.'.format(
+                        time=str(datetime.datetime.now()).split('.')[0]),
+                        file=sys.stderr)
+
             if num > 0:
                 print('[{time}] INFO: Cleared {num} broken scan(s).'.format(
                     time=str(datetime.datetime.now()).split('.')[0],
@@ -146,7 +167,9 @@ def main():
 
                 # Always sleep at least some amount of time so that CPU utilization measurements can track
                 sleep(SCANNER_CYCLE_SLEEP_TIME / 2)
-            else:  # If the queue was empty, lets sleep a little bit
+            elif listener is not None:  # If the queue was empty, wait until something is added to it
+                listener.wait(SCANNER_DEQUEUE_LISTEN_TIMEOUT)
+            else:  # or just sleep a little bit
                 sleep(SCANNER_CYCLE_SLEEP_TIME)
         except:  # this shouldn't trigger, but we don't want a scan breakage to kill the scanner
             print('[{time}] ERROR: Unknown celery error.'.format(
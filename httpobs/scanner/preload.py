@@ -0,0 +1,607 @@
+from base64 import b64decode
+from bisect import bisect_right
+from time import monotonic
+
+import codecs
+import io
+import json
+import mmap
+import os
+import os.path
+import re
+import struct
+import tempfile
+
+
+# The preload list, as regenerated by retrieve_store_hsts_preload_list(), and its compact index
+__dirname = os.path.abspath(os.path.dirname(__file__))
+HSTS_PRELOAD_PATH = os.path.join(__dirname, '..', 'conf', 'hsts-preload.json')
+HSTS_PRELOAD_INDEX_PATH = os.path.join(__dirname, '..', 'conf', 'hsts-preload.idx')
+
+# How often running processes look to see if the preload list has been regenerated, in seconds
+RELOAD_INTERVAL = 5
+
+# Where the list of entries starts in Chromium's transport_security_state_static.json
+ENTRIES = re.compile(r'"entries"\s*:\s*\[')
+
+
+# The compact preload index is a sorted array of hostnames, so that a lookup is a binary search over a file that
+# every process can map into memory and share, instead of a dictionary of ~100k dictionaries in each one. Each
+# hostname is stored with its labels reversed and a trailing dot (mozilla.org is org.mozilla.), so that the entries
+# that cover a hostname -- the hostname itself, and each of its parent domains -- are all prefixes of its key:
+#
+#   header:  magic, number of entries, length of the mode table
+#   modes:   JSON list of every distinct mode in the list (in practice, just force-https)
+#   entries: for each entry, in the same order as the keys, its flags, the length of its key, and the position of
+#            its parent: the longest other entry whose key is a prefix of its own, if there is one
+#   fences:  one unsigned int for every INDEX_FENCE entries, plus one, where each block of keys starts relative to
+#            the first one
+#   keys:    each entry's key (UTF-8) followed by a newline, sorted
+#
+# A lookup bisects the first key of each block, which is kept in memory, and then a single block of keys from the
+# file, to find the last entry that sorts no later than the hostname's key. Every entry that covers the hostname
+# sorts in between the two, so is either that entry or one of its parents: the rest of the lookup is following the
+# parents, without searching again.
+INDEX_MAGIC = b'HTTPOBS\x02'
+INDEX_HEADER = struct.Struct('>8sII')
+INDEX_ENTRY = struct.Struct('>BBI')
+INDEX_OFFSET = struct.Struct('>I')
+INDEX_FENCE = 16
+INDEX_NO_PARENT = 0xFFFFFFFF
+
+# The low bits of each entry's flags; the rest of it is its position in the mode table, plus one (zero is None)
+INCLUDE_SUBDOMAINS = 0x01
+INCLUDE_SUBDOMAINS_FOR_PINNING = 0x02
+PINNED = 0x04
+MODE_SHIFT = 3
+
+
+class PreloadIndexError(Exception):
+    pass
+
+
+def preload_index_key(hostname: str) -> bytes:
+    """
+    :param hostname: hostname, e.g. 'bugzilla.mozilla.org'
+    :return: its key in the compact index, e.g. b'org.mozilla.bugzilla.'
+    """
+    return ('.'.join(hostname.split('.')[::-1]) + '.').encode('utf-8')
+
+
+def preload_index_hostname(key: bytes) -> str:
+    """
+    :param key: key in the compact index, e.g. b'org.mozilla.bugzilla.'
+    :return: the hostname it's the key of, e.g. 'bugzilla.mozilla.org'
+    """
+    return '.'.join(key[:-1].decode('utf-8').split('.')[::-1])
+
+
+def preload_record(hostname: str, entry: dict) -> tuple:
+    """
+    :param hostname: hostname, e.g. 'bugzilla.mozilla.org'
+    :param entry: its {includeSubDomains, includeSubDomainsForPinning, mode, pinned} dictionary
+    :return: (key, flags, mode), which is how the compact index stores it; flags are just the low bits
+    """
+    return (preload_index_key(hostname),
+            (INCLUDE_SUBDOMAINS if entry.get('includeSubDomains') else 0) |
+            (INCLUDE_SUBDOMAINS_FOR_PINNING if entry.get('includeSubDomainsForPinning') else 0) |
+            (PINNED if entry.get('pinned') else 0),
+            entry.get('mode'))
+
+
+def preload_entry(flags: int, mode) -> dict:
+    """
+    :param flags: the low bits of an entry's flags
+    :param mode: its mode, e.g. 'force-https', or None
+    :return: its {includeSubDomains, includeSubDomainsForPinning, mode, pinned} dictionary
+    """
+    return {
+        'includeSubDomains': bool(flags & INCLUDE_SUBDOMAINS),
+        'includeSubDomainsForPinning': bool(flags & INCLUDE_SUBDOMAINS_FOR_PINNING),
+        'mode': mode,
+        'pinned': bool(flags & PINNED),
+    }
+
+
+def preload_records(entries) -> list:
+    """
+    :param entries: mapping of hostname -> entry, or iterable of (hostname, entry) where later entries for the same
+      hostname replace earlier ones
+    :return: the entries as sorted, unique records (see preload_record()), which are far smaller than the dictionaries
+    """
+    records = sorted((preload_record(hostname, entry) for hostname, entry in
+                      (entries.items() if isinstance(entries, dict) else entries)), key=lambda record: record[0])
+
+    # The sort is stable, so the last of any duplicates is the one that came last
+    return [record for i, record in enumerate(records) if i + 1 == len(records) or records[i + 1][0] != record[0]]
+
+
+def write_preload_records(records: list, f):
+    """
+    Write the compact index of records to f, one key at a time; the entry table and fences are filled in afterwards
+
+    :param records: sorted, unique records, as returned by preload_records()
+    :param f: seekable binary file to write the index to
+    :return: None
+    """
+    modes = sorted({mode for _, _, mode in records if mode is not None})
+    if len(modes) >= 1 << (8 - MODE_SHIFT):
+        raise PreloadIndexError('too many distinct modes in the preload list')
+
+    positions = {mode: i + 1 for i, mode in enumerate(modes)}
+    modes = json.dumps(modes).encode('utf-8')
+
+    start = f.tell()
+    entries = start + INDEX_HEADER.size + len(modes)
+    keys = entries + len(records) * INDEX_ENTRY.size + (-(-len(records) // INDEX_FENCE) + 1) * INDEX_OFFSET.size
+
+    table = bytearray()
+    fences = []
+    written = 0
+    parents = []  # the entries whose keys are prefixes of the current key, longest last
+
+    f.seek(keys)
+    for i, (key, flags, mode) in enumerate(records):
+        if len(key) > 0xFF:
+            raise PreloadIndexError('hostname is too long: ' + preload_index_hostname(key))
+
+        while parents and not key.startswith(records[parents[-1]][0]):
+            parents.pop()
+
+        table += INDEX_ENTRY.pack(flags | (positions[mode] << MODE_SHIFT if mode is not None else 0),
+                                  len(key),
+                                  parents[-1] if parents else INDEX_NO_PARENT)
+        parents.append(i)
+
+        if i % INDEX_FENCE == 0:
+            fences.append(written)
+        f.write(key + b'\n')
+        written += len(key) + 1
+    fences.append(written)
+
+    f.seek(start)
+    f.write(INDEX_HEADER.pack(INDEX_MAGIC, len(records), len(modes)))
+    f.write(modes)
+    f.write(table)
+    f.write(b''.join(INDEX_OFFSET.pack(fence) for fence in fences))
+    f.seek(0, os.SEEK_END)
+
+
+def encode_preload_index(entries: dict) -> bytes:
+    """
+    :param entries: mapping of hostname -> {includeSubDomains, includeSubDomainsForPinning, mode, pinned}, as stored
+      in hsts-preload.json
+    :return: the compact index of those entries
+    """
+    f = io.BytesIO()
+    write_preload_records(preload_records(entries), f)
+
+    return f.getvalue()
+
+
+def write_preload_json(records: list, f):
+    """
+    Write records to f as hsts-preload.json, one entry at a time, in the same order as the index
+
+    :param records: sorted, unique records, as returned by preload_records()
+    :param f: binary file to write the list to
+    :return: None
+    """
+    f.write(b'{')
+    for i, (key, flags, mode) in enumerate(records):
+        f.write('{comma}\n  {hostname}: {entry}'.format(comma=',' if i else '',
+                                                        hostname=json.dumps(preload_index_hostname(key)),
+                                                        entry=json.dumps(preload_entry(flags, mode),
+                                                                         sort_keys=True)).encode('utf-8'))
+    f.write(b'\n}\n')
+
+
+def __write_atomically(path: str, write):
+    # Readers either see the old file or the new one, never half of one
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def write_preload_index(entries: dict, path: str):
+    """
+    Write the compact index of entries to path, atomically, so that nothing ever maps a half-written index
+
+    :param entries: mapping of hostname -> entry, as stored in hsts-preload.json
+    :param path: where to write the index
+    :return: None
+    """
+    records = preload_records(entries)
+    __write_atomically(path, lambda f: write_preload_records(records, f))
+
+
+class PreloadIndex:
+    """
+    Read-only view of a compact preload index, either memory-mapped from a file or held in memory. Lookups return
+    the same dictionaries that hsts-preload.json contains.
+    """
+    def __init__(self, buffer):
+        self._buffer = buffer
+
+        try:
+            magic, self._count, modes_length = INDEX_HEADER.unpack_from(buffer, 0)
+        except struct.error:
+            raise PreloadIndexError('preload index is truncated')
+
+        if magic != INDEX_MAGIC:
+            raise PreloadIndexError('not a preload index')
+
+        self._modes = json.loads(bytes(buffer[INDEX_HEADER.size:INDEX_HEADER.size + modes_length]).decode('utf-8'))
+        self._entries = INDEX_HEADER.size + modes_length
+        self._blocks = -(-self._count // INDEX_FENCE)
+
+        fences = self._entries + self._count * INDEX_ENTRY.size
+        self._records = fences + (self._blocks + 1) * INDEX_OFFSET.size
+
+        try:
+            self._offsets = [INDEX_OFFSET.unpack_from(buffer, fences + i * INDEX_OFFSET.size)[0]
+                             for i in range(self._blocks + 1)]
+        except struct.error:
+            raise PreloadIndexError('preload index is truncated')
+
+        if self._offsets[-1] + self._records != len(buffer):
+            raise PreloadIndexError('preload index is truncated')
+
+        # The first key of every block
+        self._fences = [self.__block(i)[0] for i in range(self._blocks)]
+
+    @classmethod
+    def open(cls, path: str):
+        """
+        :param path: path to an index written by write_preload_index()
+        :return: the index, memory-mapped so that its pages are shared by every process that opens it
+        """
+        with open(path, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __block(self, i: int) -> list:
+        # The keys in the i'th block
+        return self._buffer[self._records + self._offsets[i]:self._records + self._offsets[i + 1] - 1].split(b'\n')
+
+    def __find(self, key: bytes) -> tuple:
+        # The position and key of the last entry that sorts no later than key, or (-1, None) if there isn't one
+        block = bisect_right(self._fences, key) - 1
+        if block < 0:
+            return -1, None
+
+        keys = self.__block(block)
+        i = bisect_right(keys, key) - 1
+
+        return block * INDEX_FENCE + i, keys[i]
+
+    def __mode(self, flags: int):
+        return self._modes[(flags >> MODE_SHIFT) - 1] if flags >> MODE_SHIFT else None
+
+    def __entry(self, flags: int) -> dict:
+        return preload_entry(flags, self.__mode(flags))
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, hostname: str) -> bool:
+        return self.get(hostname) is not None
+
+    def close(self):
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+
+    def get(self, hostname: str, default=None):
+        """
+        :param hostname: hostname to look up, exactly as it appears in the preload list
+        :return: its {includeSubDomains, includeSubDomainsForPinning, mode, pinned} dictionary, otherwise default
+        """
+        key = preload_index_key(hostname)
+        i, found = self.__find(key)
+
+        if found != key:
+            return default
+
+        return self.__entry(INDEX_ENTRY.unpack_from(self._buffer, self._entries + i * INDEX_ENTRY.size)[0])
+
+    def suffixes(self, hostname: str):
+        """
+        :param hostname: hostname to look up, e.g. foo.bugzilla.mozilla.org
+        :return: generator of (hostname, entry) for every entry in the list that is either the hostname or one of its
+          parent domains, longest first, e.g. bugzilla.mozilla.org and then mozilla.org
+        """
+        key = preload_index_key(hostname)
+        plain = len(key) == len(hostname) + 1  # i.e. ASCII, so the key and the hostname are the same length
+        i, found = self.__find(key)
+
+        # Every parent's key is the start of the found entry's key
+        while i != -1 and i != INDEX_NO_PARENT:
+            flags, length, i = INDEX_ENTRY.unpack_from(self._buffer, self._entries + i * INDEX_ENTRY.size)
+
+            if key.startswith(found[:length]):
+                yield (hostname[len(hostname) + 1 - length:] if plain else preload_index_hostname(found[:length]),
+                       self.__entry(flags))
+
+    def records(self):
+        """
+        :return: generator of every entry's (key, flags, mode) record (see preload_record()), in the index's order
+        """
+        for block in range(self._blocks):
+            for i, key in enumerate(self.__block(block)):
+                flags = INDEX_ENTRY.unpack_from(self._buffer,
+                                                self._entries + (block * INDEX_FENCE + i) * INDEX_ENTRY.size)[0]
+                yield key, flags & ((1 << MODE_SHIFT) - 1), self.__mode(flags)
+
+    def items(self):
+        for key, flags, mode in self.records():
+            yield preload_index_hostname(key), preload_entry(flags, mode)
+
+
+def load_preload_index(json_path: str, index_path: str) -> PreloadIndex:
+    """
+    Open the compact index next to the preload list, (re)building it first if it's missing or older than the list.
+    If the index can't be written (say, a read-only install), it's built in memory instead.
+
+    :param json_path: path to hsts-preload.json
+    :param index_path: path to its compact index
+    :return: the index
+    """
+    try:
+        if os.path.getmtime(index_path) >= os.path.getmtime(json_path):
+            return PreloadIndex.open(index_path)
+    except (OSError, PreloadIndexError):
+        pass
+
+    with open(json_path, 'r') as f:
+        entries = json.load(f)
+
+    try:
+        write_preload_index(entries, index_path)
+        return PreloadIndex.open(index_path)
+    except OSError:
+        return PreloadIndex(encode_preload_index(entries))
+
+
+class PreloadList:
+    """
+    The compact index of the preload list, which gets swapped out for the new one whenever the list is regenerated,
+    so that running workers pick up the new list without being restarted. Lookups that are already underway finish
+    against the old index.
+    """
+    def __init__(self, json_path: str=HSTS_PRELOAD_PATH, index_path: str=HSTS_PRELOAD_INDEX_PATH,
+                 interval: float=RELOAD_INTERVAL):
+        self.json_path = json_path
+        self.index_path = index_path
+        self.interval = interval
+
+        self._index = None
+        self._next_check = 0
+        self._version = None
+
+    def __version(self) -> tuple:
+        # The regeneration replaces both files rather than writing over them, so a new inode means a new list
+        versions = []
+        for path in (self.json_path, self.index_path):
+            try:
+                stat = os.stat(path)
+                versions.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                versions.append(None)
+
+        return tuple(versions)
+
+    @property
+    def index(self) -> PreloadIndex:
+        if self._index is None or monotonic() >= self._next_check:
+            self._next_check = monotonic() + self.interval
+            version = self.__version()
+
+            if self._index is None or version != self._version:
+                self._index = load_preload_index(self.json_path, self.index_path)
+                self._version = self.__version()  # loading it may well have (re)written the index
+
+        return self._index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, hostname: str) -> bool:
+        return hostname in self.index
+
+    def get(self, hostname: str, default=None):
+        return self.index.get(hostname, default)
+
+    def suffixes(self, hostname: str):
+        return self.index.suffixes(hostname)
+
+    def items(self):
+        return self.index.items()
+
+
+def decode_base64_chunks(chunks):
+    """
+    :param chunks: iterable of base64-encoded bytes, split up anywhere
+    :return: generator of the decoded bytes
+    """
+    pending = b''
+
+    for chunk in chunks:
+        pending += b''.join(chunk.split())
+
+        # Base64 decodes in groups of four characters, so anything past the last whole group waits for the next chunk
+        usable = len(pending) - len(pending) % 4
+        if usable:
+            yield b64decode(pending[:usable], validate=True)
+            pending = pending[usable:]
+
+    if pending:
+        yield b64decode(pending, validate=True)
+
+
+def strip_comments(chunks):
+    """
+    :param chunks: iterable of Chromium's JSON-with-comments text, split up anywhere
+    :return: generator of the same text, a line at a time, with the comments removed
+    """
+    pending = ''
+
+    for chunk in chunks:
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+
+        for line in lines:
+            if line.strip() != '//':
+                yield line.split('// ')[0] + '\n'
+
+    if pending.strip() != '//':
+        yield pending.split('// ')[0]
+
+
+def iter_preload_entries(chunks):
+    """
+    Parse the entries out of Chromium's transport_security_state_static.json one at a time, without ever holding
+    the whole thing in memory
+
+    :param chunks: iterable of the list's text (with the comments removed), split up anywhere
+    :return: generator of the raw entries, as dictionaries
+    """
+    chunks = iter(chunks)
+    decoder = json.JSONDecoder()
+    buffer = ''
+
+    # Skip over the pinsets and everything else up to the entries
+    while True:
+        match = ENTRIES.search(buffer)
+        if match:
+            buffer = buffer[match.end():]
+            break
+
+        # No need to hang onto anything that can't be the start of the entries
+        start = buffer.find('"entries"')
+        buffer = buffer[start:] if start != -1 else buffer[-len('"entries"'):]
+
+        try:
+            buffer += next(chunks)
+        except StopIteration:
+            raise ValueError('no entries in the preload list')
+
+    position = 0
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+
+        if buffer[position:position + 1] == ']':
+            return
+
+        # An entry that doesn't decode is most likely just cut off at the end of the buffer
+        if position < len(buffer):
+            try:
+                entry, position = decoder.raw_decode(buffer, position)
+                yield entry
+                continue
+            except ValueError:
+                pass
+
+        try:
+            buffer = buffer[position:] + next(chunks)
+            position = 0
+        except StopIteration:
+            decoder.raw_decode(buffer, position)  # raises whatever is actually wrong with it
+            raise ValueError('preload list is truncated')
+
+
+def iter_hsts_preload_list(chunks):
+    """
+    :param chunks: iterable of the base64-encoded bytes of transport_security_state_static.json, as served by
+      googlesource.com
+    :return: generator of (hostname, {includeSubDomains, includeSubDomainsForPinning, mode, pinned}), as the list
+      comes in
+    """
+    text = codecs.iterdecode(decode_base64_chunks(chunks), 'utf-8')
+
+    for site in iter_preload_entries(strip_comments(text)):
+        yield site['name'], {
+            'includeSubDomains': site.get('include_subdomains', False),
+            'includeSubDomainsForPinning':
+                site.get('include_subdomains', False) or site.get('include_subdomains_for_pinning', False),
+            'mode': site.get('mode'),
+            'pinned': True if 'pins' in site else False,
+        }
+
+
+def parse_hsts_preload_list(chunks) -> dict:
+    """
+    :param chunks: iterable of the base64-encoded bytes of transport_security_state_static.json, as served by
+      googlesource.com
+    :return: mapping of hostname -> {includeSubDomains, includeSubDomainsForPinning, mode, pinned}
+    """
+    return dict(iter_hsts_preload_list(chunks))
+
+
+def diff_preload_records(previous, records: list) -> tuple:
+    """
+    :param previous: iterable of the previous list's records, sorted
+    :param records: the new list's records, sorted
+    :return: (added, removed, changed) hostnames, each sorted
+    """
+    added, removed, changed = [], [], []
+    previous = iter(previous)
+    old = next(previous, None)
+
+    # Both are in the same order, so a single pass over each finds every difference
+    for record in records:
+        while old is not None and old[0] < record[0]:
+            removed.append(preload_index_hostname(old[0]))
+            old = next(previous, None)
+
+        if old is not None and old[0] == record[0]:
+            if old != record:
+                changed.append(preload_index_hostname(record[0]))
+            old = next(previous, None)
+        else:
+            added.append(preload_index_hostname(record[0]))
+
+    while old is not None:
+        removed.append(preload_index_hostname(old[0]))
+        old = next(previous, None)
+
+    return sorted(added), sorted(removed), sorted(changed)
+
+
+def store_preload_list(entries, json_path: str=HSTS_PRELOAD_PATH, index_path: str=HSTS_PRELOAD_INDEX_PATH) -> tuple:
+    """
+    Replace the preload list and its compact index with entries, but only if they've actually changed. Both files
+    are replaced atomically, the list first, so running workers (see PreloadList) only ever see a complete index.
+
+    The entries are kept as compact records rather than dictionaries, compared against the previous index as it's
+    read, and written out one at a time, so neither list is ever held in memory as hsts-preload.json's dictionaries.
+
+    :param entries: mapping of hostname -> entry, or iterable of (hostname, entry), as returned by
+      iter_hsts_preload_list(); later entries for the same hostname replace earlier ones
+    :param json_path: path to hsts-preload.json
+    :param index_path: path to its compact index
+    :return: (added, removed, changed) hostnames, compared to the previous list
+    """
+    records = preload_records(entries)
+
+    try:
+        previous = load_preload_index(json_path, index_path)
+    except (OSError, ValueError, PreloadIndexError):
+        previous = PreloadIndex(encode_preload_index({}))
+
+    try:
+        added, removed, changed = diff_preload_records(previous.records(), records)
+    finally:
+        previous.close()
+
+    if added or removed or changed or not os.path.exists(json_path):
+        __write_atomically(json_path, lambda f: write_preload_json(records, f))
+        __write_atomically(index_path, lambda f: write_preload_records(records, f))
+
+    return added, removed, changed
@@ -1,3 +1,5 @@
-from .retriever import retrieve_all
+from .capture import dump_retrievals, encode_retrievals, iter_retrievals, load_retrievals, open_capture
+from .retriever import retrieve_all, retrieve_all_async, retrieve_many
 
-__all__ = ['retrieve_all']
+__all__ = ['dump_retrievals', 'encode_retrievals', 'iter_retrievals', 'load_retrievals', 'open_capture',
+           'retrieve_all', 'retrieve_all_async', 'retrieve_many']
@@ -0,0 +1,222 @@
+from http.cookiejar import Cookie
+from requests.cookies import RequestsCookieJar
+from requests.models import PreparedRequest
+from requests.structures import CaseInsensitiveDict
+from urllib.parse import urlparse
+
+import gzip
+import json
+import requests
+import struct
+
+
+# Bump this whenever the layout of a capture changes in a way that older loaders can't read
+CAPTURE_VERSION = 1
+
+# Every capture record starts with the length of its metadata, followed by the metadata (JSON) and the bodies
+HEADER = struct.Struct('>I')
+
+# The cookie attributes that need to survive the round trip, in the order that http.cookiejar.Cookie takes them
+COOKIE_ATTRIBUTES = ('version', 'name', 'value', 'port', 'port_specified', 'domain', 'domain_specified',
+                     'domain_initial_dot', 'path', 'path_specified', 'secure', 'expires', 'discard', 'comment',
+                     'comment_url', 'rest', 'rfc2109')
+
+
+class CaptureError(Exception):
+    pass
+
+
+def open_capture(path: str, mode: str='rb'):
+    """
+    Open a capture file, which is a gzipped stream of capture records, one per retrieval
+
+    :param path: path to the capture file
+    :param mode: 'rb' to read, 'wb' to write, 'ab' to append
+    :return: file object to hand to dump_retrievals() and load_retrievals()
+    """
+    return gzip.open(path, mode)
+
+
+def __dump_response(response: requests.Response, bodies: list) -> dict:
+    # Responses whose bodies were never read (or were thrown away) are stored as empty
+    bodies.append(response._content if isinstance(getattr(response, '_content', None), bytes) else b'')
+
+    return {
+        'encoding': response.encoding,
+        'headers': list(response.headers.items()),
+        'history': [__dump_response(r, bodies) for r in response.history],
+        'http_equiv': list(response.http_equiv.items()) if hasattr(response, 'http_equiv') else None,
+        'reason': response.reason,
+        'request': {
+            'headers': list(response.request.headers.items()),
+            'method': response.request.method,
+            'url': response.request.url,
+        } if response.request is not None else None,
+        'status_code': response.status_code,
+        'truncated': getattr(response, 'truncated', False),
+        'url': response.url,
+        'verified': getattr(response, 'verified', None),
+    }
+
+
+def __load_response(data: dict, bodies: list) -> requests.Response:
+    response = requests.Response()
+
+    response._content = bodies.pop(0)
+    response._content_consumed = True
+    response.encoding = data['encoding']
+    response.headers = CaseInsensitiveDict(data['headers'])
+    response.history = [__load_response(r, bodies) for r in data['history']]
+    response.reason = data['reason']
+    response.status_code = data['status_code']
+    response.truncated = data['truncated']
+    response.url = data['url']
+
+    if data['http_equiv'] is not None:
+        response.http_equiv = CaseInsensitiveDict(data['http_equiv'])
+    if data['verified'] is not None:
+        response.verified = data['verified']
+
+    if data['request'] is not None:
+        response.request = PreparedRequest()
+        response.request.headers = CaseInsensitiveDict(data['request']['headers'])
+        response.request.method = data['request']['method']
+        response.request.url = data['request']['url']
+
+    return response
+
+
+def encode_retrievals(retrievals: dict) -> bytes:
+    """
+    :param retrievals: the dictionary returned by retrieve_all()
+    :return: the capture record of everything in it, as written by dump_retrievals()
+    """
+    bodies = []
+
+    # The same response is often stored under more than one name (auto is always http or https), so each one is
+    # only stored once and referred to by its position
+    responses = []
+    names = {}
+    for name, response in retrievals['responses'].items():
+        if response is None:
+            names[name] = None
+            continue
+
+        for index, stored in enumerate(responses):
+            if stored is response:
+                names[name] = index
+                break
+        else:
+            names[name] = len(responses)
+            responses.append(response)
+
+    session = retrievals['session']
+    resources = sorted(retrievals['resources'].items())
+
+    metadata = {
+        'hostname': retrievals['hostname'],
+        'resources': [(name, text is not None) for name, text in resources],
+        'responses': [__dump_response(response, bodies) for response in responses],
+        'names': names,
+        'session': {
+            'cookies': [[getattr(cookie, attribute) if attribute != 'rest' else cookie._rest
+                         for attribute in COOKIE_ATTRIBUTES] for cookie in session.cookies],
+            'url': session.url.geturl() if getattr(session, 'url', None) else None,
+        } if session is not None else None,
+        'truncated': retrievals.get('truncated', []),
+        'version': CAPTURE_VERSION,
+    }
+
+    # The resources are stored as text, which is what retrieve_all() hands to the analyzers
+    bodies.extend([text.encode('utf-8') for _, text in resources if text is not None])
+    metadata['bodies'] = [len(body) for body in bodies]
+
+    metadata = json.dumps(metadata, separators=(',', ':')).encode('utf-8')
+
+    return b''.join([HEADER.pack(len(metadata)), metadata] + bodies)
+
+
+def dump_retrievals(retrievals: dict, fp):
+    """
+    Write the output of retrieve_all() -- responses, redirection history, headers, cookies, and bodies -- as a
+    single capture record, so that it can be analyzed again later without going back to the network. The record is
+    written all at once, but writes to the same file from more than one thread still need to take turns.
+
+    :param retrievals: the dictionary returned by retrieve_all()
+    :param fp: binary file object to write to, typically from open_capture()
+    :return: None
+    """
+    fp.write(encode_retrievals(retrievals))
+
+
+def __read(fp, size: int) -> bytes:
+    data = fp.read(size)
+
+    if len(data) != size:
+        raise CaptureError('capture record is truncated')
+
+    return data
+
+
+def load_retrievals(fp) -> dict:
+    """
+    Read a single capture record written by dump_retrievals()
+
+    :param fp: binary file object to read from, typically from open_capture()
+    :return: a retrievals dictionary in the same format as retrieve_all(), or None at the end of the file
+    """
+    header = fp.read(HEADER.size)
+    if not header:
+        return None
+    elif len(header) != HEADER.size:
+        raise CaptureError('capture record is truncated')
+
+    metadata = json.loads(__read(fp, HEADER.unpack(header)[0]).decode('utf-8'))
+    if metadata.get('version') != CAPTURE_VERSION:
+        raise CaptureError('unsupported capture version: {version}'.format(version=metadata.get('version')))
+
+    bodies = [__read(fp, size) for size in metadata['bodies']]
+
+    responses = [__load_response(response, bodies) for response in metadata['responses']]
+
+    retrievals = {
+        'hostname': metadata['hostname'],
+        'resources': {},
+        'responses': {name: responses[index] if index is not None else None
+                      for name, index in metadata['names'].items()},
+        'session': None,
+        'truncated': metadata['truncated'],
+    }
+
+    for name, present in metadata['resources']:
+        retrievals['resources'][name] = bodies.pop(0).decode('utf-8') if present else None
+
+    if metadata['session'] is not None:
+        session = requests.Session()
+        session.cookies = RequestsCookieJar()
+
+        for cookie in metadata['session']['cookies']:
+            session.cookies.set_cookie(Cookie(*cookie))
+
+        if metadata['session']['url']:
+            session.url = urlparse(metadata['session']['url'])
+
+        retrievals['session'] = session
+
+    return retrievals
+
+
+def iter_retrievals(fp):
+    """
+    Read every capture record in a file, one at a time
+
+    :param fp: binary file object to read from, typically from open_capture()
+    :return: generator of retrievals dictionaries
+    """
+    while True:
+        retrievals = load_retrievals(fp)
+
+        if retrievals is None:
+            return
+
+        yield retrievals
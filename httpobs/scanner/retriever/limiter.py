@@ -0,0 +1,142 @@
+from requests.packages.urllib3.util.connection import allowed_gai_family
+from time import sleep, time
+from urllib.parse import urlparse
+
+from httpobs.conf import (BROKER_URL,
+                          RETRIEVER_LIMITER_DOMAIN_BURST,
+                          RETRIEVER_LIMITER_DOMAIN_RATE,
+                          RETRIEVER_LIMITER_IP_BURST,
+                          RETRIEVER_LIMITER_IP_RATE,
+                          RETRIEVER_LIMITER_MAX_WAIT)
+from httpobs.scanner.utils import getaddrinfo, privatesuffix
+
+import ipaddress
+import redis
+import socket
+import sys
+
+
+# Takes a token from every bucket in KEYS at once, or none of them at all. ARGV is the current time, followed by
+# a (rate, burst) pair for each key. Returns 0 if the tokens were taken, otherwise how long to wait until they can be.
+ACQUIRE = """
+local now = tonumber(ARGV[1])
+local wait = 0
+local tokens = {}
+
+for i, key in ipairs(KEYS) do
+  local rate = tonumber(ARGV[i * 2])
+  local burst = tonumber(ARGV[i * 2 + 1])
+  local bucket = redis.call('HMGET', key, 'tokens', 'timestamp')
+  local elapsed = math.max(now - (tonumber(bucket[2]) or now), 0)
+
+  tokens[i] = math.min(burst, (tonumber(bucket[1]) or burst) + elapsed * rate)
+  if tokens[i] < 1 then
+    wait = math.max(wait, (1 - tokens[i]) / rate)
+  end
+end
+
+if wait == 0 then
+  for i, key in ipairs(KEYS) do
+    redis.call('HMSET', key, 'tokens', tokens[i] - 1, 'timestamp', now)
+    redis.call('EXPIRE', key, math.ceil(tonumber(ARGV[i * 2 + 1]) / tonumber(ARGV[i * 2])) + 1)
+  end
+end
+
+return tostring(wait)
+"""
+
+# Prefix for all the bucket keys in redis
+PREFIX = 'httpobs:limiter:'
+
+
+class PolitenessLimiter:
+    """
+    Token buckets shared by every scanner worker, so that the fleet as a whole doesn't hammer any single IP address
+    (such as a CDN edge) or registrable domain (such as every subdomain of a large site) at once. Every request that
+    the retriever makes takes a token from its IP address's bucket and its registrable domain's bucket first,
+    waiting a little if need be. If redis is unavailable, or the wait would be too long, the request goes ahead
+    anyway; a slightly impolite scan beats no scan at all.
+    """
+    def __init__(self, url: str=BROKER_URL,
+                 ip_rate: float=RETRIEVER_LIMITER_IP_RATE,
+                 ip_burst: float=RETRIEVER_LIMITER_IP_BURST,
+                 domain_rate: float=RETRIEVER_LIMITER_DOMAIN_RATE,
+                 domain_burst: float=RETRIEVER_LIMITER_DOMAIN_BURST,
+                 max_wait: float=RETRIEVER_LIMITER_MAX_WAIT):
+        self.ip = (ip_rate, ip_burst)
+        self.domain = (domain_rate, domain_burst)
+        self.max_wait = max_wait
+
+        self.redis = redis.StrictRedis.from_url(url, socket_timeout=1, socket_connect_timeout=1)
+        self._acquire = self.redis.register_script(ACQUIRE)
+        self._connected = True
+
+    def buckets(self, url: str, timeout: float=None) -> list:
+        """
+        :param url: URL about to be requested
+        :param timeout: the longest to spend looking up its IP address; if that's not long enough, it only takes a
+          token from its registrable domain's bucket
+        :return: list of (key, rate, burst) for every bucket the request has to take a token from
+        """
+        url = urlparse(url)
+        hostname = (url.hostname or '').lower()
+        buckets = []
+
+        if not hostname:
+            return buckets
+
+        # The IP address that the connection will most likely go to, from the same lookup the connection will use
+        try:
+            port = url.port or (443 if url.scheme == 'https' else 80)
+            ip = getaddrinfo(hostname, port, allowed_gai_family(), socket.SOCK_STREAM, timeout=timeout)[0][4][0]
+            buckets.append((PREFIX + 'ip:' + ip,) + self.ip)
+        except (OSError, IndexError, UnicodeError):
+            pass
+
+        # IP addresses don't have a registrable domain
+        try:
+            ipaddress.ip_address(hostname)
+        except ValueError:
+            domain = privatesuffix(hostname)
+            if domain:
+                buckets.append((PREFIX + 'domain:' + domain,) + self.domain)
+
+        return buckets
+
+    def acquire(self, url: str, max_wait: float=None) -> float:
+        """
+        Wait until a request to url is allowed
+
+        :param url: URL about to be requested
+        :param max_wait: the longest to wait, including looking up the IP address, if less than the limiter's own
+        :return: how long we waited, in seconds
+        """
+        max_wait = self.max_wait if max_wait is None else min(self.max_wait, max_wait)
+
+        start = time()
+        buckets = self.buckets(url, timeout=max_wait)
+        if not buckets:
+            return time() - start
+
+        keys = [bucket[0] for bucket in buckets]
+        args = [repr(float(bucket[i])) for bucket in buckets for i in (1, 2)]
+
+        while True:
+            try:
+                wait = float(self._acquire(keys=keys, args=[repr(time())] + args))
+
+                if not self._connected:
+                    print('INFO: Politeness limiter reconnected to redis', file=sys.stderr)
+                self._connected = True
+            except redis.RedisError:
+                if self._connected:
+                    print('WARNING: Politeness limiter unable to connect to redis', file=sys.stderr)
+                self._connected = False
+
+                return time() - start
+
+            remaining = start + max_wait - time()
+            if wait <= 0 or remaining <= 0:
+                return time() - start
+
+            sleep(min(wait, remaining))
@@ -1,12 +1,28 @@
 from celery.exceptions import SoftTimeLimitExceeded, TimeLimitExceeded
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+from threading import Lock
+from time import time
 from urllib.parse import urlparse
 
-from httpobs.conf import (RETRIEVER_CONNECT_TIMEOUT,
+from httpobs.conf import (RETRIEVER_ASYNC_MAX_HOSTS,
+                          RETRIEVER_ASYNC_MAX_WORKERS,
+                          RETRIEVER_BUDGET,
+                          RETRIEVER_BUDGET_TIME,
+                          RETRIEVER_CONNECT_TIMEOUT,
                           RETRIEVER_CORS_ORIGIN,
+                          RETRIEVER_FAN_OUT,
+                          RETRIEVER_FAN_OUT_MAX_WORKERS,
+                          RETRIEVER_MAX_RESOURCE_SIZE,
+                          RETRIEVER_MAX_SCAN_SIZE,
                           RETRIEVER_READ_TIMEOUT,
                           RETRIEVER_USER_AGENT)
+from httpobs.scanner.retriever.capture import dump_retrievals, encode_retrievals
+from httpobs.scanner.document import Document
+from httpobs.scanner.retriever.transport import ScanTransport
 from httpobs.scanner.utils import parse_http_equiv_headers
 
+import asyncio
 import logging
 import requests
 
@@ -22,12 +38,131 @@ logging.getLogger('requests').setLevel(logging.CRITICAL)
 # MIME types for HTML requests
 HTML_TYPES = ('text/html', 'application/xhtml+xml')
 
+# The list of resources to get
+RESOURCES = (
+    '/clientaccesspolicy.xml',
+    '/contribute.json',
+    '/crossdomain.xml',
+    '/robots.txt'
+)
+
 # Maximum timeout for requests for all GET requests for anything but the TLS Observatory
 # The default ConnectionTimeout is something like 75 seconds, which means that things like
 # tiles can take ~600s to timeout, since they have 8 DNS entries.  Setting it to lower
-# should hopefully keep requests from taking forever
+# should hopefully keep requests from taking forever. If the scan has a RetrievalBudget, a request
+# only gets less than this once the budget is running out.
 TIMEOUT = (RETRIEVER_CONNECT_TIMEOUT, RETRIEVER_READ_TIMEOUT)
 
+# How many bytes to read from the socket at a time, when downloading a response body
+CHUNK_SIZE = 16384
+
+
+class ResponseSizeLimits:
+    """
+    Caps how much of a response body gets downloaded, both per resource and across an entire scan, so that hostile
+    or gigantic pages can't balloon the memory of the worker. Shared by every request made during a scan.
+    """
+    def __init__(self, max_resource_size: int=RETRIEVER_MAX_RESOURCE_SIZE, max_scan_size: int=RETRIEVER_MAX_SCAN_SIZE):
+        self.max_resource_size = max_resource_size
+        self.remaining = max_scan_size
+        self._lock = Lock()
+
+    def take(self, size: int, already_read: int) -> int:
+        # Returns how many of the requested bytes can be kept, and deducts that from what's left for the scan
+        with self._lock:
+            allowed = max(min(size, self.max_resource_size - already_read, self.remaining), 0)
+            self.remaining -= allowed
+
+        return allowed
+
+
+class RetrievalBudgetExhausted(Exception):
+    pass
+
+
+class RetrievalBudget:
+    """
+    The total amount of time a scan gets to retrieve everything, so that a slow site gets a degraded scan well inside
+    celery's time limits instead of getting killed by them. Each step gets a share of whatever time is left, weighted
+    against the steps that still remain, but never less than the full TIMEOUT while there's that much left. A step is
+    either a single request, or a whole phase of requests when they're made at the same time. Without a budget,
+    every request simply gets TIMEOUT.
+    """
+    def __init__(self, budget: float=None, steps: int=1, weights: list=None):
+        self.deadline = time() + budget if budget is not None else None
+        self.weights = list(weights) if weights is not None else [1] * steps
+        self._lock = Lock()
+
+    @property
+    def steps(self) -> int:
+        return len(self.weights)
+
+    def remaining(self) -> float:
+        if self.deadline is None:
+            return float('inf')
+
+        return max(self.deadline - time(), 0)
+
+    def share(self) -> float:
+        with self._lock:
+            if not self.weights:
+                return self.remaining()
+
+            return self.remaining() * self.weights[0] / sum(self.weights)
+
+    def allowance(self) -> float:
+        # The step's share, topped up to a full TIMEOUT if there's still that much left
+        return max(self.share(), min(sum(TIMEOUT), self.remaining()))
+
+    def step(self):
+        with self._lock:
+            self.weights = self.weights[1:]
+
+    def timeout(self) -> tuple:
+        allowance = self.allowance()
+
+        if allowance <= 0:
+            raise RetrievalBudgetExhausted()
+        elif allowance >= sum(TIMEOUT):
+            return TIMEOUT
+
+        # Split the allowance between connecting and reading in the same proportions as TIMEOUT
+        connect = min(TIMEOUT[0], allowance * TIMEOUT[0] / sum(TIMEOUT))
+        return connect, min(TIMEOUT[1], allowance - connect)
+
+
+def __read_body(response: requests.Response, limits: ResponseSizeLimits,
+                budget: RetrievalBudget) -> requests.Response:
+    # Download a streamed response, stopping (and dropping the connection) once we've hit one of the size limits,
+    # or have run out of time
+    body = bytearray()
+    response.truncated = False
+
+    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+        allowed = limits.take(len(chunk), len(body))
+        body += chunk[:allowed]
+
+        if allowed < len(chunk) or not budget.remaining():
+            response.truncated = True
+            response.close()
+            break
+
+    # Store the body in the response, as if requests had downloaded it itself
+    response._content = bytes(body)
+    response._content_consumed = True
+
+    return response
+
+
+def __read_redirect_body(response: requests.Response, limits: ResponseSizeLimits, budget: RetrievalBudget,
+                         *args, **kwargs) -> requests.Response:
+    # A response hook: requests reads the whole body of every redirect before following it, so read it first, the
+    # same way as every other body, and it'll find that there's nothing left to read
+    if response.is_redirect:
+        return __read_body(response, limits, budget)
+
+    return response
+
 
 # Create a session, returning the session and the HTTP response in a dictionary
 # Don't create the sessions if it can't connect and retrieve the root of the website
@@ -35,6 +170,9 @@ TIMEOUT = (RETRIEVER_CONNECT_TIMEOUT, RETRIEVER_READ_TIMEOUT)
 def __create_session(url: str, **kwargs) -> dict:
     s = requests.Session()
 
+    # Share connections with every other session in the scan
+    kwargs['transport'].mount(s, verify=kwargs['verify'])
+
     # Allow certificate verification to be disabled on the initial request, which means that sites won't get
     # penalized on things like HSTS, even for self-signed certificates
     s.verify = kwargs['verify']
@@ -56,8 +194,13 @@ def __create_session(url: str, **kwargs) -> dict:
         'User-Agent': RETRIEVER_USER_AGENT,
     })
 
+    # Every request made by this session shares the scan's size limits and time budget, including every redirect
+    s.size_limits = kwargs['size_limits']
+    s.budget = kwargs['budget']
+    s.hooks['response'].append(partial(__read_redirect_body, limits=s.size_limits, budget=s.budget))
+
     try:
-        r = s.get(url, timeout=TIMEOUT)
+        r = __read_body(s.get(url, timeout=s.budget.timeout(), stream=True), s.size_limits, s.budget)
 
         # No tls errors
         r.verified = True
@@ -67,7 +210,9 @@ def __create_session(url: str, **kwargs) -> dict:
     # We can try again if there's an SSL error, making sure to note it in the session
     except requests.exceptions.SSLError:
         try:
-            r = s.get(url, timeout=TIMEOUT, verify=False)
+            kwargs['transport'].mount(s, verify=False)
+            r = __read_body(s.get(url, timeout=s.budget.timeout(), verify=False, stream=True), s.size_limits,
+                            s.budget)
             r.verified = False
         except (KeyboardInterrupt, SystemExit):
             raise
@@ -95,13 +240,14 @@ def __get(session, relative_path='/', headers=None, cookies=None):
         cookies = {}
 
     try:
-        # TODO: limit the maximum size of the response, to keep malicious site operators from killing us
-        # TODO: Perhaps we can naively do it for now by simply setting a timeout?
         # TODO: catch TLS errors instead of just setting it to None?
-        return session.get(session.url.scheme + '://' + session.url.netloc + relative_path,
-                           headers=headers,
-                           cookies=cookies,
-                           timeout=TIMEOUT)
+        return __read_body(session.get(session.url.scheme + '://' + session.url.netloc + relative_path,
+                                       headers=headers,
+                                       cookies=cookies,
+                                       stream=True,
+                                       timeout=session.budget.timeout()),
+                           session.size_limits,
+                           session.budget)
     # Let celery exceptions percolate upward
     except (SoftTimeLimitExceeded, TimeLimitExceeded):
         raise
@@ -114,6 +260,8 @@ def __get(session, relative_path='/', headers=None, cookies=None):
 def __get_page_text(response: requests.Response, force: bool=False) -> str:
     if response is None:
         return None
+    elif getattr(response, 'truncated', False) and not force:  # A partial contribute.json is worse than none at all
+        return None
     elif response.status_code == 200 or force:  # Some pages we want to get the page text even with non-200s
         # A quick and dirty check to make sure that somebody's 404 page didn't actually return 200 with html
         ext = (response.history[0].url if response.history else response.url).split('.')[-1]
@@ -125,7 +273,16 @@ def __get_page_text(response: requests.Response, force: bool=False) -> str:
         return None
 
 
-def retrieve_all(hostname, **kwargs):
+def __budget_weights(fan_out: bool) -> list:
+    # The session phase gets twice as much of the budget as all the resource requests put together
+    if fan_out:
+        return [2, 1]
+
+    resources = 1 + len(RESOURCES)
+    return [resources, resources] + [1] * resources
+
+
+def __parse_kwargs(kwargs: dict) -> dict:
     kwargs['cookies'] = kwargs.get('cookies', {})   # HTTP cookies to send, instead of from the database
     kwargs['headers'] = kwargs.get('headers', {})   # HTTP headers to send, instead of from the database
 
@@ -135,7 +292,31 @@ def retrieve_all(hostname, **kwargs):
     kwargs['path'] = kwargs.get('path', '/')
     kwargs['verify'] = kwargs.get('verify', True)
 
-    retrievals = {
+    # Whether to make all the requests in each phase at the same time
+    kwargs['fan_out'] = kwargs.get('fan_out', RETRIEVER_FAN_OUT)
+
+    # How much of each response, and of the scan as a whole, we're willing to download
+    kwargs['size_limits'] = ResponseSizeLimits(kwargs.get('max_resource_size', RETRIEVER_MAX_RESOURCE_SIZE),
+                                               kwargs.get('max_scan_size', RETRIEVER_MAX_SCAN_SIZE))
+
+    # The resources (and their validators) from the last time the site was scanned, to make conditional requests
+    kwargs['resource_cache'] = kwargs.get('resource_cache') or {}
+
+    # How long the whole scan gets, if it's limited at all, split between two phases when fanning out, or every
+    # request when not; either way, getting the site itself at all matters far more than the rest of the resources
+    kwargs['budget'] = RetrievalBudget(kwargs.get('budget', RETRIEVER_BUDGET_TIME if RETRIEVER_BUDGET else None),
+                                       weights=__budget_weights(kwargs['fan_out']))
+
+    # The connection pools shared by both sessions, optionally rate limited by a PolitenessLimiter, whose waits come
+    # out of the budget as well
+    kwargs['transport'] = ScanTransport(limiter=kwargs.get('limiter'), budget=kwargs['budget'])
+
+    return kwargs
+
+
+def __empty_retrievals(hostname: str) -> dict:
+    return {
+        'documents': {},  # a lazily parsed Document for each resource, shared by every analyzer
         'hostname': hostname,
         'resources': {
         },
@@ -145,56 +326,260 @@ def retrieve_all(hostname, **kwargs):
             'http': None,
             'https': None,
         },
+        'resource_cache': {},  # resources with validators, to be handed back to the next scan of the site
         'session': None,
+        'truncated': [],  # resources whose bodies were cut off by the size limits
     }
 
-    # The list of resources to get
-    resources = (
-        '/clientaccesspolicy.xml',
-        '/contribute.json',
-        '/crossdomain.xml',
-        '/robots.txt'
-    )
 
+# Each phase of the retrieval is a list of independent calls, so that the various retrieval engines can decide
+# for themselves whether to run them one after another or all at once
+def __session_calls(hostname: str, kwargs: dict) -> list:
     # Create some reusable sessions, one for HTTP and one for HTTPS
-    http_session = __create_session('http://' + hostname + kwargs['http_port'] + kwargs['path'], **kwargs)
-    https_session = __create_session('https://' + hostname + kwargs['https_port'] + kwargs['path'], **kwargs)
+    return [partial(__create_session, 'http://' + hostname + kwargs['http_port'] + kwargs['path'], **kwargs),
+            partial(__create_session, 'https://' + hostname + kwargs['https_port'] + kwargs['path'], **kwargs)]
+
 
+def __conditional_headers(cached: dict) -> dict:
+    # Only ask for the resource if it has changed since the last time we saw it
+    headers = {}
+
+    if cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
+
+    return headers
+
+
+def __resource_calls(session, kwargs: dict) -> list:
+    # Do a CORS preflight request, and then get all of the resources
+    return ([partial(__get, session, kwargs['path'], headers={'Origin': RETRIEVER_CORS_ORIGIN})] +
+            [partial(__get, session, resource,
+                     headers=__conditional_headers(kwargs['resource_cache'].get(resource, {})))
+             for resource in RESOURCES])
+
+
+def __run_serially(calls: list, budget: RetrievalBudget, default=None) -> list:
+    results = []
+
+    for call in calls:
+        results.append(call())
+        budget.step()
+
+    return results
+
+
+def __run_fanned_out(calls: list, budget: RetrievalBudget, default=None) -> list:
+    # Make every call at once; anything that hasn't finished by the end of the phase's allowance is treated as
+    # having failed
+    executor = ThreadPoolExecutor(max_workers=min(len(calls), RETRIEVER_FAN_OUT_MAX_WORKERS))
+
+    try:
+        timeout = budget.allowance()
+        futures = [executor.submit(call) for call in calls]
+        wait(futures, timeout=timeout if timeout != float('inf') else None)
+    finally:
+        # Don't wait on stragglers, they'll die off on their own once their own timeouts trigger
+        executor.shutdown(wait=False)
+        budget.step()
+
+    return [future.result() if future.done() else default for future in futures]
+
+
+def __store_sessions(retrievals: dict, http_session: dict, https_session: dict) -> bool:
     # If neither one works, then the site just can't be loaded
     if http_session['session'] is None and https_session['session'] is None:
-        return retrievals
+        return False
+
+    # Store the HTTP only and HTTPS only responses (some things can only be retrieved over one or the other)
+    retrievals['responses']['http'] = http_session['response']
+    retrievals['responses']['https'] = https_session['response']
 
+    if https_session['session'] is not None:
+        retrievals['responses']['auto'] = https_session['response']
+        retrievals['session'] = https_session['session']
     else:
-        # Store the HTTP only and HTTPS only responses (some things can only be retrieved over one or the other)
-        retrievals['responses']['http'] = http_session['response']
-        retrievals['responses']['https'] = https_session['response']
-
-        if https_session['session'] is not None:
-            retrievals['responses']['auto'] = https_session['response']
-            retrievals['session'] = https_session['session']
-        else:
-            retrievals['responses']['auto'] = http_session['response']
-            retrievals['session'] = http_session['session']
-
-        # Store the contents of the "base" page
-        retrievals['resources']['__path__'] = __get_page_text(retrievals['responses']['auto'], force=True)
-
-        # Do a CORS preflight request
-        retrievals['responses']['cors'] = __get(retrievals['session'],
-                                                kwargs['path'],
-                                                headers={'Origin': RETRIEVER_CORS_ORIGIN})
-
-        # Store all the files we retrieve
-        for resource in resources:
-            resp = __get(retrievals['session'], resource)
-            retrievals['resources'][resource] = __get_page_text(resp)
+        retrievals['responses']['auto'] = http_session['response']
+        retrievals['session'] = http_session['session']
+
+    # Store the contents of the "base" page
+    retrievals['resources']['__path__'] = __get_page_text(retrievals['responses']['auto'], force=True)
+    if retrievals['responses']['auto'].truncated:
+        retrievals['truncated'].append('__path__')
+
+    return True
+
+
+def __store_resources(retrievals: dict, responses: list, resource_cache: dict) -> dict:
+    retrievals['responses']['cors'] = responses[0]
+
+    # Store all the files we retrieve
+    for resource, resp in zip(RESOURCES, responses[1:]):
+        cached = resource_cache.get(resource)
+
+        # If it hasn't changed since the last scan, use what we got then
+        if resp is not None and resp.status_code == 304 and cached:
+            retrievals['resources'][resource] = cached['body']
+            retrievals['resource_cache'][resource] = {
+                'body': cached['body'],
+                'etag': resp.headers.get('ETag', cached.get('etag')),
+                'last_modified': resp.headers.get('Last-Modified', cached.get('last_modified')),
+            }
+
+            continue
+
+        retrievals['resources'][resource] = __get_page_text(resp)
+
+        if getattr(resp, 'truncated', False):
+            retrievals['truncated'].append(resource)
+
+        # Keep anything that can be asked for conditionally next time
+        elif (retrievals['resources'][resource] is not None and
+              (resp.headers.get('ETag') or resp.headers.get('Last-Modified'))):
+            retrievals['resource_cache'][resource] = {
+                'body': retrievals['resources'][resource],
+                'etag': resp.headers.get('ETag'),
+                'last_modified': resp.headers.get('Last-Modified'),
+            }
+
+    # Each resource is parsed at most once, the first time something needs it
+    retrievals['documents'] = {resource: Document(text) for resource, text in retrievals['resources'].items()}
 
     # Parse out the HTTP meta-equiv headers
     if (retrievals['responses']['auto'].headers.get('Content-Type', '').split(';')[0]
             in HTML_TYPES
             and retrievals['resources']['__path__']):
-        retrievals['responses']['auto'].http_equiv = parse_http_equiv_headers(retrievals['resources']['__path__'])
+        retrievals['responses']['auto'].http_equiv = parse_http_equiv_headers(retrievals['documents']['__path__'])
     else:
         retrievals['responses']['auto'].http_equiv = {}
 
     return retrievals
+
+
+def __capture(retrievals: dict, kwargs: dict) -> dict:
+    # Record everything that was retrieved, if asked to
+    if kwargs.get('capture') is not None:
+        dump_retrievals(retrievals, kwargs['capture'])
+
+    return retrievals
+
+
+def retrieve_all(hostname, **kwargs):
+    """
+    Retrieve the root of a site over HTTP and HTTPS, along with the handful of resources that the analyzers look at
+
+    :param hostname: hostname to retrieve
+    :param capture: binary file object (see capture.open_capture()) to record the retrievals to, so that they can be
+      analyzed again later with capture.load_retrievals()
+    :param resource_cache: the resource_cache from the site's last retrievals, to only download the well-known
+      resources again if they have changed
+    :param limiter: PolitenessLimiter to wait on before making each request
+    :return: retrievals dictionary, to be handed to the analyzers
+    """
+    kwargs = __parse_kwargs(kwargs)
+    retrievals = __empty_retrievals(hostname)
+
+    # When fanning out, each phase gets half of the budget, so the worst case is about two requests long
+    # instead of eight
+    run = partial(__run_fanned_out if kwargs['fan_out'] else __run_serially, budget=kwargs['budget'])
+
+    http_session, https_session = run(__session_calls(hostname, kwargs), default={'session': None, 'response': None})
+    if not __store_sessions(retrievals, http_session, https_session):
+        return __capture(retrievals, kwargs)
+
+    return __capture(__store_resources(retrievals, run(__resource_calls(retrievals['session'], kwargs)),
+                                       kwargs['resource_cache']), kwargs)
+
+
+async def retrieve_all_async(hostname, executor=None, **kwargs):
+    """
+    The same as retrieve_all(), except that every request in a phase is made at the same time, so that a scan
+    takes roughly as long as its slowest request. The requests themselves are still made with requests, so that
+    the analyzers receive the same objects; they are simply run in an executor. So is everything else that takes
+    any real CPU time, such as decoding and parsing the pages and capturing them, so that one large page doesn't
+    hold up every other host on the loop.
+
+    :param hostname: hostname to retrieve
+    :param executor: the concurrent.futures executor to make the requests in, defaulting to the loop's
+    :return: the same retrievals dictionary as retrieve_all()
+    """
+    loop = asyncio.get_event_loop()
+
+    async def gather(calls: list) -> list:
+        try:
+            return await asyncio.gather(*[loop.run_in_executor(executor, call) for call in calls])
+        finally:
+            kwargs['budget'].step()
+
+    kwargs['fan_out'] = True  # for the purposes of the budget, both phases are made all at once
+    kwargs = __parse_kwargs(kwargs)
+    retrievals = __empty_retrievals(hostname)
+
+    async def capture(retrievals: dict) -> dict:
+        # The record is put together in the executor, but only ever written from the loop's own thread, so that the
+        # records of all the hosts sharing a capture file can't end up interleaved
+        if kwargs.get('capture') is not None:
+            kwargs['capture'].write(await loop.run_in_executor(executor, encode_retrievals, retrievals))
+
+        return retrievals
+
+    http_session, https_session = await gather(__session_calls(hostname, kwargs))
+    if not await loop.run_in_executor(executor, __store_sessions, retrievals, http_session, https_session):
+        return await capture(retrievals)
+
+    responses = await gather(__resource_calls(retrievals['session'], kwargs))
+
+    return await capture(await loop.run_in_executor(
+        executor, __store_resources, retrievals, responses, kwargs['resource_cache']))
+
+
+def retrieve_many(hostnames, max_hosts: int=RETRIEVER_ASYNC_MAX_HOSTS, max_workers: int=RETRIEVER_ASYNC_MAX_WORKERS,
+                  resource_caches: dict=None, **kwargs) -> dict:
+    """
+    Retrieve a large number of hosts on a single event loop, with at most max_hosts being retrieved at once. The rest
+    of the arguments are the same as retrieve_all()'s, and are shared by every host: each one gets its own copy of
+    the cookies and headers, but they all record to the same capture (one whole record at a time) and wait on the
+    same limiter.
+
+    :param hostnames: iterable of hostnames to retrieve; each one is only retrieved once, however many times it's in
+      there
+    :param max_hosts: maximum number of hosts to retrieve at the same time
+    :param max_workers: maximum number of requests to have in flight at the same time
+    :param resource_caches: dictionary of hostname -> the resource_cache from its last retrievals, since unlike the
+      rest of the arguments, a resource_cache only makes sense for the one host
+    :return: dictionary of hostname -> retrievals, in the same format as retrieve_all()
+    """
+    if 'resource_cache' in kwargs:
+        raise TypeError('retrieve_many() takes resource_caches, one for each hostname, not a resource_cache')
+
+    resource_caches = resource_caches or {}
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    semaphore = asyncio.Semaphore(max_hosts)
+
+    # The results are keyed on hostname, so retrieving the same one twice would only throw one of them away
+    seen, unique = set(), []
+    for hostname in hostnames:
+        if hostname not in seen:
+            seen.add(hostname)
+            unique.append(hostname)
+
+    async def retrieve(hostname: str, executor) -> tuple:
+        async with semaphore:
+            return hostname, await retrieve_all_async(hostname,
+                                                      executor=executor,
+                                                      **dict(kwargs,
+                                                             cookies=dict(kwargs.get('cookies', {})),
+                                                             headers=dict(kwargs.get('headers', {})),
+                                                             resource_cache=resource_caches.get(hostname)))
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return dict(loop.run_until_complete(
+                asyncio.gather(*[retrieve(hostname, executor) for hostname in unique])))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
@@ -0,0 +1,312 @@
+from collections import OrderedDict
+from itertools import zip_longest
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection, HTTPSConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from requests.packages.urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from requests.packages.urllib3.util.connection import allowed_gai_family
+from threading import Lock
+from time import time
+
+from httpobs.conf import RETRIEVER_CONNECTION_ATTEMPT_DELAY, RETRIEVER_FAN_OUT_MAX_WORKERS
+from httpobs.scanner.utils import getaddrinfo
+
+import errno
+import os
+import selectors
+import socket
+import ssl
+import weakref
+
+
+# Python 3.5 doesn't support resuming TLS sessions
+TLS_SESSION_RESUMPTION = hasattr(ssl, 'SSLSession')
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """
+    An SSL context that remembers the TLS session from the last connection to each host, and offers it up again
+    on the next connection, so that each additional connection costs an abbreviated handshake instead of a full one.
+
+    Only the most recent max_sessions hosts are remembered, and only sessions that are younger than max_age seconds
+    are offered up, so that a site whose certificate has stopped verifying can't hide behind a resumed session for
+    long.
+    """
+    def __init__(self, *args, max_sessions: int=1024, max_age: float=300, **kwargs):
+        super().__init__()
+
+        self.max_sessions = max_sessions
+        self.max_age = max_age
+
+        # hostname -> (weak reference to the last socket, the last session seen on it), least recently used first
+        self._sessions = OrderedDict()
+        self._lock = Lock()
+
+        # Certificate verification is the same as urllib3's own, which also does its own hostname matching
+        self.options |= ssl.OP_NO_COMPRESSION
+        self.verify_mode = ssl.CERT_REQUIRED
+        self.load_default_certs()
+
+    def __session(self, hostname: str):
+        with self._lock:
+            sock, session = self._sessions.get(hostname, (lambda: None, None))
+
+        # TLS 1.3 tickets only show up after the handshake, so look at the socket again if it's still around, and hang
+        # onto its session for the scans that come after it's gone
+        live = sock()
+        if live is not None and live.session is not None and live.session.has_ticket:
+            session = live.session
+
+            with self._lock:
+                if self._sessions.get(hostname, (None, None))[0] is sock:
+                    self._sessions[hostname] = (sock, session)
+
+        if session is not None and time() - session.time > self.max_age:
+            return None
+
+        return session
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        hostname = kwargs.get('server_hostname')
+
+        if TLS_SESSION_RESUMPTION and hostname and kwargs.get('session') is None:
+            kwargs['session'] = self.__session(hostname)
+
+        sslsock = super().wrap_socket(sock, *args, **kwargs)
+
+        if TLS_SESSION_RESUMPTION and hostname:
+            with self._lock:
+                self._sessions.pop(hostname, None)
+                self._sessions[hostname] = (weakref.ref(sslsock), sslsock.session)
+
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+
+        return sslsock
+
+
+__ssl_context = None
+__ssl_context_lock = Lock()
+__ssl_context_pid = None
+
+
+def shared_ssl_context():
+    """
+    :return: the ResumingSSLContext that every scan in this process shares, so that loading the CA certificates only
+      happens once, and so that scans can resume the TLS sessions of the ones before them; None if TLS sessions can't
+      be resumed
+    """
+    global __ssl_context, __ssl_context_pid
+
+    if not TLS_SESSION_RESUMPTION:
+        return None
+
+    with __ssl_context_lock:
+        # Built lazily, so that each process in a pool builds its own after it forks, rather than sharing sessions
+        if __ssl_context is None or __ssl_context_pid != os.getpid():
+            __ssl_context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            __ssl_context_pid = os.getpid()
+
+        return __ssl_context
+
+
+def interleave_addresses(addresses: list) -> list:
+    """
+    Reorder getaddrinfo() results so that the address families alternate, keeping the first family first
+
+    :param addresses: list of getaddrinfo() results
+    :return: the same results, interleaved by family
+    """
+    families = OrderedDict()
+    for address in addresses:
+        families.setdefault(address[0], []).append(address)
+
+    return [address for group in zip_longest(*families.values()) for address in group if address is not None]
+
+
+def create_connection(address: tuple, timeout=None, source_address=None, socket_options=None,
+                      attempt_delay: float=RETRIEVER_CONNECTION_ATTEMPT_DELAY):
+    """
+    socket.create_connection(), except that the hostname is looked up through the process-wide resolver cache, and
+    that rather than trying each address in turn, the connection attempts are raced against each other ("happy
+    eyeballs"): a new attempt starts every attempt_delay seconds, or as soon as one fails, and whichever connects
+    first wins. The timeout covers the lookup and all of the attempts combined.
+
+    :param address: (host, port)
+    :param timeout: connect timeout in seconds, or anything else to leave the socket's default alone
+    :param source_address: (host, port) to bind to before connecting
+    :param socket_options: [(level, option, value)] to set before connecting
+    :param attempt_delay: how long to give each attempt before starting the next one alongside it
+    :return: the connected socket
+    """
+    host, port = address
+    host = host.strip('[]')  # IPv6 literals come with brackets
+    err = None
+
+    deadline = time() + timeout if isinstance(timeout, (int, float)) else None
+
+    addresses = interleave_addresses(getaddrinfo(host, port, allowed_gai_family(), socket.SOCK_STREAM,
+                                                 timeout=timeout if deadline is not None else None))
+    selector = selectors.DefaultSelector()
+    next_attempt = 0
+    winner = None
+
+    try:
+        while addresses or selector.get_map():
+            now = time()
+
+            if deadline is not None and now >= deadline:
+                err = socket.timeout('timed out')
+                break
+
+            # Start the next attempt if there's nothing else in flight, or the last one has had its chance
+            if addresses and (not selector.get_map() or now >= next_attempt):
+                family, socktype, proto, _, sockaddr = addresses.pop(0)
+                sock = None
+
+                try:
+                    sock = socket.socket(family, socktype, proto)
+
+                    for option in socket_options or []:
+                        sock.setsockopt(*option)
+                    if source_address:
+                        sock.bind(source_address)
+
+                    sock.setblocking(False)
+                    result = sock.connect_ex(sockaddr)
+
+                    if result == 0:
+                        winner = sock
+                        break
+                    elif result not in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                        raise OSError(result, os.strerror(result))
+
+                    selector.register(sock, selectors.EVENT_WRITE)
+                    next_attempt = now + attempt_delay
+                except OSError as e:
+                    err = e
+                    if sock is not None:
+                        sock.close()
+
+                continue
+
+            # Otherwise, wait for an attempt to finish, or until it's time for the next one
+            wait_until = [t for t in (next_attempt if addresses else None, deadline) if t is not None]
+            events = selector.select(max(min(wait_until) - now, 0) if wait_until else None)
+
+            for key, _ in events:
+                sock = key.fileobj
+                selector.unregister(sock)
+                result = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+                if result == 0:
+                    winner = sock
+                    break
+
+                err = OSError(result, os.strerror(result))
+                sock.close()
+                next_attempt = 0  # a failed attempt means we don't need to wait to start the next one
+
+            if winner is not None:
+                break
+    finally:
+        # Abandon all the attempts that lost the race
+        for key in list(selector.get_map().values()):
+            selector.unregister(key.fileobj)
+            key.fileobj.close()
+        selector.close()
+
+    if winner is not None:
+        winner.settimeout(timeout if deadline is not None else socket.getdefaulttimeout())
+        return winner
+
+    if err is not None:
+        raise err
+
+    raise OSError('getaddrinfo returns an empty list')
+
+
+class CachedResolutionMixin:
+    def _new_conn(self):
+        try:
+            return create_connection((getattr(self, '_dns_host', self.host), self.port), self.timeout,
+                                     source_address=self.source_address, socket_options=self.socket_options)
+        except socket.timeout:
+            raise ConnectTimeoutError(
+                self, 'Connection to {host} timed out. (connect timeout={timeout})'.format(host=self.host,
+                                                                                           timeout=self.timeout))
+        except OSError as e:
+            raise NewConnectionError(self, 'Failed to establish a new connection: {e}'.format(e=e))
+
+
+class CachedResolutionHTTPConnection(CachedResolutionMixin, HTTPConnection):
+    pass
+
+
+class CachedResolutionHTTPSConnection(CachedResolutionMixin, HTTPSConnection):
+    pass
+
+
+class CachedResolutionHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CachedResolutionHTTPConnection
+
+
+class CachedResolutionHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CachedResolutionHTTPSConnection
+
+
+class ScanAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter whose connections resolve hostnames through the resolver cache, and optionally use a shared
+    SSL context, and wait on a politeness limiter before every request (including every hop of a redirect). The
+    wait comes out of the scan's RetrievalBudget, if it has one, so the request's timeout is only worked out after it.
+    """
+    def __init__(self, ssl_context=None, limiter=None, budget=None, **kwargs):
+        self.ssl_context = ssl_context
+        self.limiter = limiter
+        self.budget = budget
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if self.limiter is not None:
+            self.limiter.acquire(request.url, max_wait=self.budget.share() if self.budget is not None else None)
+
+            if self.budget is not None:
+                kwargs['timeout'] = self.budget.timeout()
+
+        return super().send(request, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.ssl_context is not None:
+            kwargs['ssl_context'] = self.ssl_context
+
+        super().init_poolmanager(*args, **kwargs)
+
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CachedResolutionHTTPConnectionPool,
+            'https': CachedResolutionHTTPSConnectionPool,
+        }
+
+
+class ScanTransport:
+    """
+    The connection pools shared by every session in a scan. urllib3 keys its pools on (scheme, host, port), so the
+    HTTP probe's redirect to HTTPS and all the follow-up requests reuse the connections that were already opened,
+    and any new connections to the same host can resume the TLS session instead of doing a full handshake, through
+    the SSL context shared by every scan in the process.
+    """
+    def __init__(self, pool_maxsize: int=RETRIEVER_FAN_OUT_MAX_WORKERS, limiter=None, budget=None):
+        self.adapter = ScanAdapter(ssl_context=shared_ssl_context(), limiter=limiter, budget=budget,
+                                   pool_maxsize=pool_maxsize)
+
+        # Requests made without certificate verification get their own pools, so that they can never hand out a
+        # connection that was opened without verification to a request that expects it
+        self.insecure_adapter = ScanAdapter(limiter=limiter, budget=budget, pool_maxsize=pool_maxsize)
+
+    def mount(self, session, verify: bool=True):
+        adapter = self.adapter if verify else self.insecure_adapter
+
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        return session
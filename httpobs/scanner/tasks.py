@@ -1,14 +1,20 @@
 from celery import Celery
 from celery.exceptions import SoftTimeLimitExceeded, TimeLimitExceeded
+from celery.signals import worker_init, worker_process_init, worker_process_shutdown
 
-from httpobs.conf import DEVELOPMENT_MODE
-from httpobs.database import (insert_test_results,
+from httpobs.conf import DEVELOPMENT_MODE, RETRIEVER_LIMITER, SCANNER_PSL_UPDATE_ON_STARTUP
+from httpobs.database import (flush_test_results,
+                              insert_test_results,
+                              reset_pool,
                               select_site_headers,
-                              update_scan_state)
+                              update_scan_state,
+                              update_site_resources)
 from httpobs.scanner import celeryconfig, STATE_ABORTED, STATE_FAILED, STATE_RUNNING
-from httpobs.scanner.analyzer import tests
+from httpobs.scanner.analyzer import run_tests
+from httpobs.scanner.analyzer.utils import report_cache_stats
 from httpobs.scanner.retriever import retrieve_all
-from httpobs.scanner.utils import sanitize_headers
+from httpobs.scanner.retriever.limiter import PolitenessLimiter
+from httpobs.scanner.utils import psl, sanitize_headers
 
 import sys
 
@@ -17,6 +23,28 @@ import sys
 scanner = Celery()
 scanner.config_from_object(celeryconfig)
 
+# Keep the whole fleet of workers from hammering the same hosts at once
+limiter = PolitenessLimiter() if RETRIEVER_LIMITER else None
+
+
+@worker_init.connect
+def update_public_suffix_list(**kwargs):
+    # This happens before the worker forks off its pool, so every process in the pool shares the same list
+    if SCANNER_PSL_UPDATE_ON_STARTUP:
+        psl.refresh()
+
+
+@worker_process_init.connect
+def reset_database_pool(**kwargs):
+    # Each process in the worker's pool needs its own database connections, rather than the ones it inherited
+    reset_pool()
+
+
+@worker_process_shutdown.connect
+def flush_database_write_behind(**kwargs):
+    # Don't lose any finished scans still waiting in the write-behind buffer when a process in the pool is retired
+    flush_test_results()
+
 
 @scanner.task()
 def scan(hostname: str, site_id: int, scan_id: int):
@@ -24,11 +52,16 @@ def scan(hostname: str, site_id: int, scan_id: int):
         # Once celery kicks off the task, let's update the scan state from PENDING to RUNNING
         update_scan_state(scan_id, STATE_RUNNING)
 
-        # Get the site's cookies and headers
+        # Get the site's cookies and headers, and the resources we retrieved the last time we scanned it
         headers = select_site_headers(hostname)
+        resources = headers['resources']
 
         # Attempt to retrieve all the resources
-        reqs = retrieve_all(hostname, cookies=headers['cookies'], headers=headers['headers'])
+        reqs = retrieve_all(hostname,
+                            cookies=headers['cookies'],
+                            headers=headers['headers'],
+                            limiter=limiter,
+                            resource_cache=resources)
 
         # If we can't connect at all, let's abort the test
         if reqs['responses']['auto'] is None:
@@ -36,14 +69,22 @@ def scan(hostname: str, site_id: int, scan_id: int):
 
             return
 
-        # Execute each test, replacing the underscores in the function name with dashes in the test name
+        # Execute each test, replacing the underscores in the function name with dashes in the test name, and write
+        # all of their results in one go, once they've all finished
         # TODO: Get overridden expectations
         insert_test_results(site_id,
                             scan_id,
-                            [test(reqs) for test in tests],
+                            run_tests(reqs),
                             sanitize_headers(reqs['responses']['auto'].headers),
                             reqs['responses']['auto'].status_code)
 
+        # Hang onto the resources, so that the next scan only has to download them if they've changed; the scan is
+        # finished by now, so this is only worth a warning if it doesn't work out
+        try:
+            update_site_resources(site_id, reqs['resource_cache'], resources)
+        except:
+            print('Unable to store the resources retrieved from {hostname}'.format(hostname=hostname),
+                  file=sys.stderr)
     # catch the celery timeout, which will almost certainly occur in retrieve_all()
     except (SoftTimeLimitExceeded, TimeLimitExceeded):
         update_scan_state(scan_id, STATE_ABORTED, error='site unresponsive')
@@ -62,3 +103,6 @@ def scan(hostname: str, site_id: int, scan_id: int):
             import traceback
             print('Error detected in scan for : ' + hostname)
             traceback.print_exc(file=sys.stderr)
+    finally:
+        # Every so often, say how well the analyzer caches in this process are doing
+        report_cache_stats()
@@ -1,32 +1,204 @@
-import json
-import os.path
+import logging
 import requests
 import socket
 import sys
 
-from base64 import b64decode
-from bs4 import BeautifulSoup as bs
+from collections import OrderedDict
 from httpobs.conf import (SCANNER_ALLOW_LOCALHOST,
-                          SCANNER_PINNED_DOMAINS)
+                          SCANNER_DNS_CACHE_NEGATIVE_TTL,
+                          SCANNER_DNS_CACHE_SIZE,
+                          SCANNER_DNS_CACHE_TTL,
+                          SCANNER_PINNED_DOMAINS,
+                          SCANNER_PSL_CACHE_SIZE)
+from httpobs.scanner.document import Document
+from httpobs.scanner.preload import iter_hsts_preload_list, store_preload_list
+from itertools import chain
+from publicsuffixlist import PublicSuffixList
 from requests.structures import CaseInsensitiveDict
+from threading import Lock, Thread
+from time import monotonic
 
 
 HSTS_URL = ('https://chromium.googlesource.com/chromium'
             '/src/net/+/master/http/transport_security_state_static.json?format=TEXT')
+PSL_URL = 'https://publicsuffix.org/list/public_suffix_list.dat'
 
+logger = logging.getLogger(__name__)
 
-def parse_http_equiv_headers(html: str) -> CaseInsensitiveDict:
+
+class ResolverCache:
+    """
+    A size-bounded cache in front of socket.getaddrinfo(), shared by everything in the process that needs to look up
+    a hostname: the API's hostname validation, and every connection the retriever makes. Failed lookups are cached
+    as well, for a shorter period of time, and raise the same exception again every time until they expire.
+    getaddrinfo() doesn't tell us the TTL of the records it returns, so every entry lives for the configured TTL
+    instead.
+    """
+    def __init__(self, max_size: int=SCANNER_DNS_CACHE_SIZE, ttl: float=SCANNER_DNS_CACHE_TTL,
+                 negative_ttl: float=SCANNER_DNS_CACHE_NEGATIVE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        self._cache = OrderedDict()  # (getaddrinfo arguments) -> (expiration, addresses, exception)
+        self._lock = Lock()
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def _lookup(self, key: tuple) -> tuple:
+        try:
+            entry = (monotonic() + self.ttl, socket.getaddrinfo(*key), None)
+        except (OSError, UnicodeError) as e:
+            # Not just gaierror: hostnames that can't be encoded, such as labels too long for IDNA, fail before the
+            # lookup even starts
+            entry = (monotonic() + self.negative_ttl, None, e)
+
+        with self._lock:
+            self._cache[key] = entry
+            self._cache.move_to_end(key)
+
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+        return entry
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0, timeout: float=None) -> list:
+        key = (host, port, family, type, proto, flags)
+
+        with self._lock:
+            entry = self._cache.get(key)
+
+            if entry is not None and entry[0] > monotonic():
+                self._cache.move_to_end(key)
+            else:
+                entry = None
+
+        if entry is None and timeout is None:
+            entry = self._lookup(key)
+        elif entry is None:
+            # getaddrinfo() can't be interrupted, so the lookup happens in the background; if it finishes after
+            # we've given up on it, it still ends up in the cache for next time
+            result = []
+            lookup = Thread(target=lambda: result.append(self._lookup(key)), daemon=True)
+            lookup.start()
+            lookup.join(timeout)
+
+            if not result:
+                raise socket.timeout('timed out resolving {host}'.format(host=host))
+
+            entry = result[0]
+
+        # Every caller gets its own copy of the exception, since they could be raising it at the same time
+        if entry[2] is not None:
+            raise entry[2].__class__(*entry[2].args)
+
+        return list(entry[1])
+
+
+# The process-wide resolver cache
+resolver = ResolverCache()
+
+
+def getaddrinfo(host, port, family=0, type=0, proto=0, flags=0, timeout: float=None) -> list:
+    return resolver.getaddrinfo(host, port, family, type, proto, flags, timeout=timeout)
+
+
+class PublicSuffixService:
+    """
+    The Public Suffix List, loaded once per process and shared by everything that needs to know a hostname's
+    registrable domain, with the lookups themselves memoized in a size-bounded cache. The list is the one that
+    ships with publicsuffixlist until refresh() replaces it with the latest one.
+    """
+    def __init__(self, max_size: int=SCANNER_PSL_CACHE_SIZE):
+        self.max_size = max_size
+
+        self._cache = OrderedDict()  # hostname -> registrable domain
+        self._lock = Lock()
+        self._psl = None
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    @property
+    def psl(self) -> PublicSuffixList:
+        # Loading the list takes a while, so don't do it until someone actually needs it
+        if self._psl is None:
+            with self._lock:
+                if self._psl is None:
+                    self._psl = PublicSuffixList()
+
+        return self._psl
+
+    def privatesuffix(self, hostname: str):
+        """
+        :param hostname: hostname to look up
+        :return: its registrable domain, or None if it doesn't have one
+        """
+        with self._lock:
+            if hostname in self._cache:
+                self._cache.move_to_end(hostname)
+                return self._cache[hostname]
+
+        domain = self.psl.privatesuffix(hostname)
+
+        with self._lock:
+            self._cache[hostname] = domain
+
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+        return domain
+
+    def refresh(self, url: str=PSL_URL, timeout: float=10) -> bool:
+        """
+        Replace the list with the latest one, keeping the current one if it can't be downloaded
+
+        :param url: where to download the list from
+        :param timeout: how long to wait for it, in seconds
+        :return: True if the list was replaced, otherwise False
+        """
+        try:
+            r = requests.get(url, timeout=timeout)
+            r.raise_for_status()
+
+            # Guard against swapping in an error page or a truncated download
+            psl = PublicSuffixList(r.text.splitlines())
+            if psl.privatesuffix('www.example.co.uk') != 'example.co.uk':
+                raise ValueError('not a valid public suffix list')
+        except:
+            print('Unable to download the Public Suffix List.', file=sys.stderr)
+            return False
+
+        with self._lock:
+            self._psl = psl
+            self._cache.clear()
+
+        return True
+
+
+# The process-wide Public Suffix List
+psl = PublicSuffixService()
+
+
+def privatesuffix(hostname: str):
+    return psl.privatesuffix(hostname)
+
+
+def parse_http_equiv_headers(html) -> CaseInsensitiveDict:
     http_equiv_headers = CaseInsensitiveDict()
 
-    # Try to parse the HTML
+    # Accept either the raw HTML or its already parsed Document
+    document = html if isinstance(html, Document) else Document(html)
+
+    # Try to parse the HTML, and find all the meta tags
     try:
-        soup = bs(html, 'html.parser')
+        metas = document.metas
     except:
         return http_equiv_headers
 
-    # Find all the meta tags
-    metas = soup.find_all('meta')
-
     for meta in metas:
         if meta.has_attr('http-equiv') and meta.has_attr('content'):
             # Add support for multiple CSP policies specified via http-equiv
@@ -46,40 +218,27 @@ def parse_http_equiv_headers(html: str) -> CaseInsensitiveDict:
     return http_equiv_headers
 
 
-def retrieve_store_hsts_preload_list():
-    # Download the Google HSTS Preload List
+def retrieve_store_hsts_preload_list(url: str=HSTS_URL):
+    # Download the Google HSTS Preload List, decoding and parsing it as it comes in
     try:
-        r = b64decode(requests.get(HSTS_URL).text).decode('utf-8').split('\n')
-
-        # Remove all the comments
-        r = ''.join([line.split('// ')[0] for line in r if line.strip() != '//'])
-
-        r = json.loads(r)
-
-        # Mapping of site -> whether it includes subdomains
-        hsts = {site['name']: {
-            'includeSubDomains': site.get('include_subdomains', False),
-            'includeSubDomainsForPinning':
-                site.get('include_subdomains', False) or site.get('include_subdomains_for_pinning', False),
-            'mode': site.get('mode'),
-            'pinned': True if 'pins' in site else False,
-        } for site in r['entries']}
-
-        # Add in the manually pinned domains
-        for pinned_domain in SCANNER_PINNED_DOMAINS:
-            hsts[pinned_domain] = {
-                'includeSubDomains': True,
-                'includeSubDomainsForPinning': True,
-                'mode': 'force-https',
-                'pinned': True
-            }
-
-        # Write json file to disk
-        __dirname = os.path.abspath(os.path.dirname(__file__))
-        __filename = os.path.join(__dirname, '..', 'conf', 'hsts-preload.json')
-
-        with open(__filename, 'w') as f:
-            json.dump(hsts, f, indent=2, sort_keys=True)
+        r = requests.get(url, stream=True, timeout=60)
+        r.raise_for_status()
+
+        hsts = iter_hsts_preload_list(r.iter_content(chunk_size=65536))
+
+        # Add in the manually pinned domains, which come last so that they win over the list's own entries
+        pinned = ((pinned_domain, {
+            'includeSubDomains': True,
+            'includeSubDomainsForPinning': True,
+            'mode': 'force-https',
+            'pinned': True
+        }) for pinned_domain in SCANNER_PINNED_DOMAINS)
+
+        # Write the list and its index to disk, if anything changed
+        added, removed, changed = store_preload_list(chain(hsts, pinned))
+
+        logger.info('Updated the HSTS preload list: {added} added, {removed} removed, {changed} changed.'.format(
+            added=len(added), removed=len(removed), changed=len(changed)))
 
     except:
         print('Unable to download the Chromium HSTS preload list.', file=sys.stderr)
@@ -127,7 +286,7 @@ def valid_hostname(hostname: str):
     # Then, try to do a lookup on the hostname; this should return at least one entry and should be the first time
     # that the validator is making a network connection -- the same that requests would make.
     try:
-        hostname_ips = socket.getaddrinfo(hostname, 443)
+        hostname_ips = getaddrinfo(hostname, 443)
 
         # This shouldn't trigger, since getaddrinfo should generate saierror if there's no A records.  Nevertheless,
         # I want to be careful in case of edge cases.  This does make it hard to test.
@@ -0,0 +1,138 @@
+from copy import deepcopy
+from http.cookiejar import Cookie
+from threading import Event
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from httpobs.database.database import _prepare_test_results
+from httpobs.scanner.analyzer import analyze, analyze_many, AnalyzerTimeout, iter_tests, run_tests, tests, TEST_NAMES
+from httpobs.scanner.analyzer.utils import FACTS, get_fact
+from httpobs.tests.unittests.test_capture import retrievals
+from httpobs.tests.utils import empty_requests
+
+
+class TestRunTests(TestCase):
+    def setUp(self):
+        self.reqs = empty_requests('test_parse_http_equiv_headers_csp1.html')
+
+        self.reqs['responses']['auto'].headers['X-XSS-Protection'] = '0'
+        self.reqs['responses']['https'].headers['Strict-Transport-Security'] = 'max-age=15768000'
+        self.reqs['session'].cookies.set_cookie(Cookie(name='SESSIONID', value='bar', port=None, port_specified=False,
+                                                       domain='mozilla.com', domain_specified=True,
+                                                       domain_initial_dot=False, path='/', path_specified=True,
+                                                       secure=False, expires=None, discard=False, comment=None,
+                                                       comment_url=None, rest={'HttpOnly': True}, rfc2109=False,
+                                                       version=1))
+
+    def test_same_results(self):
+        expected = [test(self.reqs) for test in tests]
+
+        self.assertEquals(run_tests(self.reqs), expected)
+        self.assertEquals([result['name'] for result in expected], TEST_NAMES)
+
+        # And the facts from the run don't stick around
+        self.assertNotIn('facts', self.reqs)
+
+    def test_facts_derived_once(self):
+        counted = ('content-security-policy', 'strict-transport-security', 'url')
+
+        with patch.dict(FACTS, {name: MagicMock(wraps=FACTS[name]) for name in counted}):
+            results = run_tests(self.reqs)
+
+            for name in counted:
+                self.assertEquals(FACTS[name].call_count, 1, msg=name)
+
+        # Which other tests then based their results on
+        results = {result['name']: result for result in results}
+        self.assertEquals(results['x-xss-protection']['result'], 'x-xss-protection-not-needed-due-to-csp')
+        self.assertEquals(results['cookies']['result'], 'cookies-session-without-secure-flag-but-protected-by-hsts')
+
+    def test_threads(self):
+        expected = run_tests(self.reqs, threads=0)
+
+        self.assertEquals(run_tests(self.reqs, threads=4), expected)
+        self.assertEquals(run_tests(self.reqs, threads=len(tests)), expected)
+        self.assertNotIn('facts', self.reqs)
+
+    def test_threads_facts_derived_once(self):
+        counted = ('content-security-policy', 'strict-transport-security', 'url')
+
+        with patch.dict(FACTS, {name: MagicMock(wraps=FACTS[name]) for name in counted}):
+            run_tests(self.reqs, threads=len(tests))
+
+            for name in counted:
+                self.assertEquals(FACTS[name].call_count, 1, msg=name)
+
+    def test_threads_timeout(self):
+        released = Event()
+        finished = Event()
+
+        def stuck(reqs):
+            released.wait(5)
+
+            # Even after the run has been given up on, it still has the run's facts, rather than deriving them again
+            get_fact(reqs, 'url')
+            finished.set()
+
+        url = MagicMock(wraps=FACTS['url'])
+
+        try:
+            with patch.dict(FACTS, {'redirection': stuck, 'url': url}):
+                results = iter_tests(self.reqs, threads=2, timeout=0.1)
+
+                # Everything before the stuck test still comes through
+                for name in TEST_NAMES[:TEST_NAMES.index('redirection')]:
+                    self.assertEquals(next(results)['name'], name)
+
+                self.assertRaises(AnalyzerTimeout, next, results)
+                self.assertNotIn('facts', self.reqs)
+
+                released.set()
+                self.assertTrue(finished.wait(5))
+                self.assertEquals(url.call_count, 1)
+        finally:
+            released.set()
+
+
+class TestAnalyze(TestCase):
+    def test_same_score_as_database(self):
+        # A site that gets extra credit, but doesn't get an A without it, so summing the modifiers would be wrong
+        results = [{'expectation': None, 'name': name, 'pass': False, 'result': 'x-xss-protection-disabled',
+                    'score_modifier': 0} for name in TEST_NAMES]
+        results[0].update({'pass': True, 'result': 'csp-implemented-with-no-unsafe', 'score_modifier': 5})
+        results[1].update({'result': 'cookies-without-secure-flag', 'score_modifier': -20})
+
+        with patch('httpobs.scanner.analyzer.run_tests', return_value=deepcopy(results)):
+            analyzed = analyze(retrievals())
+
+        _, scan = _prepare_test_results(1, 1, deepcopy(results), {}, 200)
+
+        self.assertEquals(analyzed['scan']['score'], 80)
+        self.assertEquals((analyzed['scan']['grade'], analyzed['scan']['score']), (scan[3], scan[4]))
+
+
+class TestAnalyzeMany(TestCase):
+    def setUp(self):
+        self.retrievals = [retrievals() for _ in range(3)]
+
+        # One site that's down, and one that's missing everything
+        self.retrievals[1]['responses']['auto'] = None
+        self.retrievals.append({})
+
+    def test_in_process(self):
+        results = list(analyze_many(self.retrievals))
+
+        self.assertEquals(len(results), 4)
+        self.assertEquals(results[0], analyze(retrievals()))
+        self.assertEquals(results[2], results[0])
+        self.assertEquals(results[1], {'error': 'site down'})
+        self.assertIn('KeyError', results[3]['error'])
+
+        self.assertEquals(results[0]['scan']['tests_quantity'], len(tests))
+        self.assertEquals(sorted(results[0]['tests'].keys()), sorted(TEST_NAMES))
+
+    def test_processes(self):
+        # The pool gets fed in batches, which are smaller than the number of retrievals here
+        results = list(analyze_many(iter(self.retrievals * 5), processes=2, chunksize=1))
+
+        self.assertEquals(results, list(analyze_many(self.retrievals * 5)))
@@ -0,0 +1,72 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread
+from unittest import TestCase
+from unittest.mock import patch
+
+from httpobs.scanner.retriever import iter_retrievals, open_capture, retrieve_many
+
+import io
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    # Serves the same page, with an ETag, at every path
+    def do_GET(self):
+        body = b'<html>' + b'x' * 10000 + b'</html>'
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('ETag', '"1"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestRetrieveMany(TestCase):
+    def test_duplicates(self):
+        retrieved = []
+
+        async def retrieve_all_async(hostname, executor=None, **kwargs):
+            retrieved.append(hostname)
+            return {'hostname': hostname}
+
+        with patch('httpobs.scanner.retriever.retriever.retrieve_all_async', retrieve_all_async):
+            reqs = retrieve_many(['mozilla.org', 'example.com', 'mozilla.org'])
+
+        self.assertEquals(sorted(retrieved), ['example.com', 'mozilla.org'])
+        self.assertEquals(reqs, {'example.com': {'hostname': 'example.com'},
+                                 'mozilla.org': {'hostname': 'mozilla.org'}})
+
+    def test_shared_capture(self):
+        server = ThreadingHTTPServer(('', 0), PageHandler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        # Every address in 127/8 is loopback, so each of these is a different host as far as the retriever cares
+        hostnames = ['127.0.0.{i}'.format(i=i) for i in range(1, 41)]
+        buffer = io.BytesIO()
+
+        with open_capture(buffer, 'wb') as capture:
+            reqs = retrieve_many(hostnames, capture=capture, http_port=server.server_port,
+                                 https_port=server.server_port, budget=20)
+
+        with open_capture(io.BytesIO(buffer.getvalue()), 'rb') as capture:
+            captured = {retrievals['hostname']: retrievals for retrievals in iter_retrievals(capture)}
+
+        self.assertEquals(sorted(captured), sorted(hostnames))
+        for hostname in hostnames:
+            self.assertEquals(captured[hostname]['resources'], reqs[hostname]['resources'])
+
+        # Each host has its own resource cache
+        self.assertEquals(len({id(retrievals['resource_cache']) for retrievals in reqs.values()}), len(hostnames))
+
+    def test_shared_resource_cache(self):
+        self.assertRaises(TypeError, retrieve_many, ['mozilla.org'], resource_cache={})
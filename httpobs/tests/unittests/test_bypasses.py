@@ -0,0 +1,65 @@
+from unittest import TestCase
+
+from httpobs.scanner.bypasses import ANGULAR, BypassMatcher, FLASH, JSONP, load_bypasses
+
+
+class TestBypassMatcher(TestCase):
+    def setUp(self):
+        self.bypasses = BypassMatcher({
+            ANGULAR: ['//cdn.example.com/libs/angular/angular.min.js'],
+            FLASH: ['//static.example.com/swf/player.swf'],
+            JSONP: ['//api.example.com/jsonp', '//tags.example.net/gtm/js'],
+        }, needs_eval={'tags.example.net'})
+
+    def test_hosts(self):
+        self.assertEquals(len(self.bypasses), 4)
+
+        self.assertEquals(self.bypasses.match('cdn.example.com'), {ANGULAR})
+        self.assertEquals(self.bypasses.match('https://cdn.example.com'), {ANGULAR})
+        self.assertEquals(self.bypasses.match('https://cdn.example.com:443'), {ANGULAR})
+        self.assertEquals(self.bypasses.match('*.example.com'), {ANGULAR, FLASH, JSONP})
+        self.assertEquals(self.bypasses.match('example.com'), set())
+        self.assertEquals(self.bypasses.match('www.example.com'), set())
+
+    def test_paths(self):
+        self.assertEquals(self.bypasses.match('cdn.example.com/libs/'), {ANGULAR})
+        self.assertEquals(self.bypasses.match('cdn.example.com/libs/angular/angular.min.js'), {ANGULAR})
+        self.assertEquals(self.bypasses.match('*.example.com/swf/'), {FLASH})
+
+        # Paths without a trailing slash only match themselves
+        self.assertEquals(self.bypasses.match('cdn.example.com/libs'), set())
+        self.assertEquals(self.bypasses.match('cdn.example.com/libs/jquery/'), set())
+        self.assertEquals(self.bypasses.match('api.example.com/jsonp/x'), set())
+
+        # Paths with one match the bypasses at exactly that path, as well as below it
+        self.assertEquals(self.bypasses.match('api.example.com/jsonp/'), {JSONP})
+        self.assertEquals(self.bypasses.match('cdn.example.com/libs/angular/angular.min.js/'), {ANGULAR})
+
+    def test_root(self):
+        bypasses = BypassMatcher({JSONP: ['//api.example.org'], FLASH: ['//api.example.org/swf/player.swf']})
+
+        self.assertEquals(bypasses.match('api.example.org'), {FLASH, JSONP})
+        self.assertEquals(bypasses.match('api.example.org/'), {FLASH, JSONP})
+        self.assertEquals(bypasses.match('*.example.org/'), {FLASH, JSONP})
+        self.assertEquals(bypasses.match('api.example.org/swf/'), {FLASH})
+
+    def test_not_hosts(self):
+        for source in ('\'self\'', '\'unsafe-inline\'', '\'nonce-abc\'', '*', 'https:', 'data:'):
+            self.assertEquals(self.bypasses.match(source), set())
+
+    def test_needs_eval(self):
+        self.assertEquals(self.bypasses.match('tags.example.net'), set())
+        self.assertEquals(self.bypasses.match('tags.example.net', unsafe_eval=True), {JSONP})
+
+    def test_bypassable(self):
+        sources = {'\'self\'', 'https://mozilla.org', 'static.example.com', 'api.example.com', 'cdn.example.com'}
+
+        self.assertEquals(self.bypasses.bypassable(sources, (ANGULAR, JSONP)), ['api.example.com', 'cdn.example.com'])
+        self.assertEquals(self.bypasses.bypassable(sources, (FLASH,)), ['static.example.com'])
+
+    def test_load_bypasses(self):
+        bypasses = load_bypasses()
+
+        self.assertEquals(bypasses.match('https://ajax.googleapis.com'), {ANGULAR, FLASH, JSONP})
+        self.assertEquals(bypasses.match('www.googletagmanager.com'), set())
+        self.assertEquals(bypasses.match('www.googletagmanager.com', unsafe_eval=True), {JSONP})
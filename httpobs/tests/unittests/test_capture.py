@@ -0,0 +1,121 @@
+from http.cookiejar import Cookie
+from io import BytesIO
+from requests.cookies import RequestsCookieJar
+from requests.models import PreparedRequest
+from requests.structures import CaseInsensitiveDict
+from unittest import TestCase
+from urllib.parse import urlparse
+
+import requests
+
+from httpobs.scanner.analyzer import tests
+from httpobs.scanner.retriever import dump_retrievals, iter_retrievals, load_retrievals
+from httpobs.scanner.retriever.capture import CaptureError
+
+
+def response(url: str, status_code: int=200, headers: dict=None, body: bytes=b'', history: list=None,
+             request_headers: dict=None) -> requests.Response:
+    r = requests.Response()
+    r._content = body
+    r._content_consumed = True
+    r.encoding = 'utf-8'
+    r.headers = CaseInsensitiveDict(headers or {})
+    r.history = history or []
+    r.status_code = status_code
+    r.url = url
+    r.verified = True
+
+    r.request = PreparedRequest()
+    r.request.prepare(method='GET', url=url, headers=request_headers)
+
+    return r
+
+
+def retrievals() -> dict:
+    https = response('https://www.mozilla.org/',
+                     headers={'Content-Type': 'text/html', 'Strict-Transport-Security': 'max-age=63072000'},
+                     body='<html><head><meta http-equiv="Content-Security-Policy" content="default-src \'none\'">'
+                          '</head><body>💩</body></html>'.encode('utf-8'))
+    https.http_equiv = {'Content-Security-Policy': "default-src 'none'"}
+
+    http = response('https://www.mozilla.org/',
+                    headers=https.headers,
+                    body=https.content,
+                    history=[response('http://www.mozilla.org/', status_code=301,
+                                      headers={'Location': 'https://www.mozilla.org/'})])
+
+    session = requests.Session()
+    session.cookies = RequestsCookieJar()
+    session.cookies.set_cookie(Cookie(0, 'SESSIONID', 'foo', None, False, 'www.mozilla.org', False, False, '/', True,
+                                      False, 2147483647, False, None, None, {'HttpOnly': None}, False))
+    session.url = urlparse(https.url)
+
+    return {
+        'hostname': 'www.mozilla.org',
+        'resources': {
+            '__path__': https.text,
+            '/clientaccesspolicy.xml': None,
+            '/contribute.json': '{"name": "Mozilla"}',
+            '/crossdomain.xml': None,
+            '/robots.txt': 'User-agent: *\nDisallow:\n',
+        },
+        'responses': {
+            'auto': https,
+            'cors': response('https://www.mozilla.org/', request_headers={'Origin': 'https://example.com'}),
+            'http': http,
+            'https': https,
+        },
+        'session': session,
+        'truncated': [],
+    }
+
+
+class TestCapture(TestCase):
+    def round_trip(self, reqs: dict) -> dict:
+        fp = BytesIO()
+        dump_retrievals(reqs, fp)
+        fp.seek(0)
+
+        return load_retrievals(fp)
+
+    def test_round_trip(self):
+        reqs = self.round_trip(retrievals())
+
+        self.assertIs(reqs['responses']['auto'], reqs['responses']['https'])
+        self.assertEquals(reqs['resources'], retrievals()['resources'])
+        self.assertEquals(reqs['responses']['auto'].text, retrievals()['responses']['auto'].text)
+        self.assertEquals(reqs['responses']['auto'].headers['strict-transport-security'], 'max-age=63072000')
+        self.assertEquals(reqs['responses']['cors'].request.headers['Origin'], 'https://example.com')
+        self.assertEquals([r.status_code for r in reqs['responses']['http'].history], [301])
+        self.assertEquals([r.request.url for r in reqs['responses']['http'].history], ['http://www.mozilla.org/'])
+        self.assertEquals(reqs['session'].cookies['SESSIONID'], 'foo')
+        self.assertTrue(reqs['responses']['https'].verified)
+
+    def test_analyzers(self):
+        # Every test should give exactly the same result on a capture as on the original retrievals
+        for test in tests:
+            self.assertEquals(test(self.round_trip(retrievals())), test(retrievals()))
+
+    def test_site_down(self):
+        reqs = retrievals()
+        reqs['responses'] = {'auto': None, 'cors': None, 'http': None, 'https': None}
+        reqs['resources'] = {}
+        reqs['session'] = None
+
+        self.assertEquals(self.round_trip(reqs), reqs)
+
+    def test_multiple(self):
+        fp = BytesIO()
+        for hostname in ('mozilla.org', 'www.mozilla.org'):
+            reqs = retrievals()
+            reqs['hostname'] = hostname
+            dump_retrievals(reqs, fp)
+        fp.seek(0)
+
+        self.assertEquals([reqs['hostname'] for reqs in iter_retrievals(fp)], ['mozilla.org', 'www.mozilla.org'])
+
+    def test_truncated(self):
+        fp = BytesIO()
+        dump_retrievals(retrievals(), fp)
+
+        self.assertRaises(CaptureError, load_retrievals, BytesIO(fp.getvalue()[:-1]))
@@ -0,0 +1,544 @@
+from contextlib import contextmanager
+from threading import Thread
+from time import sleep
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from httpobs.database.database import (_finish_scans,
+                                       _prepare_test_results,
+                                       DatabaseConnectionPool,
+                                       insert_scan,
+                                       insert_test_results,
+                                       maintain_scan_partitions,
+                                       PendingScansListener,
+                                       periodic_maintenance,
+                                       SCANS_PENDING_CHANNEL,
+                                       select_scan_scanner_statistics,
+                                       select_star_from,
+                                       update_scans_dequeue_scans,
+                                       update_site_resources,
+                                       WriteBehindBuffer)
+from httpobs.scanner import STATE_FINISHED
+
+import json
+import psycopg2.extensions
+import re
+import socket
+
+
+class Connection:
+    def __init__(self):
+        self.broken = False
+        self.closed = 0
+        self.rollbacks = 0
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+    def cursor(self):
+        return self
+
+    def execute(self, query):
+        if self.broken:
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+class Cursor:
+    def __init__(self):
+        self.commits = 0
+        self.queries = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def commit(self):
+        self.commits += 1
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, args=None):
+        self.queries.append(query.decode('utf-8') if isinstance(query, bytes) else query)
+
+    def fetchall(self):
+        return []
+
+    def fetchone(self):
+        return {'id': 1, 'state': STATE_FINISHED}
+
+    def mogrify(self, query, args):
+        return (query % tuple(psycopg2.extensions.adapt(arg).getquoted().decode('utf-8') for arg in args)).encode()
+
+
+def results(*scores):
+    return [{'name': 'test-{i}'.format(i=i),
+             'expectation': 'test-passes',
+             'pass': score >= 0,
+             'result': 'test-passes' if score >= 0 else 'test-fails',
+             'score_modifier': score,
+             'data': '%s 100%'} for i, score in enumerate(scores)]
+
+
+class TestDatabaseConnectionPool(TestCase):
+    def setUp(self):
+        self.connections = []
+
+        def connect():
+            self.connections.append(Connection())
+            return self.connections[-1]
+
+        self.pool = DatabaseConnectionPool(max_size=2, timeout=0.05, check_idle=60, connect=connect)
+
+    def test_reuse(self):
+        with self.pool.connection() as first:
+            with self.pool.connection() as second:
+                self.assertIsNot(first, second)
+
+        with self.pool.connection() as third:
+            self.assertIn(third, (first, second))
+
+        self.assertEquals(len(self.connections), 2)
+        self.assertEquals(self.pool.stats()['checkouts'], 3)
+        self.assertEquals(self.pool.stats()['connections'], 2)
+        self.assertEquals(self.pool.stats()['idle'], 2)
+
+    def test_bounded(self):
+        with self.pool.connection():
+            with self.pool.connection():
+                with self.assertRaises(IOError):
+                    with self.pool.connection():
+                        pass
+
+        self.assertEquals(len(self.connections), 2)
+        self.assertEquals(self.pool.stats()['timeouts'], 1)
+        self.assertGreaterEqual(self.pool.stats()['wait_max'], 0.05)
+
+    def test_wait(self):
+        self.pool.timeout = 5
+
+        def hold():
+            with self.pool.connection():
+                sleep(0.2)
+
+        threads = [Thread(target=hold) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        sleep(0.05)
+
+        # Waits for one of the others to give back its connection, rather than opening a third
+        with self.pool.connection() as conn:
+            self.assertIn(conn, self.connections)
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(len(self.connections), 2)
+        self.assertEquals(self.pool.stats()['timeouts'], 0)
+        self.assertGreater(self.pool.stats()['wait_max'], 0.05)
+
+    def test_health_checks(self):
+        with self.pool.connection() as conn:
+            pass
+
+        # Connections that have closed are replaced
+        conn.closed = 1
+        with self.pool.connection() as replacement:
+            self.assertIsNot(replacement, conn)
+
+        # And ones that have been idle a while are checked first
+        self.pool.check_idle = 0
+        replacement.broken = True
+        with self.pool.connection() as conn:
+            self.assertIsNot(conn, replacement)
+            self.assertTrue(replacement.closed)
+
+        with self.pool.connection() as healthy:
+            self.assertIs(healthy, conn)
+
+        self.assertEquals(self.pool.stats()['connections'], 1)
+
+    def test_rollback(self):
+        with self.assertRaises(ValueError):
+            with self.pool.connection() as conn:
+                conn.status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+                raise ValueError
+
+        self.assertEquals(conn.rollbacks, 1)
+
+        with self.pool.connection() as reused:
+            self.assertIs(reused, conn)
+
+    def test_reset(self):
+        with self.pool.connection() as inherited:
+            pass
+
+        with self.pool.connection() as checked_out:
+            self.pool.reset()
+
+        # Nothing from before the reset is closed or handed out again
+        with self.pool.connection() as conn:
+            self.assertNotIn(conn, (inherited, checked_out))
+        self.assertFalse(inherited.closed)
+        self.assertFalse(checked_out.closed)
+        self.assertEquals(self.pool.stats()['connections'], 1)
+
+    def test_reset_after_fork(self):
+        with self.pool.connection() as inherited:
+            pass
+
+        with patch('httpobs.database.database.getpid', return_value=-1):
+            with self.pool.connection() as conn:
+                self.assertIsNot(conn, inherited)
+
+        self.assertEquals(self.pool.stats()['checkouts'], 1)
+
+
+class TestInsertTestResults(TestCase):
+    def setUp(self):
+        self.cursor = Cursor()
+
+        @contextmanager
+        def get_cursor():
+            yield self.cursor
+
+        # The write-behind buffer uses the pool directly; the cursor doubles as the connection
+        @contextmanager
+        def connection():
+            yield self.cursor
+
+        for patcher in (patch('httpobs.database.database.get_cursor', get_cursor),
+                        patch('httpobs.database.database.pool.connection', connection)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_prepare(self):
+        rows, scan = _prepare_test_results(7, 42, results(0, 5, -20), {'Server': 'nginx'}, 200)
+
+        self.assertEquals(len(rows), 3)
+        self.assertEquals(rows[2][:6], (7, 42, 'test-2', 'test-passes', 'test-fails', False))
+        self.assertEquals(json.loads(rows[2][6]), {'data': '%s 100%'})
+        self.assertEquals(rows[2][7], -20)
+
+        # No extra credit below an A
+        self.assertEquals(scan[:6], (42, 1, 2, 'B+', 80, 'MEDIUM'))
+        self.assertEquals(scan[6:], (STATE_FINISHED, '{"Server": "nginx"}', 200))
+
+    def test_single_statement(self):
+        self.assertEquals(insert_test_results(7, 42, results(0, 5, -20), {}, 200, buffered=False),
+                          {'id': 1, 'state': STATE_FINISHED})
+
+        # The tests and the scan in one statement, with the %s in the test output passed along as is
+        self.assertEquals(len(self.cursor.queries), 1)
+        query = self.cursor.queries[0]
+        self.assertIn('INSERT INTO tests', query)
+        self.assertIn('UPDATE scans', query)
+        self.assertEqual(query.count("'test-passes', 'test-"), 3)
+        self.assertIn('%s 100%', query)
+
+    def test_write_behind(self):
+        buffer = WriteBehindBuffer(max_scans=3, interval=60)
+
+        with patch('httpobs.database.database.write_behind', buffer):
+            for scan_id in (1, 2):
+                self.assertIsNone(insert_test_results(7, scan_id, results(0, 5), {}, 200, buffered=True))
+
+            self.assertEquals(len(buffer), 2)
+            self.assertEquals(self.cursor.queries, [])
+
+            # Filling it up writes everything at once
+            insert_test_results(7, 3, results(0, 5), {}, 200, buffered=True)
+
+        self.assertEquals(len(buffer), 0)
+        self.assertEquals(len(self.cursor.queries), 1)
+        self.assertEqual(self.cursor.queries[0].count("'test-passes', 'test-"), 6)
+        self.assertEqual(self.cursor.queries[0].count("'FINISHED'::VARCHAR"), 3)
+
+        self.assertEquals(buffer.flush(), 0)
+
+    def test_write_behind_retry(self):
+        buffer = WriteBehindBuffer(max_scans=10, interval=60)
+        buffer.add(*_prepare_test_results(7, 1, results(0), {}, 200))
+
+        with patch('httpobs.database.database._finish_scans', side_effect=IOError):
+            self.assertEquals(buffer.flush(), 0)
+        self.assertEquals(len(buffer), 1)
+
+        self.assertEquals(buffer.flush(), 1)
+        self.assertEquals(len(buffer), 0)
+
+    def test_write_behind_rejected(self):
+        buffer = WriteBehindBuffer(max_scans=10, interval=60)
+        for scan_id in range(1, 6):
+            buffer.add(*_prepare_test_results(7, scan_id, results(0), {}, 200))
+
+        # Scan 3 can't ever be written, which shouldn't hold up the rest of them
+        def finish_scans(cur, scans):
+            if 3 in (scan[0] for _, scan in scans):
+                raise ValueError('A string literal cannot contain NUL (0x00) characters.')
+            _finish_scans(cur, scans)
+
+        with patch('httpobs.database.database._finish_scans', side_effect=finish_scans), \
+                patch('httpobs.database.database.update_scan_state') as update_scan_state:
+            self.assertEquals(buffer.flush(), 4)
+
+        update_scan_state.assert_called_once_with(3, 'FAILED', error='unable to save results')
+        self.assertEquals(len(buffer), 0)
+        self.assertEquals(sorted(int(scan_id) for query in self.cursor.queries
+                                 for scan_id in re.findall(r'\((\d+)::INTEGER', query)), [1, 2, 4, 5])
+
+    def test_write_behind_max_buffered(self):
+        buffer = WriteBehindBuffer(max_scans=10, interval=60, max_buffered=3)
+        for scan_id in range(1, 6):
+            buffer.add(*_prepare_test_results(7, scan_id, results(0), {}, 200))
+
+        # The oldest are given up on first
+        self.assertEquals(len(buffer), 3)
+        self.assertEquals(buffer.flush(), 3)
+        self.assertIn('(VALUES (3::INTEGER', self.cursor.queries[0])
+
+    def test_no_tests(self):
+        _finish_scans(self.cursor, [([], (1, 0, 0, 'F', 0, 'high', STATE_FINISHED, '{}', None))])
+
+        self.assertNotIn('INSERT INTO tests', self.cursor.queries[0])
+        self.assertIn('NULL::SMALLINT', self.cursor.queries[0])
+
+
+class TestDequeue(TestCase):
+    def setUp(self):
+        self.cursor = Cursor()
+
+        @contextmanager
+        def get_cursor():
+            yield self.cursor
+
+        patcher = patch('httpobs.database.database.get_cursor', get_cursor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_skip_locked(self):
+        update_scans_dequeue_scans(10, skip_locked=True)
+        self.assertIn('ORDER BY scans.start_time', self.cursor.queries[0])
+        self.assertIn('FOR UPDATE OF scans SKIP LOCKED', self.cursor.queries[0])
+
+        update_scans_dequeue_scans(10, skip_locked=False)
+        self.assertNotIn('SKIP LOCKED', self.cursor.queries[1])
+
+    def test_insert_scan_notifies(self):
+        self.assertEquals(insert_scan(1), {'id': 1, 'state': STATE_FINISHED})
+        self.assertEquals(self.cursor.queries[-1], 'NOTIFY ' + SCANS_PENDING_CHANNEL)
+
+
+class TestMaintainScanPartitions(TestCase):
+    def setUp(self):
+        self.cursor = Cursor()
+        self.cursor.fetchone = lambda: {'created': 1, 'archived': 2, 'dropped': 3}
+
+        @contextmanager
+        def get_cursor():
+            yield self.cursor
+
+        patcher = patch('httpobs.database.database.get_cursor', get_cursor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_keep_everything(self):
+        self.assertEquals(maintain_scan_partitions(0, 0), {'created': 1, 'archived': 0, 'dropped': 0})
+        self.assertEquals(len(self.cursor.queries), 1)
+        self.assertIn('create_scan_partitions()', self.cursor.queries[0])
+
+    def test_retire(self):
+        self.assertEquals(maintain_scan_partitions(12, 24), {'created': 1, 'archived': 2, 'dropped': 3})
+        self.assertIn('retire_scan_partitions(%s, %s)', self.cursor.queries[1])
+
+        # The summaries forget the archived scans in the same transaction
+        self.assertEquals(self.cursor.queries[2], 'SELECT refresh_scan_summaries();')
+
+    def test_retire_nothing(self):
+        self.cursor.fetchone = lambda: {'created': 0, 'archived': 0, 'dropped': 0}
+
+        maintain_scan_partitions(12, 24)
+        self.assertEquals(len(self.cursor.queries), 2)
+
+    def test_one_hot_partition(self):
+        self.assertRaises(ValueError, maintain_scan_partitions, 1, 0)
+
+
+class TestScanSummaries(TestCase):
+    def setUp(self):
+        self.cursor = Cursor()
+        self.cursor.fetchall = lambda: [(1, None)]
+        self.cursor.rowcount = 0
+
+        @contextmanager
+        def get_cursor():
+            yield self.cursor
+
+        patcher = patch('httpobs.database.database.get_cursor', get_cursor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_live(self):
+        # The distributions include the deltas that haven't been folded in yet
+        select_star_from('grade_distribution')
+        select_star_from('sites')
+        self.assertEquals(self.cursor.queries, ['SELECT * FROM grade_distribution_live', 'SELECT * FROM sites'])
+
+        select_scan_scanner_statistics()
+        self.assertIn('SELECT * FROM grade_distribution_live;', self.cursor.queries)
+        self.assertIn('SELECT * FROM grade_distribution_all_scans_live;', self.cursor.queries)
+        self.assertIn('SELECT * FROM scan_score_difference_distribution_summation_live;', self.cursor.queries)
+
+    def test_fold(self):
+        periodic_maintenance()
+        self.assertEquals(self.cursor.queries[0], 'SELECT fold_scan_summary_deltas();')
+
+
+class TestUpdateSiteResources(TestCase):
+    def setUp(self):
+        self.cursor = Cursor()
+
+        @contextmanager
+        def get_cursor():
+            yield self.cursor
+
+        patcher = patch('httpobs.database.database.get_cursor', get_cursor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.previous = {
+            '/robots.txt': {'body': 'User-agent: *', 'etag': '"1"', 'last_modified': None},
+            '/contribute.json': {'body': '{}', 'etag': None, 'last_modified': None},
+        }
+
+    def test_unchanged(self):
+        update_site_resources(1, dict(self.previous), self.previous)
+        self.assertEquals(self.cursor.queries, [])
+
+        # Only the validators matter, not the (possibly very large) bodies
+        resources = dict(self.previous, **{'/robots.txt': {'body': 'Disallow: /', 'etag': '"1"',
+                                                           'last_modified': None}})
+        update_site_resources(1, resources, self.previous)
+        self.assertEquals(self.cursor.queries, [])
+
+    def test_nul(self):
+        resources = dict(self.previous, **{'/robots.txt': {'body': 'User-agent: *\x00', 'etag': '"2"',
+                                                           'last_modified': None}})
+        update_site_resources(1, resources, self.previous)
+
+        self.assertIn("'User-agent: *'", self.cursor.queries[0])
+
+    def test_single_statement(self):
+        resources = {
+            '/robots.txt': {'body': 'User-agent: * %s', 'etag': '"2"', 'last_modified': None},
+            '/.well-known/security.txt': {'body': 'Contact: %(x)s', 'etag': None, 'last_modified': 'yesterday'},
+        }
+        update_site_resources(1, resources, self.previous)
+
+        self.assertEquals(len(self.cursor.queries), 1)
+        self.assertIn('DELETE FROM site_resources', self.cursor.queries[0])
+        self.assertIn("'/contribute.json'", self.cursor.queries[0])
+        self.assertIn('ON CONFLICT (site_id, path)', self.cursor.queries[0])
+        self.assertIn("'User-agent: * %s'", self.cursor.queries[0])
+        self.assertIn("'Contact: %(x)s'", self.cursor.queries[0])
+
+    def test_removed(self):
+        update_site_resources(1, {}, self.previous)
+
+        self.assertEquals(len(self.cursor.queries), 1)
+        self.assertTrue(self.cursor.queries[0].startswith('DELETE FROM site_resources'))
+
+
+class Listening:
+    def __init__(self):
+        self.closed = 0
+        self.notifies = []
+        self.queries = []
+        self.sock, self.server = socket.socketpair()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def close(self):
+        self.closed = 1
+        self.sock.close()
+        self.server.close()
+
+    def cursor(self):
+        return self
+
+    def execute(self, query):
+        self.queries.append(query)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def notify(self):
+        self.server.send(b'\x00')
+
+    def poll(self):
+        for _ in self.sock.recv(1024):
+            self.notifies.append(SCANS_PENDING_CHANNEL)
+
+    def set_isolation_level(self, level):
+        self.isolation_level = level
+
+
+class TestPendingScansListener(TestCase):
+    def setUp(self):
+        self.connections = []
+
+        def connect():
+            self.connections.append(Listening())
+            return self.connections[-1]
+
+        self.listener = PendingScansListener(0.01, connect=connect)
+        self.addCleanup(self.listener.close)
+
+    def test_wait(self):
+        # Anything could have been inserted before it started listening
+        self.assertTrue(self.listener.wait(0.01))
+
+        conn = self.connections[0]
+        self.assertEquals(conn.queries, ['LISTEN ' + SCANS_PENDING_CHANNEL])
+        self.assertEquals(conn.isolation_level, psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+
+        self.assertFalse(self.listener.wait(0.01))
+
+        conn.notify()
+        conn.notify()
+        self.assertTrue(self.listener.wait(5))
+        self.assertFalse(self.listener.wait(0.01))
+
+    def test_reconnect(self):
+        self.listener.wait(0.01)
+        self.connections[0].close()
+
+        self.assertTrue(self.listener.wait(0.01))
+        self.assertEquals(len(self.connections), 2)
+
+    def test_unavailable(self):
+        self.listener._connect = MagicMock(side_effect=psycopg2.OperationalError)
+
+        # Falls back to polling
+        self.assertTrue(self.listener.wait(5))
+        self.assertTrue(self.listener.wait(5))
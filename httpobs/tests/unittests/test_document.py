@@ -0,0 +1,174 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+from unittest import skipIf, TestCase
+from unittest.mock import MagicMock, patch
+
+import os.path
+
+from httpobs.scanner.document import Document, ENGINES, EXTRACTED_TAGS
+
+import httpobs.tests.unittests.test_content as test_content
+import httpobs.tests.unittests.test_misc as test_misc
+import httpobs.tests.unittests.test_parse_http_equiv_headers as test_parse_http_equiv_headers
+
+
+HTML = """<html><head>
+<meta http-equiv="Content-Security-Policy" content="default-src 'none'">
+<meta name="referrer" content="no-referrer">
+<script src="https://example.com/a.js" integrity="sha384-foo"></script>
+</head><body><script>var a = 1;</script></body></html>"""
+
+# Documents that every engine has to extract exactly the same elements from as BeautifulSoup does
+CORPUS = [
+    HTML,
+    '',
+    '<html><head></head><body></body></html>',
+    '<META HTTP-EQUIV="Content-Security-Policy" CONTENT="default-src \'self\'">',
+    '<meta name=referrer content=no-referrer>',
+    '<meta content="a &amp; b &lt; &#39;c&#39;">',
+    '<noscript><meta http-equiv="refresh" content="0"></noscript>',
+    '<script>document.write("<meta name=x>")</script><meta name=y>',
+    '<style><meta name=a></style><meta name=b>',
+    '<!-- <meta name=a> --><meta name=b>',
+    '<template><meta name=a></template>',
+    '<meta name="a"/><meta name="b" / >',
+    '<script src="a" async defer integrity></script>',
+    '<script src="//cdn.example.com/a.js" crossorigin="anonymous" integrity="sha384-a sha384-b"></script>',
+    '<meta\nname="a"\ncontent="b">',
+    '<meta name="é" content="😀">',
+    '<svg><script href="a"></script></svg><script src="b"></script>',
+    '<table><meta name=a><tr><td><script src=x></script></td></tr></table>',
+    '<html><body></body></html><meta name=after>',
+    '<![CDATA[<meta name=a>]]><meta name=b>',
+    '<?xml version="1.0" encoding="utf-8"?><cross-domain-policy>'
+    '<allow-access-from domain="*.example.com"/><allow-access-from domain="*"/></cross-domain-policy>',
+    '<?xml version="1.0"?><access-policy><cross-domain-access><policy><allow-from>'
+    '<domain uri="https://example.com"/></allow-from></policy></cross-domain-access></access-policy>',
+]
+
+# Where libxml2 recovers from markup differently than html.parser does
+LXML_DIVERGENCES = [
+    '<meta http-equiv="a" content="1" content="2">',  # first duplicate attribute wins
+    '<title><meta name="a"></title><meta name="b">',  # <title> contents are text
+    '<textarea><meta name="a"></textarea>',
+    '<meta content="&notit;">',                       # entities without semicolons
+]
+
+__dirname = os.path.abspath(os.path.dirname(__file__))
+for __filename in sorted(f for f in os.listdir(os.path.join(__dirname, 'files')) if f.endswith('.html')):
+    with open(os.path.join(__dirname, 'files', __filename), 'r') as __f:
+        CORPUS.append(__f.read())
+
+
+def extracted(document: Document) -> list:
+    # Just the extracted elements' names and attributes, in document order; BeautifulSoup splits up a few
+    # attributes (like class) into lists, which the analyzers never look at
+    return [(element.name, {key: ' '.join(value) if isinstance(value, list) else value
+                            for key, value in element.attrs.items()})
+            for tag in sorted(EXTRACTED_TAGS) for element in document.find_all(tag)]
+
+
+class TestDocument(TestCase):
+    def test_indexes(self):
+        for engine in ('bs4', 'html.parser'):
+            document = Document(HTML, engine=engine)
+
+            self.assertEquals([meta.get('name') for meta in document.metas], [None, 'referrer'])
+            self.assertEquals([script.get('src') for script in document.scripts], ['https://example.com/a.js', None])
+            self.assertTrue(document.scripts[0].has_attr('integrity'))
+            self.assertEquals(document.scripts[0]['integrity'], 'sha384-foo')
+            self.assertEquals([element.name for element in document.find_all('body')], ['body'])
+            self.assertEquals(document.find_all('img'), [])
+
+    def test_lazy(self):
+        with patch('httpobs.scanner.document.bs') as bs:
+            document = Document(HTML)
+            document.metas
+            document.scripts
+            self.assertFalse(bs.called)
+
+            document.soup
+            document.soup
+            self.assertEquals(bs.call_count, 1)
+
+    def test_threads(self):
+        extract = ENGINES['html.parser']
+
+        def slow(*args):
+            sleep(0.05)
+            return extract(*args)
+
+        # Every test in a scan can ask for the same document at once, but it still only gets indexed the once
+        with patch.dict(ENGINES, {'html.parser': MagicMock(wraps=slow)}):
+            document = Document(HTML)
+
+            with ThreadPoolExecutor(8) as executor:
+                metas = list(executor.map(lambda _: document.metas, range(8)))
+
+            self.assertEquals(ENGINES['html.parser'].call_count, 1)
+            self.assertTrue(all(found is metas[0] for found in metas))
+            self.assertEquals(len(metas[0]), 2)
+
+    def test_unparsable(self):
+        for engine in ('bs4', 'html.parser'):
+            for text in (None, '<![..]>'):
+                document = Document(text, engine=engine)
+
+                self.assertRaises(Exception, lambda: document.metas)
+                self.assertRaises(Exception, lambda: document.scripts)
+
+    def test_unknown_engine(self):
+        self.assertRaises(ValueError, Document, HTML, engine='foo')
+
+
+class TestDocumentConformance(TestCase):
+    def assertConforms(self, engine: str, corpus: list):
+        for text in corpus:
+            self.assertEquals(extracted(Document(text, engine=engine)), extracted(Document(text, engine='bs4')),
+                              msg=repr(text[:256]))
+
+    def test_html_parser(self):
+        self.assertConforms('html.parser', CORPUS + LXML_DIVERGENCES)
+
+    @skipIf(ENGINES['lxml'] is None, 'lxml is not installed')
+    def test_lxml(self):
+        self.assertConforms('lxml', CORPUS)
+
+        for text in LXML_DIVERGENCES:
+            self.assertNotEqual(extracted(Document(text, engine='lxml')), extracted(Document(text, engine='bs4')))
+
+
+# Run the analyzers' own tests against each engine, which should get exactly the same results
+class EngineMixin:
+    engine = None
+
+    def setUp(self):
+        patcher = patch('httpobs.scanner.document.SCANNER_DOCUMENT_ENGINE', self.engine)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        super().setUp()
+
+
+class TestSubResourceIntegrityBS4(EngineMixin, test_content.TestSubResourceIntegrity):
+    engine = 'bs4'
+
+
+class TestSubResourceIntegrityHTMLParser(EngineMixin, test_content.TestSubResourceIntegrity):
+    engine = 'html.parser'
+
+
+class TestCORSBS4(EngineMixin, test_misc.TestCORS):
+    engine = 'bs4'
+
+
+class TestCORSHTMLParser(EngineMixin, test_misc.TestCORS):
+    engine = 'html.parser'
+
+
+class TestHTTPEquivHeadersBS4(EngineMixin, test_parse_http_equiv_headers.TestHTTPEquivHeaders):
+    engine = 'bs4'
+
+
+class TestHTTPEquivHeadersHTMLParser(EngineMixin, test_parse_http_equiv_headers.TestHTTPEquivHeaders):
+    engine = 'html.parser'
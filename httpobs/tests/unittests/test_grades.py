@@ -1,6 +1,6 @@
 from unittest import TestCase
 
-from httpobs.scanner.grader import get_score_description, get_score_modifier
+from httpobs.scanner.grader import get_curved_score, get_score_description, get_score_modifier
 
 
 class TestGrader(TestCase):
@@ -10,3 +10,9 @@ class TestGrader(TestCase):
 
     def test_get_score_modifier(self):
         self.assertEquals(0, get_score_modifier('hpkp-preloaded'))
+
+    def test_get_curved_score(self):
+        # Extra credit only counts if the site already gets an A without it
+        self.assertEquals(105, get_curved_score([-5, 10]))
+        self.assertEquals(80, get_curved_score([-20, 10]))
+        self.assertEquals(100, get_curved_score([]))
@@ -1,4 +1,5 @@
 from http.cookiejar import Cookie
+from io import StringIO
 from unittest import TestCase
 
 from httpobs.scanner.analyzer.headers import (content_security_policy,
@@ -9,6 +10,7 @@ from httpobs.scanner.analyzer.headers import (content_security_policy,
                                               x_content_type_options,
                                               x_frame_options,
                                               x_xss_protection)
+from httpobs.scanner.analyzer.utils import AnalyzerCache, cache_stats, caches, report_cache_stats
 from httpobs.tests.utils import empty_requests
 
 
@@ -258,6 +260,33 @@ class TestContentSecurityPolicy(TestCase):
             self.reqs['responses']['auto'].headers['Content-Security-Policy'] = value
             self.assertFalse(content_security_policy(self.reqs)['policy']['insecureBaseUri'])
 
+    def test_bypassable_allowlist(self):
+        values = (
+            "default-src 'self'; script-src 'self' https://cdnjs.cloudflare.com",  # angular
+            "default-src 'self'; script-src 'self' *.googleapis.com",
+            "default-src 'self' ajax.googleapis.com/ajax/libs/",
+            "default-src 'none'; object-src vk.com/swf/",  # flash
+            "script-src 'nonce-abc' 'strict-dynamic'; object-src vk.com",  # strict-dynamic doesn't cover object-src
+            "script-src www.google-analytics.com 'unsafe-eval'",  # jsonp that needs eval
+        )
+
+        for value in values:
+            self.reqs['responses']['auto'].headers['Content-Security-Policy'] = value
+            self.assertTrue(content_security_policy(self.reqs)['policy']['bypassableAllowlist'], msg=value)
+
+        values = (
+            "default-src 'none'",
+            "default-src 'self'; script-src 'self' https://mozilla.org",
+            "default-src 'self'; script-src ajax.googleapis.com/ajax/libs/jquery/",
+            "object-src 'none'; script-src ajax.googleapis.com/ajax/libs/yui/",  # flash isn't a script bypass
+            "script-src 'nonce-abc' 'strict-dynamic' https://cdnjs.cloudflare.com; object-src 'none'",
+            "script-src www.google-analytics.com",
+        )
+
+        for value in values:
+            self.reqs['responses']['auto'].headers['Content-Security-Policy'] = value
+            self.assertFalse(content_security_policy(self.reqs)['policy']['bypassableAllowlist'], msg=value)
+
 
 class TestCookies(TestCase):
     def setUp(self):
@@ -977,3 +1006,75 @@ class TestXXSSProtection(TestCase):
 
         self.assertEquals('x-xss-protection-not-needed-due-to-csp', result['result'])
         self.assertTrue(result['pass'])
+
+
+class TestAnalyzerCaches(TestCase):
+    def setUp(self):
+        self.reqs = empty_requests()
+
+        for cache in caches.values():
+            cache.clear()
+
+    def test_content_security_policy(self):
+        self.reqs['responses']['auto'].headers['Content-Security-Policy'] = "default-src 'none'; img-src https:"
+
+        first = content_security_policy(self.reqs)
+        self.assertEquals(cache_stats()['content-security-policy'], {'hits': 0, 'misses': 1, 'size': 1})
+
+        # Anything the test's caller does to its result stays out of the cache
+        first['policy']['defaultNone'] = False
+        first['data']['default-src'].append('https:')
+
+        second = content_security_policy(self.reqs)
+        self.assertEquals(cache_stats()['content-security-policy'], {'hits': 1, 'misses': 1, 'size': 1})
+        self.assertTrue(second['policy']['defaultNone'])
+        self.assertEquals(second['data']['default-src'], ["'none'"])
+
+        # Line breaks and surrounding whitespace don't make for a different policy, but the scheme does
+        self.reqs['responses']['auto'].headers['Content-Security-Policy'] = "  default-src 'none';\r\n img-src https:"
+        content_security_policy(self.reqs)
+        self.assertEquals(cache_stats()['content-security-policy']['hits'], 2)
+
+        self.reqs['responses']['auto'].url = 'http://mozilla.org/'
+        content_security_policy(self.reqs)
+        self.assertEquals(cache_stats()['content-security-policy']['misses'], 2)
+
+        # Whether it passes is up to the expectation, not the cache
+        self.reqs['responses']['auto'].headers['Content-Security-Policy'] = "script-src 'unsafe-inline'"
+        self.assertFalse(content_security_policy(self.reqs)['pass'])
+        self.assertTrue(content_security_policy(self.reqs, expectation='csp-implemented-with-unsafe-inline')['pass'])
+
+    def test_header_caches(self):
+        self.reqs['responses']['auto'].headers['Referrer-Policy'] = 'no-referrer'
+        self.reqs['responses']['https'].headers['Strict-Transport-Security'] = 'max-age=15768000; includeSubDomains'
+
+        for _ in range(3):
+            self.assertEquals(referrer_policy(self.reqs)['result'], 'referrer-policy-private')
+            self.assertEquals(strict_transport_security(self.reqs)['result'],
+                              'hsts-implemented-max-age-at-least-six-months')
+
+        self.assertEquals(cache_stats()['referrer-policy'], {'hits': 2, 'misses': 1, 'size': 1})
+        self.assertEquals(cache_stats()['strict-transport-security'], {'hits': 2, 'misses': 1, 'size': 1})
+
+    def test_bounded(self):
+        cache = AnalyzerCache('test', max_size=2)
+        self.addCleanup(caches.pop, 'test')
+
+        for key in ('a', 'b', 'a', 'c'):
+            cache.get(key, str.upper, key)
+
+        self.assertEquals(list(cache._cache.items()), [('a', 'A'), ('c', 'C')])
+        self.assertEquals(cache.stats(), {'hits': 1, 'misses': 3, 'size': 2})
+
+    def test_report(self):
+        self.reqs['responses']['auto'].headers['Referrer-Policy'] = 'no-referrer'
+        referrer_policy(self.reqs)
+        referrer_policy(self.reqs)
+
+        output = StringIO()
+        self.assertTrue(report_cache_stats(interval=1e-9, file=output))
+        self.assertIn('referrer-policy 1 hits, 1 misses, 1 cached', output.getvalue())
+
+        # Not again until the interval is up, and never without one
+        self.assertFalse(report_cache_stats(interval=3600, file=output))
+        self.assertFalse(report_cache_stats(interval=0, file=output))
@@ -0,0 +1,104 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+from unittest import TestCase
+from unittest.mock import patch
+
+from httpobs.conf import RETRIEVER_BUDGET_TIME
+from httpobs.scanner.retriever import retrieve_all
+from httpobs.scanner.retriever.retriever import RetrievalBudget, RetrievalBudgetExhausted, TIMEOUT
+
+import requests
+
+
+class TestRetrievalBudget(TestCase):
+    def test_timeout(self):
+        # A generous budget just gets the usual timeouts
+        self.assertEquals(RetrievalBudget(1000, steps=2).timeout(), TIMEOUT)
+
+        # As does a step whose share is small, as long as there's still a full TIMEOUT left
+        self.assertEquals(RetrievalBudget(100, steps=20).timeout(), TIMEOUT)
+
+        # Otherwise, the step gets what's left, split between connecting and reading
+        connect, read = RetrievalBudget(10, steps=5).timeout()
+        self.assertLessEqual(connect + read, 10)
+        self.assertAlmostEqual(connect / read, TIMEOUT[0] / TIMEOUT[1], places=2)
+
+        # And without a budget at all, every step gets TIMEOUT
+        self.assertEquals(RetrievalBudget(None, steps=7).timeout(), TIMEOUT)
+
+    def test_step(self):
+        budget = RetrievalBudget(1000, steps=5)
+        share = budget.share()
+
+        budget.step()
+        self.assertGreater(budget.share(), share)
+
+    def test_weights(self):
+        budget = RetrievalBudget(1000, weights=[3, 1])
+        self.assertAlmostEqual(budget.share(), 750, places=0)
+
+        budget.step()
+        self.assertAlmostEqual(budget.share(), 1000, places=0)
+
+    def test_exhausted(self):
+        self.assertRaises(RetrievalBudgetExhausted, RetrievalBudget(0).timeout)
+
+    def test_default(self):
+        timeouts = []
+
+        def get(*args, **kwargs):
+            timeouts.append(kwargs['timeout'])
+            raise requests.exceptions.ConnectionError()
+
+        # A serial scan with the default configuration gets the usual timeout for its first request
+        with patch('requests.Session.get', side_effect=get):
+            retrieve_all('example.com', fan_out=False)
+
+        self.assertEquals(timeouts[0], TIMEOUT)
+
+        # Even with the budget turned on
+        timeouts.clear()
+        with patch('requests.Session.get', side_effect=get):
+            retrieve_all('example.com', fan_out=False, budget=RETRIEVER_BUDGET_TIME)
+
+        self.assertEquals(timeouts[0], TIMEOUT)
+
+
+class RedirectHandler(BaseHTTPRequestHandler):
+    # Redirects / to /final with a huge body, which the retriever shouldn't read all of
+    def do_GET(self):
+        body = b'x' * (1024 * 1024) if self.path == '/' else b'<html></html>'
+
+        self.send_response(302 if self.path == '/' else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Content-Type', 'text/html')
+        if self.path == '/':
+            self.send_header('Location', '/final')
+        self.end_headers()
+
+        try:
+            self.wfile.write(body)
+        except OSError:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class TestRedirectBodies(TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), RedirectHandler)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_limited(self):
+        reqs = retrieve_all('127.0.0.1', http_port=self.server.server_port, https_port=self.server.server_port,
+                            max_resource_size=1000, max_scan_size=100000, budget=10)
+
+        self.assertEquals(reqs['responses']['http'].url, 'http://127.0.0.1:{port}/final'.format(
+            port=self.server.server_port))
+        self.assertEquals(len(reqs['responses']['http'].history[0].content), 1000)
+        self.assertTrue(reqs['responses']['http'].history[0].truncated)
@@ -1,6 +1,21 @@
+from base64 import b64encode
 from unittest import TestCase
+from unittest.mock import patch
 
-from httpobs.scanner.analyzer.utils import is_hpkp_preloaded, is_hsts_preloaded
+from httpobs.scanner.analyzer.utils import hsts, is_hpkp_preloaded, is_hsts_preloaded
+from httpobs.scanner.preload import (encode_preload_index,
+                                     load_preload_index,
+                                     parse_hsts_preload_list,
+                                     PreloadIndex,
+                                     PreloadIndexError,
+                                     PreloadList,
+                                     store_preload_list)
+from httpobs.scanner.utils import retrieve_store_hsts_preload_list
+
+import httpobs.conf
+import json
+import os.path
+import tempfile
 
 
 class TestPreloadPublicKeyPinning(TestCase):
@@ -60,3 +75,202 @@ class TestPreloadStrictTransportSecurity(TestCase):
 
         self.assertTrue(result['pinned'])
         self.assertTrue(result['includeSubDomainsForPinning'])
+
+
+class TestPreloadIndex(TestCase):
+    def setUp(self):
+        self.entries = {
+            'example.com': {'includeSubDomains': True, 'includeSubDomainsForPinning': True,
+                            'mode': 'force-https', 'pinned': False},
+            'pinned.example.net': {'includeSubDomains': False, 'includeSubDomainsForPinning': True,
+                                   'mode': None, 'pinned': True},
+            'www.example.org': {'includeSubDomains': False, 'includeSubDomainsForPinning': False,
+                                'mode': 'force-https', 'pinned': False},
+        }
+
+    def test_lookup(self):
+        index = PreloadIndex(encode_preload_index(self.entries))
+
+        self.assertEquals(len(index), 3)
+        self.assertEquals(dict(index.items()), self.entries)
+        for hostname, entry in self.entries.items():
+            self.assertEquals(index.get(hostname), entry)
+
+        for hostname in ('', 'com', 'a.example.com', 'example.net', 'zzz.example.org'):
+            self.assertIsNone(index.get(hostname))
+            self.assertFalse(hostname in index)
+
+        self.assertIsNone(PreloadIndex(encode_preload_index({})).get('example.com'))
+
+    def test_suffixes(self):
+        self.entries.update({
+            'com': {'includeSubDomains': False, 'includeSubDomainsForPinning': False, 'mode': None, 'pinned': False},
+            'a-b.example.com': {'includeSubDomains': True, 'includeSubDomainsForPinning': False,
+                                'mode': 'force-https', 'pinned': False},
+            'www.example.com': {'includeSubDomains': False, 'includeSubDomainsForPinning': False,
+                                'mode': 'force-https', 'pinned': True},
+        })
+        index = PreloadIndex(encode_preload_index(self.entries))
+
+        def suffixes(hostname):
+            return [suffix for suffix, entry in index.suffixes(hostname)]
+
+        self.assertEquals(suffixes('foo.www.example.com'), ['www.example.com', 'example.com', 'com'])
+        self.assertEquals(suffixes('www.example.com'), ['www.example.com', 'example.com', 'com'])
+        self.assertEquals(suffixes('foo.a-b.example.com'), ['a-b.example.com', 'example.com', 'com'])
+
+        # Entries that sort in between a hostname and its parents, but don't cover it
+        self.assertEquals(suffixes('zzz.example.com'), ['example.com', 'com'])
+        self.assertEquals(suffixes('a.example.com'), ['example.com', 'com'])
+        self.assertEquals(suffixes('example.community'), [])
+        self.assertEquals(suffixes('www.example.org'), ['www.example.org'])
+        self.assertEquals(suffixes('example.org'), [])
+        self.assertEquals(suffixes('aaa'), [])
+        self.assertEquals(list(PreloadIndex(encode_preload_index({})).suffixes('example.com')), [])
+
+        self.assertEquals(dict(index.suffixes('foo.www.example.com')),
+                          {hostname: self.entries[hostname] for hostname in ('www.example.com', 'example.com', 'com')})
+
+    def test_invalid(self):
+        data = encode_preload_index(self.entries)
+
+        self.assertRaises(PreloadIndexError, PreloadIndex, data[:-1])
+        self.assertRaises(PreloadIndexError, PreloadIndex, data[:4])
+        self.assertRaises(PreloadIndexError, PreloadIndex, b'\x00' + data[1:])
+
+    def test_load(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            json_path = os.path.join(tmp, 'hsts-preload.json')
+            index_path = os.path.join(tmp, 'hsts-preload.idx')
+
+            with open(json_path, 'w') as f:
+                json.dump(self.entries, f)
+
+            # The index gets built the first time, and then it's just opened after that
+            index = load_preload_index(json_path, index_path)
+            self.assertEquals(dict(index.items()), self.entries)
+            index.close()
+
+            with patch('httpobs.scanner.preload.write_preload_index') as write_preload_index:
+                load_preload_index(json_path, index_path).close()
+                self.assertFalse(write_preload_index.called)
+
+            # But it gets rebuilt once the list changes
+            del self.entries['example.com']
+            with open(json_path, 'w') as f:
+                json.dump(self.entries, f)
+            os.utime(json_path, (os.path.getmtime(index_path) + 1,) * 2)
+
+            index = load_preload_index(json_path, index_path)
+            self.assertEquals(dict(index.items()), self.entries)
+            index.close()
+
+    def test_matches_list(self):
+        with open(os.path.join(os.path.dirname(httpobs.conf.__file__), 'hsts-preload.json'), 'r') as f:
+            entries = json.load(f)
+
+        self.assertEquals(dict(hsts.items()), entries)
+
+
+class TestPreloadListRegeneration(TestCase):
+    def setUp(self):
+        with open(os.path.join(os.path.dirname(__file__), 'files', 'transport_security_state_static.json'), 'rb') as f:
+            self.source = f.read()
+
+        # googlesource.com serves it base64-encoded, wrapped or not
+        self.encoded = b64encode(self.source)
+
+    def chunks(self, size: int) -> list:
+        return [self.encoded[i:i + size] for i in range(0, len(self.encoded), size)]
+
+    def test_parse(self):
+        # The way the list used to be parsed, all in one go
+        lines = self.source.decode('utf-8').split('\n')
+        expected = {site['name']: site for site in
+                    json.loads(''.join([line.split('// ')[0] for line in lines if line.strip() != '//']))['entries']}
+
+        # No matter where the chunks get split, it comes out the same
+        for size in (1, 3, 4, 7, 64, 4096):
+            entries = parse_hsts_preload_list(self.chunks(size))
+            self.assertEquals(sorted(entries.keys()), sorted(expected.keys()))
+
+        self.assertEquals(entries['apis.google.com'], {'includeSubDomains': True,
+                                                       'includeSubDomainsForPinning': True,
+                                                       'mode': 'force-https',
+                                                       'pinned': True})
+        self.assertEquals(entries['dropboxstatic.com'], {'includeSubDomains': False,
+                                                         'includeSubDomainsForPinning': True,
+                                                         'mode': None,
+                                                         'pinned': True})
+        self.assertEquals(entries['mail.yahoo.com'], {'includeSubDomains': False,
+                                                      'includeSubDomainsForPinning': False,
+                                                      'mode': 'force-https',
+                                                      'pinned': False})
+
+        # Including when it's line-wrapped, like base64 often is
+        wrapped = b'\n'.join(self.chunks(76))
+        self.assertEquals(parse_hsts_preload_list([wrapped[i:i + 100] for i in range(0, len(wrapped), 100)]),
+                          entries)
+
+    def test_parse_invalid(self):
+        # Cut off in the middle of the entries
+        truncated = b64encode(self.source[:self.source.index(b'mail.yahoo.com')])
+        self.assertRaises(ValueError, parse_hsts_preload_list, [truncated])
+
+        # No entries at all
+        self.assertRaises(ValueError, parse_hsts_preload_list, [b64encode(b'{"pinsets": []}')])
+
+        # Not base64
+        self.assertRaises(ValueError, parse_hsts_preload_list, [b'<html>Not Found</html>'])
+
+    def test_store(self):
+        entries = parse_hsts_preload_list([self.encoded])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            json_path = os.path.join(tmp, 'hsts-preload.json')
+            index_path = os.path.join(tmp, 'hsts-preload.idx')
+            preload = PreloadList(json_path, index_path, interval=0)
+
+            added, removed, changed = store_preload_list(entries, json_path, index_path)
+            self.assertEquals(added, sorted(entries.keys()))
+            self.assertEquals((removed, changed), ([], []))
+            self.assertEquals(preload.get('mail.yahoo.com'), entries['mail.yahoo.com'])
+
+            # Storing the same list again doesn't touch either file
+            inodes = [os.stat(path).st_ino for path in (json_path, index_path)]
+            self.assertEquals(store_preload_list(dict(entries), json_path, index_path), ([], [], []))
+            self.assertEquals([os.stat(path).st_ino for path in (json_path, index_path)], inodes)
+
+            # Whereas a different one replaces them both, and gets picked up without having to reload anything
+            del entries['google.com']
+            entries['mail.yahoo.com']['includeSubDomains'] = True
+            entries['example.com'] = entries['mail.yahoo.com']
+
+            self.assertEquals(store_preload_list(entries, json_path, index_path),
+                              (['example.com'], ['google.com'], ['mail.yahoo.com']))
+            self.assertTrue(preload.get('mail.yahoo.com')['includeSubDomains'])
+            self.assertIsNone(preload.get('google.com'))
+
+            with open(json_path, 'r') as f:
+                self.assertEquals(json.load(f), entries)
+
+            # It can be handed the list as it's parsed, too, with the last of any duplicates winning
+            pinned = {'includeSubDomains': True, 'includeSubDomainsForPinning': True, 'mode': 'force-https',
+                      'pinned': True}
+
+            updates = iter([('example.com', entries['example.com']), ('example.com', pinned)])
+            self.assertEquals(store_preload_list(updates, json_path, index_path),
+                              ([], sorted(set(entries) - {'example.com'}), ['example.com']))
+            self.assertEquals(preload.get('example.com'), pinned)
+
+    @patch('httpobs.scanner.utils.store_preload_list', return_value=([], [], []))
+    @patch('httpobs.scanner.utils.requests.get')
+    def test_regenerate_from_fixture(self, get, store_preload_list):
+        get.return_value.iter_content.return_value = self.chunks(4096)
+
+        retrieve_store_hsts_preload_list()
+
+        # The manually pinned domains are added on top of the list
+        entries = dict(store_preload_list.call_args[0][0])
+        self.assertTrue(entries['aus4.mozilla.org']['pinned'])
+        self.assertTrue(entries['pinningtest.appspot.com']['pinned'])
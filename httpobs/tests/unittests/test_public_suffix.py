@@ -0,0 +1,60 @@
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from httpobs.scanner.utils import PublicSuffixService
+
+
+PSL = """// ===BEGIN ICANN DOMAINS===
+com
+uk
+co.uk
+foo.example
+"""
+
+
+class TestPublicSuffixService(TestCase):
+    def test_privatesuffix(self):
+        psl = PublicSuffixService()
+
+        self.assertEquals(psl.privatesuffix('www.mozilla.org'), 'mozilla.org')
+        self.assertEquals(psl.privatesuffix('www.bbc.co.uk'), 'bbc.co.uk')
+        self.assertIsNone(psl.privatesuffix('co.uk'))
+        self.assertIsNone(psl.privatesuffix(''))
+
+    def test_cached(self):
+        psl = PublicSuffixService(max_size=2)
+
+        with patch.object(psl.psl, 'privatesuffix', wraps=psl.psl.privatesuffix) as privatesuffix:
+            for _ in range(100):
+                self.assertEquals(psl.privatesuffix('www.mozilla.org'), 'mozilla.org')
+            self.assertEquals(privatesuffix.call_count, 1)
+
+            # The least recently used lookup is the one that gets evicted
+            psl.privatesuffix('www.example.com')
+            psl.privatesuffix('www.mozilla.org')
+            psl.privatesuffix('www.example.net')
+            self.assertEquals(list(psl._cache.keys()), ['www.mozilla.org', 'www.example.net'])
+            self.assertEquals(privatesuffix.call_count, 3)
+
+    @patch('httpobs.scanner.utils.requests.get')
+    def test_refresh(self, get):
+        psl = PublicSuffixService()
+        self.assertEquals(psl.privatesuffix('www.foo.example'), 'foo.example')
+
+        # Refreshing the list also throws away the lookups made with the old one
+        get.return_value = MagicMock(text=PSL)
+        self.assertTrue(psl.refresh())
+        self.assertEquals(psl.privatesuffix('www.foo.example'), 'www.foo.example')
+
+    @patch('httpobs.scanner.utils.requests.get')
+    def test_refresh_failure(self, get):
+        psl = PublicSuffixService()
+        original = psl.psl
+
+        # Network failures, and things that aren't the PSL, both leave the current list alone
+        for r in (OSError(), MagicMock(text='<html>Not Found</html>')):
+            get.side_effect = r if isinstance(r, Exception) else None
+            get.return_value = r
+
+            self.assertFalse(psl.refresh())
+            self.assertIs(psl.psl, original)
@@ -0,0 +1,66 @@
+from socket import gaierror
+from unittest import TestCase
+from unittest.mock import patch
+
+import socket
+
+from httpobs.scanner.utils import ResolverCache
+
+
+ADDRESSES = [(2, 1, 6, '', ('192.0.2.1', 443))]
+
+
+class TestResolverCache(TestCase):
+    @patch('httpobs.scanner.utils.socket.getaddrinfo', return_value=ADDRESSES)
+    def test_cached(self, getaddrinfo):
+        resolver = ResolverCache()
+
+        self.assertEquals(resolver.getaddrinfo('mozilla.org', 443), ADDRESSES)
+        self.assertEquals(resolver.getaddrinfo('mozilla.org', 443), ADDRESSES)
+        self.assertEquals(getaddrinfo.call_count, 1)
+
+        # Different arguments are a different lookup
+        resolver.getaddrinfo('mozilla.org', 80)
+        self.assertEquals(getaddrinfo.call_count, 2)
+
+    @patch('httpobs.scanner.utils.socket.getaddrinfo', side_effect=gaierror(-2, 'Name or service not known'))
+    def test_negative(self, getaddrinfo):
+        resolver = ResolverCache()
+
+        self.assertRaises(gaierror, resolver.getaddrinfo, 'foo.invalid', 443)
+        self.assertRaises(gaierror, resolver.getaddrinfo, 'foo.invalid', 443)
+        self.assertEquals(getaddrinfo.call_count, 1)
+
+    @patch('httpobs.scanner.utils.socket.getaddrinfo', return_value=ADDRESSES)
+    def test_expiration(self, getaddrinfo):
+        resolver = ResolverCache(ttl=0)
+
+        resolver.getaddrinfo('mozilla.org', 443)
+        resolver.getaddrinfo('mozilla.org', 443)
+        self.assertEquals(getaddrinfo.call_count, 2)
+
+    @patch('httpobs.scanner.utils.socket.getaddrinfo', return_value=ADDRESSES)
+    def test_max_size(self, getaddrinfo):
+        resolver = ResolverCache(max_size=2)
+
+        resolver.getaddrinfo('a.example', 443)
+        resolver.getaddrinfo('b.example', 443)
+        resolver.getaddrinfo('a.example', 443)  # a is now the most recently used
+        resolver.getaddrinfo('c.example', 443)  # so b gets evicted
+        self.assertEquals(getaddrinfo.call_count, 3)
+
+        resolver.getaddrinfo('a.example', 443)
+        self.assertEquals(getaddrinfo.call_count, 3)
+        resolver.getaddrinfo('b.example', 443)
+        self.assertEquals(getaddrinfo.call_count, 4)
+
+    def test_unencodable(self):
+        resolver = ResolverCache()
+        hostname = 'a' * 70 + '.example.com'  # a label too long for IDNA
+
+        # The real error, not a timeout, both in the background lookup and from the cache afterwards
+        with patch('httpobs.scanner.utils.socket.getaddrinfo', wraps=socket.getaddrinfo) as getaddrinfo:
+            for timeout in (5, None, 5):
+                self.assertRaises(UnicodeError, resolver.getaddrinfo, hostname, 443, timeout=timeout)
+
+        self.assertEquals(getaddrinfo.call_count, 1)
@@ -0,0 +1,86 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+from unittest import TestCase
+
+from httpobs.scanner.retriever import retrieve_all
+
+
+class ValidatingHandler(BaseHTTPRequestHandler):
+    # Answers 304 when asked for a resource with its current ETag, and records what it was asked with
+    etag = '"2"'
+    last_modified = 'Tue, 02 Jan 2018 00:00:00 GMT'
+    requests = {}
+
+    def do_GET(self):
+        self.requests[self.path] = dict(self.headers)
+
+        if self.path != '/' and self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.send_header('ETag', self.etag)
+            self.send_header('Last-Modified', self.last_modified)
+            self.end_headers()
+            return
+
+        body = b'<html></html>' if self.path == '/' else b'changed'
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Content-Type', 'text/html' if self.path == '/' else 'text/plain')
+        if self.path != '/':
+            self.send_header('ETag', self.etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestResourceCache(TestCase):
+    def setUp(self):
+        ValidatingHandler.requests = {}
+
+        self.server = HTTPServer(('127.0.0.1', 0), ValidatingHandler)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_not_modified(self):
+        resource_cache = {
+            '/robots.txt': {'body': 'cached', 'etag': '"2"', 'last_modified': 'Mon, 01 Jan 2018 00:00:00 GMT'},
+        }
+
+        reqs = retrieve_all('127.0.0.1', http_port=self.server.server_port, https_port=self.server.server_port,
+                            resource_cache=resource_cache, budget=10)
+
+        # The validators from the last scan are sent along, but only for the resources that have them
+        self.assertEquals(ValidatingHandler.requests['/robots.txt']['If-None-Match'], '"2"')
+        self.assertEquals(ValidatingHandler.requests['/robots.txt']['If-Modified-Since'],
+                          'Mon, 01 Jan 2018 00:00:00 GMT')
+        self.assertNotIn('If-None-Match', ValidatingHandler.requests['/contribute.json'])
+        self.assertNotIn('If-Modified-Since', ValidatingHandler.requests['/contribute.json'])
+
+        # A 304 gets the body from the last scan, and the validators from the 304
+        self.assertEquals(reqs['resources']['/robots.txt'], 'cached')
+        self.assertEquals(reqs['resource_cache']['/robots.txt'],
+                          {'body': 'cached', 'etag': '"2"', 'last_modified': 'Tue, 02 Jan 2018 00:00:00 GMT'})
+
+        # Anything that was downloaded is kept for next time
+        self.assertEquals(reqs['resources']['/contribute.json'], 'changed')
+        self.assertEquals(reqs['resource_cache']['/contribute.json'],
+                          {'body': 'changed', 'etag': '"2"', 'last_modified': None})
+
+    def test_modified(self):
+        resource_cache = {'/robots.txt': {'body': 'cached', 'etag': '"1"', 'last_modified': None}}
+
+        reqs = retrieve_all('127.0.0.1', http_port=self.server.server_port, https_port=self.server.server_port,
+                            resource_cache=resource_cache, budget=10)
+
+        self.assertEquals(ValidatingHandler.requests['/robots.txt']['If-None-Match'], '"1"')
+        self.assertNotIn('If-Modified-Since', ValidatingHandler.requests['/robots.txt'])
+
+        # The stale body is replaced
+        self.assertEquals(reqs['resources']['/robots.txt'], 'changed')
+        self.assertEquals(reqs['resource_cache']['/robots.txt'],
+                          {'body': 'changed', 'etag': '"2"', 'last_modified': None})
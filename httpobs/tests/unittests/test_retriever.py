@@ -4,7 +4,7 @@ import string
 
 from unittest import TestCase
 
-from httpobs.scanner.retriever import retrieve_all
+from httpobs.scanner.retriever import retrieve_all, retrieve_many
 
 
 class TestRetriever(TestCase):
@@ -48,3 +48,15 @@ class TestRetriever(TestCase):
         reqs = retrieve_all('expired.badssl.com')
 
         self.assertFalse(reqs['responses']['auto'].verified)
+
+    def test_retrieve_many(self):
+        domain = ''.join(random.choice(string.ascii_lowercase) for _ in range(223)) + '.net'
+        reqs = retrieve_many(['mozilla.org', domain])
+
+        self.assertEquals({'mozilla.org', domain}, set(reqs.keys()))
+
+        # The results should be the same as if they were retrieved one by one
+        self.assertIsNone(reqs[domain]['responses']['auto'])
+        self.assertIsNotNone(reqs['mozilla.org']['resources']['/contribute.json'])
+        self.assertIsInstance(reqs['mozilla.org']['responses']['auto'], requests.Response)
+        self.assertIsInstance(reqs['mozilla.org']['session'], requests.Session)
@@ -0,0 +1,389 @@
+from datetime import datetime, timedelta
+from os import environ
+from unittest import skipUnless, TestCase
+from unittest.mock import patch
+from uuid import uuid4
+
+from httpobs.database.database import (_finish_scans,
+                                       _prepare_test_results,
+                                       DatabaseConnectionPool,
+                                       insert_test_results,
+                                       maintain_scan_partitions,
+                                       select_star_from)
+from httpobs.scanner import STATE_FINISHED, STATE_RUNNING
+
+import os.path
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+
+
+# These run schema.sql against a real PostgreSQL, such as the postgres:11 that the database's Dockerfile uses. Every
+# test creates a database of its own, along with the roles that schema.sql creates, and drops them afterwards, so
+# this has to be a superuser on a throwaway server, e.g. HTTPOBS_TEST_POSTGRESQL='host=localhost user=postgres'
+POSTGRESQL = environ.get('HTTPOBS_TEST_POSTGRESQL')
+
+SCHEMA = os.path.join(os.path.dirname(__file__), '..', '..', 'database', 'schema.sql')
+
+# The summaries that update_scan_summaries() keeps up to date, and the views of the distributions that include the
+# deltas that fold_scan_summary_deltas() hasn't folded in yet
+SUMMARIES = {
+    'earliest_scans': 'SELECT site_id, scan_id FROM earliest_scans ORDER BY site_id',
+    'latest_scans': 'SELECT site_id, scan_id FROM latest_scans ORDER BY site_id',
+    'grade_distribution': 'SELECT * FROM grade_distribution_live ORDER BY grade',
+    'grade_distribution_all_scans': 'SELECT * FROM grade_distribution_all_scans_live ORDER BY grade',
+    'scan_score_difference_distribution': """SELECT site_id, before, after, difference
+                                               FROM scan_score_difference_distribution ORDER BY site_id""",
+    'scan_score_difference_distribution_summation': """SELECT * FROM scan_score_difference_distribution_summation_live
+                                                         ORDER BY difference""",
+}
+
+
+def read_schema() -> str:
+    with open(SCHEMA) as f:
+        return f.read()
+
+
+@skipUnless(POSTGRESQL, 'HTTPOBS_TEST_POSTGRESQL isn\'t set')
+class SchemaTestCase(TestCase):
+    schema = None  # defaults to schema.sql
+
+    def setUp(self):
+        self.database = 'httpobs_test_' + uuid4().hex
+
+        self.admin(['CREATE DATABASE ' + self.database])
+        self.addCleanup(self.admin, ['DROP DATABASE IF EXISTS ' + self.database,
+                                     'DROP ROLE IF EXISTS httpobsapi',
+                                     'DROP ROLE IF EXISTS httpobsscanner'])
+
+        self.conn = self.connect()
+        self.execute(self.schema or read_schema())
+
+        self.start = datetime(2019, 1, 1)
+
+    @staticmethod
+    def admin(statements: list):
+        conn = psycopg2.connect(POSTGRESQL)
+        conn.autocommit = True
+
+        try:
+            with conn.cursor() as cur:
+                for statement in statements:
+                    cur.execute(statement)
+        finally:
+            conn.close()
+
+    def connect(self, role: str=None):
+        conn = psycopg2.connect(psycopg2.extensions.make_dsn(POSTGRESQL, dbname=self.database),
+                                cursor_factory=psycopg2.extras.DictCursor)
+        conn.autocommit = True
+        self.addCleanup(conn.close)
+
+        # Run as one of the roles that schema.sql creates, so that it takes their grants to work
+        if role:
+            with conn.cursor() as cur:
+                cur.execute('SET ROLE ' + role)
+
+        return conn
+
+    def use_pool(self, role: str='httpobsscanner'):
+        # Point httpobs.database at this test's database, so that its functions can be run against it
+        def connect():
+            conn = self.connect(role)
+            conn.autocommit = False
+
+            return conn
+
+        patcher = patch('httpobs.database.database.pool', DatabaseConnectionPool(connect=connect))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def execute(self, query: str, args=None, conn=None) -> list:
+        with (conn or self.conn).cursor() as cur:
+            cur.execute(query, args)
+
+            return [tuple(row) for row in cur.fetchall()] if cur.description else []
+
+    def site(self, domain: str) -> int:
+        return self.execute("""INSERT INTO sites (domain, creation_time) VALUES (%s, NOW()) RETURNING id""",
+                            (domain,))[0][0]
+
+    def scan(self, site_id: int) -> int:
+        return self.execute("""INSERT INTO scans (site_id, state, start_time, tests_quantity)
+                                 VALUES (%s, %s, %s, 1) RETURNING id""",
+                            (site_id, STATE_RUNNING, self.start))[0][0]
+
+    def skip_to(self, scan_id: int):
+        # Pretend that a lot of scans have already happened, so the next one's id is scan_id
+        self.execute("SELECT setval('scans_id_seq', %s, false)", (scan_id,))
+
+    def finish(self, scan_id: int, score: int, minutes: int):
+        # Finish a scan at a given time after the start, rather than at NOW(), so that they can finish out of order
+        self.execute("""UPDATE scans SET (state, end_time, score, grade) = (%s, %s, %s, %s) WHERE id = %s""",
+                     (STATE_FINISHED, self.start + timedelta(minutes=minutes), score, 'A' if score >= 90 else 'F',
+                      scan_id),
+                     conn=self.connect('httpobsscanner'))
+
+    def results(self, scan_id: int) -> list:
+        return [{'expectation': 'x', 'name': 'x', 'pass': True, 'result': 'x', 'score_modifier': -5}]
+
+    def finish_with_tests(self, site_id: int, scan_ids: list):
+        # Finish scans the way the scanner does, with their tests, all in a single statement
+        scans = [_prepare_test_results(site_id, scan_id, self.results(scan_id), {}, 200) for scan_id in scan_ids]
+
+        with self.connect('httpobsscanner').cursor() as cur:
+            _finish_scans(cur, scans)
+
+    def summaries(self) -> dict:
+        return {name: self.execute(query) for name, query in SUMMARIES.items()}
+
+
+class TestScanSummaries(SchemaTestCase):
+    def test_incremental_matches_refresh(self):
+        new, existing, unordered, earlier, tied = (self.site(domain) for domain in ('new.example.com',
+                                                                                    'existing.example.com',
+                                                                                    'unordered.example.com',
+                                                                                    'earlier.example.com',
+                                                                                    'tied.example.com'))
+
+        # A site's first scan, and a site that already has one
+        self.finish(self.scan(new), 100, 10)
+        self.finish(self.scan(existing), 50, 1)
+        self.finish(self.scan(existing), 95, 2)
+
+        # Scans that finish after a scan that ended later than them, which aren't the site's latest
+        first, second, third = self.scan(unordered), self.scan(unordered), self.scan(unordered)
+        self.finish(first, 40, 1)
+        self.finish(third, 90, 3)
+        self.finish(second, 60, 2)
+
+        # Or are even the site's earliest
+        first, second = self.scan(earlier), self.scan(earlier)
+        self.finish(second, 90, 2)
+        self.finish(first, 30, 1)
+
+        # And scans that finish at exactly the same time
+        self.finish_with_tests(tied, [self.scan(tied), self.scan(tied)])
+
+        # The live views already include the deltas, so folding them in changes nothing, and neither does rebuilding
+        # everything from scratch
+        incremental = self.summaries()
+        self.assertEquals(len(incremental['latest_scans']), 5)
+        self.assertNotEquals(self.execute('SELECT count(*) FROM scan_summary_deltas'), [(0,)])
+
+        self.assertEquals(self.execute('SELECT fold_scan_summary_deltas()', conn=self.connect('httpobsscanner')),
+                          [(10,)])
+        self.assertEquals(self.execute('SELECT count(*) FROM scan_summary_deltas'), [(0,)])
+        self.assertEquals(self.summaries(), incremental)
+
+        self.execute('SELECT refresh_scan_summaries()', conn=self.connect('httpobsscanner'))
+        self.assertEquals(self.summaries(), incremental)
+
+        # Even with deltas still queued up when it's rebuilt
+        self.finish(self.scan(existing), 40, 3)
+        incremental = self.summaries()
+
+        self.execute('SELECT refresh_scan_summaries()')
+        self.assertEquals(self.summaries(), incremental)
+
+
+# The scans and tests tables from before they were partitioned
+UNPARTITIONED = """
+CREATE TABLE IF NOT EXISTS scans (
+  id                                  SERIAL PRIMARY KEY,
+  site_id                             INTEGER REFERENCES sites (id) NOT NULL,
+  state                               VARCHAR    NOT NULL,
+  start_time                          TIMESTAMP  NOT NULL,
+  end_time                            TIMESTAMP  NULL,
+  algorithm_version                   SMALLINT   NOT NULL DEFAULT 1,
+  tests_failed                        SMALLINT   NOT NULL DEFAULT 0,
+  tests_passed                        SMALLINT   NOT NULL DEFAULT 0,
+  tests_quantity                      SMALLINT   NOT NULL,
+  grade                               VARCHAR(2) NULL,
+  score                               SMALLINT   NULL,
+  likelihood_indicator                VARCHAR    NULL,
+  error                               VARCHAR    NULL,
+  response_headers                    JSONB NULL,
+  hidden                              BOOL       NOT NULL DEFAULT FALSE,
+  status_code                         SMALLINT   NULL
+);
+
+CREATE TABLE IF NOT EXISTS tests (
+  id                                  BIGSERIAL PRIMARY KEY,
+  site_id                             INTEGER REFERENCES sites (id) NOT NULL,
+  scan_id                             INTEGER REFERENCES scans (id) NOT NULL,
+  name                                VARCHAR  NOT NULL,
+  expectation                         VARCHAR  NOT NULL,
+  result                              VARCHAR  NOT NULL,
+  score_modifier                      SMALLINT NOT NULL,
+  pass                                BOOL     NOT NULL,
+  output                              JSONB    NOT NULL
+);
+CREATE INDEX tests_scan_id_idx ON tests (scan_id);
+
+"""
+
+
+def unpartitioned_schema() -> str:
+    # schema.sql as it was before partitioning, other than the (unused) partitioning functions
+    schema = read_schema()
+    start = schema.index('/* Scans and their tests are partitioned')
+    end = schema.index('CREATE TABLE IF NOT EXISTS site_resources')
+
+    return (schema[:start] + UNPARTITIONED + schema[end:]).replace('SELECT create_scan_partitions();', '')
+
+
+def partitioning_migration() -> str:
+    # The commented out update at the bottom of schema.sql
+    schema = read_schema()
+    start = schema.index('/*\n', schema.index('/* Update to partition scans and tests')) + 3
+
+    return schema[start:schema.index('\n*/', start)]
+
+
+class TestScanPartitions(SchemaTestCase):
+    def partitions(self, schema: str='public') -> list:
+        return [row[0] for row in self.execute("""SELECT relname FROM pg_class
+                                                    WHERE relnamespace = %s::REGNAMESPACE
+                                                      AND relkind = 'r'
+                                                      AND relname ~ '^(scans|tests)_p'
+                                                    ORDER BY relname""", (schema,))]
+
+    def test_fresh_install(self):
+        self.assertEquals(self.partitions(), ['scans_p000000', 'scans_p000001', 'scans_p000002',
+                                              'tests_p000000', 'tests_p000001', 'tests_p000002'])
+
+        self.use_pool()
+        site_id = self.site('mozilla.org')
+        scan_id = self.scan(site_id)
+
+        self.assertEquals(insert_test_results(site_id, scan_id, self.results(scan_id), {}, 200, buffered=False)['id'],
+                          scan_id)
+        self.assertEquals(self.execute('SELECT scan_id FROM tests_p000000'), [(scan_id,)])
+        self.assertEquals(self.execute('SELECT scan_id FROM latest_tests'), [(scan_id,)])
+
+        # Each partition of tests can only have the tests of scans that exist
+        self.assertRaises(psycopg2.IntegrityError, self.execute,
+                          """INSERT INTO tests (site_id, scan_id, name, expectation, result, pass, output,
+                                                score_modifier)
+                               VALUES (%s, %s, 'x', 'x', 'x', TRUE, '{}', 0)""", (site_id, scan_id + 1))
+
+    def test_partition_boundary(self):
+        self.use_pool()
+        site_id = self.site('mozilla.org')
+
+        # A scan starts just before the boundary, and finishes after scans have moved on to the next partition and
+        # the old partitions have been retired
+        self.skip_to(999999)
+        before = self.scan(site_id)
+        after = self.scan(site_id)
+        self.assertEquals((before, after), (999999, 1000000))
+
+        self.assertEquals(maintain_scan_partitions(2, 0), {'created': 1, 'archived': 0, 'dropped': 0})
+
+        for scan_id in (after, before):
+            self.assertEquals(insert_test_results(site_id, scan_id, self.results(scan_id), {}, 200,
+                                                  buffered=False)['state'], STATE_FINISHED)
+
+        self.assertEquals(self.execute('SELECT scan_id FROM tests_p000000'), [(before,)])
+        self.assertEquals(self.execute('SELECT scan_id FROM tests_p000001'), [(after,)])
+        self.assertEquals(self.execute('SELECT count(*) FROM scans WHERE state = %s', (STATE_FINISHED,)), [(2,)])
+
+    def test_retire(self):
+        old, current = self.site('old.example.com'), self.site('current.example.com')
+
+        self.finish(self.scan(old), 90, 1)
+        self.finish(self.scan(current), 50, 1)
+
+        self.skip_to(1500000)
+        self.finish(self.scan(current), 100, 2)
+
+        # With just the one hot partition, partition 0 is archived, and then dropped once it's a partition older
+        self.assertEquals(self.execute('SELECT * FROM retire_scan_partitions(1, 1)'), [(1, 0)])
+        self.assertEquals(self.partitions('archive'), ['scans_p000000', 'tests_p000000'])
+        self.assertEquals(self.execute('SELECT count(*) FROM scans'), [(1,)])
+
+        self.skip_to(2500000)
+        self.execute('SELECT create_scan_partitions()')
+        self.assertEquals(self.execute('SELECT * FROM retire_scan_partitions(1, 1)'), [(1, 1)])
+        self.assertEquals(self.partitions('archive'), ['scans_p000001', 'tests_p000001'])
+        self.assertEquals(self.partitions(), ['scans_p000002', 'scans_p000003', 'scans_p000004',
+                                              'tests_p000002', 'tests_p000003', 'tests_p000004'])
+
+    def test_retire_refreshes_summaries(self):
+        self.use_pool()
+        old, current = self.site('old.example.com'), self.site('current.example.com')
+
+        self.finish(self.scan(old), 90, 1)
+        self.finish(self.scan(current), 50, 1)
+
+        self.skip_to(1500000)
+        self.finish(self.scan(current), 100, 2)
+
+        # Maintenance retires partition 0, and the summaries forget every scan that was in it
+        self.skip_to(2500000)
+        self.assertEquals(maintain_scan_partitions(2, 0), {'created': 2, 'archived': 1, 'dropped': 0})
+
+        self.assertEquals([row[0] for row in self.execute('SELECT domain FROM latest_scans')],
+                          ['current.example.com'])
+
+        self.use_pool('httpobsapi')
+        self.assertEquals(select_star_from('grade_distribution'), {'A': 1})
+        self.assertEquals(select_star_from('grade_distribution_all_scans'), {'A': 1})
+
+        summaries = self.summaries()
+        self.execute('SELECT refresh_scan_summaries()')
+        self.assertEquals(self.summaries(), summaries)
+
+
+class TestPartitioningMigration(SchemaTestCase):
+    schema = unpartitioned_schema()
+
+    def test_migrate(self):
+        sites = [self.site('{i}.example.com'.format(i=i)) for i in range(3)]
+
+        for minutes, site_id in enumerate(sites * 2):
+            scan_id = self.scan(site_id)
+            self.finish_with_tests(site_id, [scan_id])
+            self.execute('UPDATE scans SET end_time = %s WHERE id = %s',
+                         (self.start + timedelta(minutes=minutes), scan_id))
+
+        scans = self.execute('SELECT * FROM scans ORDER BY id')
+        tests = self.execute('SELECT * FROM tests ORDER BY id')
+        latest_tests = self.execute('SELECT * FROM latest_tests ORDER BY scan_id')
+        summaries = self.summaries()
+
+        self.execute(partitioning_migration())
+
+        # Everything that was there before is now in partition 0, which goes up to the next multiple of a million
+        self.assertEquals(self.execute("""SELECT relname FROM pg_partitioned_table
+                                            INNER JOIN pg_class ON (pg_class.oid = partrelid) ORDER BY relname"""),
+                          [('scans',), ('tests',)])
+        self.assertEquals(self.execute('SELECT pg_get_expr(relpartbound, oid) FROM pg_class WHERE relname = %s',
+                                       ('scans_p000000',)),
+                          [('FOR VALUES FROM (MINVALUE) TO (1000000)',)])
+        self.assertEquals(self.execute('SELECT * FROM scans ORDER BY id'), scans)
+        self.assertEquals(self.execute('SELECT * FROM tests ORDER BY id'), tests)
+        self.assertEquals(self.execute('SELECT * FROM latest_tests ORDER BY scan_id'), latest_tests)
+        self.assertEquals(self.summaries(), summaries)
+
+        # New scans carry on where the old ones left off, and finish just like before
+        scan_id = self.scan(sites[0])
+        self.assertEquals(scan_id, scans[-1][0] + 1)
+
+        self.use_pool()
+        insert_test_results(sites[0], scan_id, self.results(scan_id), {}, 200, buffered=False)
+        self.assertEquals(self.execute('SELECT scan_id FROM latest_scans WHERE site_id = %s', (sites[0],)),
+                          [(scan_id,)])
+        self.assertEquals(len(self.execute('SELECT * FROM tests WHERE scan_id = %s', (scan_id,))), 1)
+
+        # And once they're past partition 0, they go into the partitions that come after it
+        self.skip_to(1000000)
+        self.assertEquals(maintain_scan_partitions(0, 0)['created'], 1)
+        scan_id = self.scan(sites[1])
+        insert_test_results(sites[1], scan_id, self.results(scan_id), {}, 200, buffered=False)
+        self.assertEquals(self.execute('SELECT scan_id FROM tests_p000001'), [(scan_id,)])
+
+        summaries = self.summaries()
+        self.execute('SELECT refresh_scan_summaries()')
+        self.assertEquals(self.summaries(), summaries)
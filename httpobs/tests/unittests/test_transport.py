@@ -0,0 +1,86 @@
+import os
+import socket
+
+from unittest import skipUnless, TestCase
+from unittest.mock import MagicMock, patch
+
+from httpobs.scanner.retriever.retriever import RetrievalBudget
+from httpobs.scanner.retriever.transport import (create_connection,
+                                                 interleave_addresses,
+                                                 ScanAdapter,
+                                                 ScanTransport,
+                                                 shared_ssl_context,
+                                                 TLS_SESSION_RESUMPTION)
+
+
+def address(family, ip, port):
+    return family, socket.SOCK_STREAM, 6, '', (ip, port)
+
+
+class TestTransport(TestCase):
+    def setUp(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(8)
+        self.port = self.listener.getsockname()[1]
+
+        # A port that nothing is listening on
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        self.closed_port = closed.getsockname()[1]
+        closed.close()
+
+    def tearDown(self):
+        self.listener.close()
+
+    def test_interleave_addresses(self):
+        addresses = [address(socket.AF_INET6, '2001:db8::1', 443),
+                     address(socket.AF_INET6, '2001:db8::2', 443),
+                     address(socket.AF_INET6, '2001:db8::3', 443),
+                     address(socket.AF_INET, '192.0.2.1', 443)]
+
+        self.assertEquals([a[4][0] for a in interleave_addresses(addresses)],
+                          ['2001:db8::1', '192.0.2.1', '2001:db8::2', '2001:db8::3'])
+
+    def test_create_connection(self):
+        addresses = [address(socket.AF_INET, '127.0.0.1', self.closed_port),
+                     address(socket.AF_INET, '127.0.0.1', self.port)]
+
+        with patch('httpobs.scanner.retriever.transport.getaddrinfo', return_value=addresses):
+            sock = create_connection(('example.com', self.port), timeout=5)
+
+        self.assertEquals(sock.getpeername(), ('127.0.0.1', self.port))
+        self.assertEquals(sock.gettimeout(), 5)
+        sock.close()
+
+    def test_create_connection_refused(self):
+        addresses = [address(socket.AF_INET, '127.0.0.1', self.closed_port)]
+
+        with patch('httpobs.scanner.retriever.transport.getaddrinfo', return_value=addresses):
+            self.assertRaises(ConnectionRefusedError, create_connection, ('example.com', self.closed_port), 5)
+
+    def test_limiter_budget(self):
+        budget = RetrievalBudget(10, steps=2)
+        limiter = MagicMock()
+        limiter.acquire.side_effect = lambda url, max_wait: budget.__setattr__('deadline', budget.deadline - 6)
+
+        request = MagicMock(url='https://example.com/')
+        with patch('httpobs.scanner.retriever.transport.HTTPAdapter.send') as send:
+            ScanAdapter(limiter=limiter, budget=budget).send(request, timeout=(6.05, 30))
+
+        # The limiter gets no more than the request's share of the budget, and the timeout is what's left after it
+        self.assertAlmostEqual(limiter.acquire.call_args[1]['max_wait'], 5, places=1)
+        self.assertAlmostEqual(sum(send.call_args[1]['timeout']), 4, places=1)
+
+    @skipUnless(TLS_SESSION_RESUMPTION, 'TLS sessions can\'t be resumed')
+    def test_shared_ssl_context(self):
+        context = shared_ssl_context()
+
+        # Every scan in the process gets the same one
+        self.assertIs(ScanTransport().adapter.ssl_context, context)
+        self.assertIs(ScanTransport().adapter.ssl_context, context)
+        self.assertIsNone(ScanTransport().insecure_adapter.ssl_context)
+
+        # But a forked process gets its own
+        with patch('httpobs.scanner.retriever.transport.os.getpid', return_value=os.getpid() + 1):
+            self.assertIsNot(shared_ssl_context(), context)
@@ -24,8 +24,9 @@ def api_post_scan_hostname():
     hostname = request.args.get('host', '').lower()
 
     # Fail if it's not a valid hostname (not in DNS, not a real hostname, etc.)
-    ip = True if valid_hostname(hostname) is None else False
-    hostname = valid_hostname(hostname) or valid_hostname('www.' + hostname)  # prepend www. if necessary
+    valid = valid_hostname(hostname)
+    ip = True if valid is None else False
+    hostname = valid or valid_hostname('www.' + hostname)  # prepend www. if necessary
 
     if ip:
         return {
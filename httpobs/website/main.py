@@ -2,7 +2,13 @@ import sys
 
 from flask import Flask
 
+try:
+    from uwsgidecorators import postfork
+except ImportError:  # only available when running under uWSGI
+    postfork = None
+
 from httpobs.conf import DEVELOPMENT_MODE, API_PORT, API_PROPAGATE_EXCEPTIONS
+from httpobs.database import reset_pool
 from httpobs.website import add_response_headers
 from httpobs.website.api import api
 from httpobs.website.monitoring import monitoring_api
@@ -19,6 +25,10 @@ app.config['PROPAGATE_EXCEPTIONS'] = API_PROPAGATE_EXCEPTIONS
 app.register_blueprint(api)
 app.register_blueprint(monitoring_api)
 
+# uWSGI loads the app before forking off its workers, each of which needs its own database connections
+if postfork is not None:
+    postfork(reset_pool)
+
 
 @app.route('/')
 @add_response_headers()
@@ -1,7 +1,7 @@
 from flask import abort, Blueprint, jsonify
 
 from httpobs import SOURCE_URL, VERSION
-from httpobs.database import get_cursor
+from httpobs.database import get_cursor, get_pool_stats
 
 
 monitoring_api = Blueprint('monitoring-api', __name__)
@@ -17,7 +17,8 @@ def heartbeat():
     except:
         abort(500)
 
-    return jsonify({'database': 'OK'})
+    return jsonify({'database': 'OK',
+                    'pool': get_pool_stats()})
 
 
 @monitoring_api.route('/__lbheartbeat__')